@@ -1,32 +1,86 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
+import sys
+import time
+
+
+class StartupProfiler():
+    """ Time taken by each phase of starting up (imports, config, logging, MQTT, schema, Gateway construction, up to
+        the first packet being received), reported if run with --startup-profile. Defined ahead of the other imports,
+        so that they can be timed too
+    """
+
+    def __init__(self):
+        self.enabled = "--startup-profile" in sys.argv
+        self.done = False
+        self._start = self._last = time.perf_counter()
+        self._modules = len(sys.modules)
+        self.phases = {}
+
+    def mark(self, phase):
+        """ End of the given phase, i.e. the time since the previous mark is attributed to it """
+        now = time.perf_counter()
+        modules = len(sys.modules)
+        self.phases[phase] = (now - self._last, modules - self._modules)
+        self._last = now
+        self._modules = modules
+
+    def finish(self, phase="first_packet"):
+        if self.done:
+            return
+        self.mark(phase)
+        self.done = True
+        if self.enabled:
+            self.report()
+
+    def report(self):
+        total = self._last - self._start
+        print_formatted_row("", text=f"{Style.BRIGHT}{Fore.YELLOW}Startup profile: {total * 1000:.0f} ms to '{list(self.phases)[-1]}'")
+        for phase, (elapsed, modules) in self.phases.items():
+            imported = f"({modules} modules imported)" if modules else ""
+            print_formatted_row("", text=f"{Style.BRIGHT}{Fore.BLUE}   {phase:<18} {elapsed * 1000:9.1f} ms {100 * elapsed / total:5.1f}% {imported}")
+        log.info(f"Startup profile (ms): { {phase: round(elapsed * 1000, 1) for phase, (elapsed, _) in self.phases.items()} }")
+
+    def get_stats(self) -> dict:
+        return {f"{phase}_ms": round(elapsed * 1000, 1) for phase, (elapsed, _) in self.phases.items()}
+
+
+STARTUP = StartupProfiler()
+
+import argparse
 import asyncio
+import atexit
+import collections
+import functools
+import gzip
+import hashlib
 import json
 from platform import platform
-import sys
 import traceback
 import re
-import glob
-from typing import Tuple
+from typing import Tuple, Union
 from signal import SIGINT, SIGTERM
 import os
+import queue
+import threading
 import inspect
 import configparser
-import paho.mqtt.client as mqtt
-import time
+import sqlite3
 import datetime
-from colorama import init as colorama_init, Fore, Style, Back
+import uuid
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler
 from datetime import timedelta as td
+STARTUP.mark("import_stdlib")
 
-from ramses_rf import Gateway, GracefulExit
+# paho is imported on first use (see mqtt_initialise), as it is not needed when replaying packet logs.
+# NB: ramses_rf itself imports colorama and its discovery, schedule, command and message modules
+from colorama import init as colorama_init, Fore, Style, Back
+from ramses_rf import Gateway, GracefulExit, POLLER_TASK, create_pkt_stack
 from ramses_rf.discovery import GET_SCHED, SET_SCHED
-from ramses_rf.protocol import schedule
-from ramses_rf.protocol import command
 from ramses_rf.version import VERSION as RAMSES_RF_VERSION
-from ramses_rf.protocol.command import Command
+from ramses_rf.protocol.command import Command, QOS_KEYS
 from ramses_rf.protocol.const import HGI_DEVICE_ID, NON_DEVICE_ID, _OUT_DEVICE_TABLE
 from ramses_rf.protocol.logger import CONSOLE_COLS
 from ramses_rf.schema import (
@@ -58,6 +112,7 @@ from ramses_rf.protocol.schema import (
 from ramses_rf.protocol.exceptions import EvohomeError
 from ramses_rf.message import CODE_NAMES as CODE_NAMES
 # from ramses_rf.discovery import spawn_execute_cmd
+STARTUP.mark("import_ramses_rf")
 
 LIB_KEYS = (
     INPUT_FILE,
@@ -108,19 +163,49 @@ def get_display_colorscheme(reload_config=False):
 
     return scheme
 
+def get_config_dict(section, option, fallback, value_type=str):
+    """ Parse a 'key: value, key: value...' config string into a dict """
+    items = config.get(section, option, fallback=fallback).split(",")
+    return {k.strip(): value_type(v.strip()) for k, v in (item.split(":", 1) for item in items if item.strip())}
+
 COM_PORT                = config.get("Serial Port","COM_PORT", fallback="/dev/ttyUSB0")
 COM_BAUD                = config.get("Serial Port","COM_BAUD", fallback=115200)
+# Optional list of several radios (serial ports) to use together. If given, the first one replaces COM_PORT
+COM_PORTS               = [port.strip() for port in config.get("Serial Port", "COM_PORTS", fallback="").split(",") if port.strip()]
+COM_PORT                = COM_PORTS[0] if COM_PORTS else COM_PORT
+RADIO_DEDUP_WINDOW      = config.getfloat("Serial Port", "RADIO_DEDUP_WINDOW", fallback=0.5)
 
 EVENTS_FILE             = config.get("Files", "EVENTS_FILE", fallback="events.log")
 PACKET_LOG_FILE         = config.get("Files", "PACKET_LOG_FILE", fallback="packet.log")
 LOG_FILE_ROTATE_COUNT   = config.getint("Files", "LOG_FILE_ROTATE_COUNT", fallback=9)
 LOG_FILE_ROTATE_BYTES   = config.getint("Files", "LOG_FILE_ROTATE_BYTES", fallback=1000000)
+# Rotated packet logs are compressed into PACKET_ARCHIVE_DIR, with an index (in blocks of PACKET_ARCHIVE_BLOCK_LINES
+# packets) by time, device and code. Rotated files are left as they are (up to LOG_FILE_ROTATE_COUNT) if no
+# PACKET_ARCHIVE_DIR. The oldest archives are deleted once they take up more than PACKET_ARCHIVE_MAX_MB (0 for no limit)
+PACKET_ARCHIVE_DIR      = config.get("Files", "PACKET_ARCHIVE_DIR", fallback="")
+PACKET_ARCHIVE_BLOCK_LINES = config.getint("Files", "PACKET_ARCHIVE_BLOCK_LINES", fallback=1000)
+PACKET_ARCHIVE_MAX_MB   = config.getfloat("Files", "PACKET_ARCHIVE_MAX_MB", fallback=100)
+# Max log records waiting to be written by the background log writer. Further records are dropped
+LOG_QUEUE_SIZE          = config.getint("Files", "LOG_QUEUE_SIZE", fallback=10000)
 
 DEVICES_FILE            = config.get("Files", "DEVICES_FILE", fallback="devices.json")
 ZONES_FILE              = config.get("Files", "ZONES_FILE", fallback="zones.json")
 LOAD_ZONES_FROM_FILE    = config.getboolean("Files", "LOAD_ZONES_FROM_FILE", fallback=True)
 SCHEMA_FILE             = config.get("Files", "SCHEMA_FILE", fallback="ramsesrf_schema.json")
 MAX_SAVE_FILE_COUNT     = config.getint("Files", "MAX_SAVE_FILE_COUNT", fallback=9)
+STATE_STORE_FILE        = config.get("Files", "STATE_STORE_FILE", fallback="evogateway_state.jsonl")
+SAVE_DEBOUNCE_SECS      = config.getfloat("Files", "SAVE_DEBOUNCE_SECS", fallback=5)
+STATE_SNAPSHOT_FILE     = config.get("Files", "STATE_SNAPSHOT_FILE", fallback="state_snapshot.json")
+STATE_SNAPSHOT_INTERVAL = config.getint("Files", "STATE_SNAPSHOT_INTERVAL", fallback=300)
+STATE_SNAPSHOT_MAX_AGE  = config.getint("Files", "STATE_SNAPSHOT_MAX_AGE", fallback=3600)
+METRICS_FILE            = config.get("Files", "METRICS_FILE", fallback="")
+SCHEDULES_FILE          = config.get("Files", "SCHEDULES_FILE", fallback="schedules.json")
+# History of numeric values (SQLite db) for the given codes, with days kept at each resolution. No history if no file
+HISTORY_DB_FILE         = config.get("Files", "HISTORY_DB_FILE", fallback="")
+HISTORY_CODES           = [code.strip() for code in config.get("Files", "HISTORY_CODES",
+                            fallback="temperature, setpoint, heat_demand, relay_demand, dhw_temp, opentherm_msg, actuator_state").split(",") if code.strip()]
+HISTORY_RETENTION_DAYS  = get_config_dict("Files", "HISTORY_RETENTION_DAYS", "raw: 2, 1min: 14, 15min: 180, 1h: 1825", float)
+HISTORY_FLUSH_INTERVAL  = config.getfloat("Files", "HISTORY_FLUSH_INTERVAL", fallback=10)
 
 MQTT_SERVER             = config.get("MQTT", "MQTT_SERVER", fallback="")
 MQTT_USER               = config.get("MQTT", "MQTT_USER", fallback="")
@@ -128,8 +213,23 @@ MQTT_PW                 = config.get("MQTT", "MQTT_PW", fallback="")
 MQTT_CLIENTID           = config.get("MQTT", "MQTT_SERVER", fallback="evoGateway")
 
 MQTT_PUB_AS_JSON        = config.getboolean("MQTT", "MQTT_PUB_AS_JSON", fallback=False)
+# Publish one JSON state document per zone (with the same tree as the per key topics), at most every ZONE_DOC_INTERVAL secs
+MQTT_PUB_ZONE_DOCS      = config.getboolean("MQTT", "MQTT_PUB_ZONE_DOCS", fallback=False)
+MQTT_ZONE_DOC_INTERVAL  = config.getfloat("MQTT", "MQTT_ZONE_DOC_INTERVAL", fallback=5)
 MQTT_GROUP_BY_ZONE      = config.getboolean("MQTT", "MQTT_GROUP_BY_ZONE", fallback=True)
 MQTT_REQUIRE_ZONE_NAMES = config.getboolean("MQTT", "MQTT_REQUIRE_ZONE_NAMES", fallback=True)
+MQTT_SCHEMA_PUBLISH_DELAY = config.getfloat("MQTT", "MQTT_SCHEMA_PUBLISH_DELAY", fallback=5)
+MQTT_STATS_PUBLISH_INTERVAL = config.getfloat("MQTT", "MQTT_STATS_PUBLISH_INTERVAL", fallback=60)
+
+# Only publish received values that have changed, or are due a heartbeat republish
+MQTT_PUB_CHANGES_ONLY   = config.getboolean("MQTT", "MQTT_PUB_CHANGES_ONLY", fallback=False)
+MQTT_PUB_MAX_INTERVAL   = config.getfloat("MQTT", "MQTT_PUB_MAX_INTERVAL", fallback=900)
+MQTT_PUB_DEADBANDS      = get_config_dict("MQTT", "MQTT_PUB_DEADBANDS", "temperature: 0.05, dhw_temp: 0.05", float)
+
+# Publish pipeline. Policy for when the client's outgoing queue is full is either 'drop' or 'coalesce'
+MQTT_MAX_QUEUED         = config.getint("MQTT", "MQTT_MAX_QUEUED", fallback=1000)
+MQTT_QUEUE_POLICY       = config.get("MQTT", "MQTT_QUEUE_POLICY", fallback="coalesce").strip().lower()
+MQTT_QOS                = get_config_dict("MQTT", "MQTT_QOS", "state: 0, timestamp: 0, schema: 0, command: 0, stats: 0, status: 0", int)
 
 MQTT_SUB_TOPIC          = config.get("MQTT", "MQTT_SUB_TOPIC", fallback="")
 MQTT_PUB_TOPIC          = config.get("MQTT", "MQTT_PUB_TOPIC", fallback="")
@@ -139,7 +239,24 @@ MQTT_ZONE_UNKNOWN       = config.get("MQTT", "MQTT_ZONE_UNKNOWN", fallback="_zon
 THIS_GATEWAY_NAME       = config.get("MISC", "THIS_GATEWAY_NAME", fallback="EvoGateway")
 GATEWAY_DISABLE_SENDING = config.getboolean("MISC", "DISABLE_SENDING", fallback=False)
 
+# Commands received via MQTT. Max awaiting a response at any one time, and seconds to wait for a response
+COMMAND_MAX_IN_FLIGHT   = config.getint("MISC", "COMMAND_MAX_IN_FLIGHT", fallback=2)
+COMMAND_TIMEOUT         = config.getfloat("MISC", "COMMAND_TIMEOUT", fallback=10)
+COMMAND_DEFAULT_PRIORITY = config.getint("MISC", "COMMAND_DEFAULT_PRIORITY", fallback=5)
+
+# Max fraction of DUTY_CYCLE_WINDOW seconds that the gateway may spend transmitting (e.g. 1% for 868MHz). 0 to disable
+DUTY_CYCLE_LIMIT        = config.getfloat("MISC", "DUTY_CYCLE_LIMIT", fallback=0.01)
+DUTY_CYCLE_WINDOW       = config.getfloat("MISC", "DUTY_CYCLE_WINDOW", fallback=3600)
+
 DISPLAY_FULL_JSON       = config.getboolean("MISC", "DISPLAY_FULL_JSON", fallback=False)
+# Skip formatting received msgs for the console altogether. 'auto' if stdout is not a terminal (e.g. systemd service)
+DISPLAY_HEADLESS        = config.get("MISC", "DISPLAY_HEADLESS", fallback="auto").strip().lower()
+DISPLAY_HEADLESS        = not sys.stdout.isatty() if DISPLAY_HEADLESS == "auto" else DISPLAY_HEADLESS in ("true", "yes", "on", "1")
+# Max console rows waiting to be rendered. The oldest are dropped if the console cannot keep up
+DISPLAY_QUEUE_SIZE      = config.getint("MISC", "DISPLAY_QUEUE_SIZE", fallback=1000)
+DEDUP_WINDOW            = config.getfloat("MISC", "DEDUP_WINDOW", fallback=3)
+DEDUP_SLOTS             = config.getint("MISC", "DEDUP_SLOTS", fallback=1024)
+SCHEDULE_CONCURRENCY    = config.getint("MISC", "SCHEDULE_CONCURRENCY", fallback=1)
 SCHEMA_EAVESDROP        = config.getboolean("Misc", "SCHEMA_EAVESDROP", fallback=False)
 FORCE_SINGLE_HGI        = config.getboolean("Misc", "FORCE_SINGLE_HGI", fallback=True)
 DHW_ZONE_PREFIX         = config.get("Misc", "DHW_ZONE_PREFIX", fallback="_dhw")
@@ -150,38 +267,764 @@ RAMSESRF_KNOWN_LIST        = config.getboolean("Ramses_rf", "KNOWN_LIST", fallba
 
 MIN_ROW_LENGTH          = config.get("MISC", "MIN_ROW_LENGTH", fallback=160)
 
+# Seconds before retrying a device/zone lookup that was not found in the gateway schema
+LOOKUP_MISS_TTL         = config.getfloat("MISC", "LOOKUP_MISS_TTL", fallback=300)
+
 DISPLAY_COLOURS         = get_display_colorscheme()
+STARTUP.mark("config")
 
 MQTT_STATUS_SUBTOPIC    = "status"
 MQTT_OFFLINE            = "Offline"
 MQTT_ONLINE             = "Online"
 SYS_CONFIG_COMMAND      = "sys_config"
 SYSTEM_MSG_TAG          = "*"
-SEND_STATUS_TRANSMITTED = "Transmitted"
+SEND_STATUS_QUEUED      = "Queued"
+SEND_STATUS_DISPATCHED  = "Dispatched" # Handed to ramses_rf's transmit queue, i.e. not necessarily on air yet
 SEND_STATUS_FAILED      = "Failed"
 SEND_STATUS_SUCCESS     = "Successful"
+SEND_STATUS_TIMED_OUT   = "Timed out"
+SEND_STATUS_SUPERSEDED  = "Superseded"
+
+RF_BIT_RATE             = 38400 # evohome 868MHz radio
+RF_FRAME_OVERHEAD_BYTES = 8     # preamble, sync word and trailer
+
+STAGE_QUANTILES         = (0.5, 0.9, 0.99)
+
+PACKET_LOGGER_NAME      = "ramses_rf.protocol.packet_log" # ramses_rf's packet log (PACKET_LOG_FILE)
 
 SZ_ZONE_NAME            = "name"
 SZ_UFH_CIRCUITS         = "circuits"
 
 # -----------------------------------
-DEVICES = {}
-ZONES = {}
-UFH_CIRCUITS = {}
 MQTT_CLIENT = None
+MQTT_LOOP_HELPER = None
 GWY = None
+RADIOS = None # RadioSet, if more than one of COM_PORTS is configured
+HISTORY = None # HistoryStore, if HISTORY_DB_FILE is configured (not when replaying packet logs)
 GWY_MODE = None
-LAST_SEND_MSG = None
+
+# Resolved MQTT topics, keyed on (src device id, code_name, target zone, src zone, topic_idx). Only valid
+# for the current REGISTRY devices/zones/UFH circuits, so must be cleared whenever any of these change. Least recently
+# used first, and limited to TOPIC_CACHE_SIZE topics, as e.g. a neighbour's devices can add any number of device ids
+TOPIC_CACHE = collections.OrderedDict()
+TOPIC_CACHE_SIZE = 2000
+
+# Hash of each last published _gateway_config section, so that only changed sections are republished
+SCHEMA_SECTION_HASHES = {}
+SCHEMA_PUBLISH_PENDING = False
+
+# Last value (and monotonic time) published to each received msg topic, for MQTT_PUB_CHANGES_ONLY
+LAST_PUBLISHED = {}
+
+# perf_counter() time the current packet line was handed to ramses_rf, when replaying a packet log
+PACKET_RX_TIME = None
+SCHEDULE_CACHE = None   # Schedules by zone_idx, with the controller's schedule change counter when received
+SCHEDULE_WRITES = None  # Queue of schedules to be written, one at a time, by the schedule_writer() task
+RESTORING_STATE = False # True while msgs from the STATE_SNAPSHOT_FILE are being replayed into GWY
+STALE_TOPICS = set()    # Restored '_stale' topics marked as stale, until a live msg is published to the topic
 
 # -----------------------------------
 
+class BatchedRotatingFileHandler(RotatingFileHandler):
+    """ RotatingFileHandler that is only flushed by flush_batch(), so that a batch of records is written in one go """
+
+    archiver = None # PacketLogArchiver for the rotated files, if any
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+    def doRollover(self):
+        super().doRollover()
+        if self.archiver and self.backupCount > 0:
+            self.archiver.archive(f"{self.baseFilename}.1")
+
+
+class BatchedTimedRotatingFileHandler(TimedRotatingFileHandler):
+    """ As BatchedRotatingFileHandler, for logs rotated at midnight (i.e. ramses_rf's packet log, if there is no
+        LOG_FILE_ROTATE_BYTES)
+    """
+
+    archiver = None
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+    def doRollover(self):
+        super().doRollover()
+        if self.archiver and self.backupCount > 0:
+            self.archiver.archive_rotated(self.baseFilename)
+
+
+def get_rotated_files(log_file) -> list:
+    """ The rotated copies of log_file, oldest first: log_file.<n> if rotated by size, or log_file.<date> if at midnight """
+    dir_name, base_name = os.path.split(os.path.abspath(log_file))
+    dated = sorted(f for f in os.listdir(dir_name) if re.fullmatch(rf"{re.escape(base_name)}\.\d{{4}}-\d{{2}}-\d{{2}}", f)) \
+        if os.path.isdir(dir_name) else []
+    return ([f"{log_file}.{n}" for n in range(LOG_FILE_ROTATE_COUNT, 0, -1) if os.path.isfile(f"{log_file}.{n}")]
+        + [os.path.join(os.path.dirname(log_file), f) for f in dated])
+
+
+def parse_packet_line(line):
+    """ Timestamp, device ids and code of a packet log line, or None if not a packet (e.g. a comment) """
+    fields = line.split()
+    if len(fields) < 9 or fields[1] == "#":
+        return None
+    return fields[0], [f for f in fields[4:7] if f != "--:------"], fields[7]
+
+
+def packet_line_matches(line, start=None, end=None, devices=None, codes=None) -> bool:
+    """ True if the packet is within start/end (ISO datetimes), and from/to any of devices, and of any of codes """
+    packet = parse_packet_line(line)
+    if not packet or (start and packet[0] < start) or (end and packet[0] > end):
+        return False
+    return (not devices or not devices.isdisjoint(packet[1])) and (not codes or packet[2] in codes)
+
+
+class PacketLogArchiver():
+    """ Compresses rotated packet logs into archive_dir. Each archive is written as a series of gzip members (one per
+        block of block_lines lines, which together are still a normal .gz file), with a sidecar index (.idx) of the
+        offset, time range, device ids and codes of each block. Queries then only need to read and decompress the
+        blocks that can match, rather than grepping through every log file. Once the archives take up more than
+        max_mb, the oldest are deleted.
+    """
+
+    def __init__(self, archive_dir, block_lines, max_mb=0):
+        self.archive_dir = archive_dir
+        self.block_lines = max(block_lines, 1)
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.archived = 0
+        self.archived_lines = 0
+        self.pruned = 0
+        self.errors = 0
+        self.archive_time = 0
+        self._lock = threading.Lock()
+
+    def archive_rotated(self, log_file):
+        """ Archive any rotated files of log_file, oldest first """
+        for file_name in get_rotated_files(log_file):
+            self.archive(file_name)
+
+    def archive(self, file_name):
+        with self._lock:
+            start = time.perf_counter()
+            try:
+                with open(file_name, "r") as fp:
+                    lines = fp.readlines()
+                if lines:
+                    self._write_archive(lines)
+                os.remove(file_name)
+                self.archived += 1
+                self.archived_lines += len(lines)
+                self._prune()
+            except Exception as e:
+                self.errors += 1
+                log.error(f"Exception occured archiving packet log '{file_name}': {e}", exc_info=True)
+            finally:
+                self.archive_time += time.perf_counter() - start
+
+    def _write_archive(self, lines):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        name = f"packet_{lines[0][:19].replace('-', '').replace(':', '')}"
+        archive_file = os.path.join(self.archive_dir, f"{name}.log.gz")
+        n = 1
+        while os.path.exists(archive_file):
+            n += 1
+            archive_file = os.path.join(self.archive_dir, f"{name}_{n}.log.gz")
+
+        blocks = []
+        with open(f"{archive_file}.tmp", "wb") as fp:
+            for i in range(0, len(lines), self.block_lines):
+                block = lines[i:i + self.block_lines]
+                devices, codes = set(), set()
+                for line in block:
+                    packet = parse_packet_line(line)
+                    if packet:
+                        devices.update(packet[1])
+                        codes.add(packet[2])
+                data = gzip.compress("".join(block).encode())
+                blocks.append({"offset": fp.tell(), "size": len(data), "first": block[0][:26], "last": block[-1][:26],
+                    "lines": len(block), "devices": sorted(devices), "codes": sorted(codes)})
+                fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(f"{archive_file}.tmp", archive_file)
+        write_file_atomic(f"{archive_file}.idx", json.dumps({"file": os.path.basename(archive_file), "first": blocks[0]["first"],
+            "last": blocks[-1]["last"], "lines": len(lines), "blocks": blocks}))
+
+    def _prune(self):
+        """ Delete the oldest archives (and their indexes) until the rest fit within max_bytes. The newest is always kept """
+        if not self.max_bytes:
+            return
+        archives = sorted(f for f in os.listdir(self.archive_dir) if f.endswith(".log.gz"))
+        sizes = {f: sum(os.path.getsize(os.path.join(self.archive_dir, n)) for n in (f, f"{f}.idx")
+            if os.path.isfile(os.path.join(self.archive_dir, n))) for f in archives}
+        total = sum(sizes.values())
+        for archive_file in archives[:-1]:
+            if total <= self.max_bytes:
+                break
+            for name in (f"{archive_file}.idx", archive_file):
+                if os.path.isfile(os.path.join(self.archive_dir, name)):
+                    os.remove(os.path.join(self.archive_dir, name))
+            total -= sizes[archive_file]
+            self.pruned += 1
+            log.info(f"Deleted packet log archive '{archive_file}', as the archives are over PACKET_ARCHIVE_MAX_MB")
+
+    def query(self, start=None, end=None, devices=None, codes=None):
+        """ Yield the archived packet log lines that match (see packet_line_matches), oldest first """
+        if not os.path.isdir(self.archive_dir):
+            return
+        for idx_file in sorted(f for f in os.listdir(self.archive_dir) if f.endswith(".idx")):
+            with open(os.path.join(self.archive_dir, idx_file), "r") as fp:
+                index = json.load(fp)
+            if (start and index["last"] < start) or (end and index["first"] > end):
+                continue
+            with open(os.path.join(self.archive_dir, index["file"]), "rb") as fp:
+                for block in index["blocks"]:
+                    if ((start and block["last"] < start) or (end and block["first"] > end)
+                        or (devices and devices.isdisjoint(block["devices"])) or (codes and codes.isdisjoint(block["codes"]))):
+                        continue
+                    fp.seek(block["offset"])
+                    for line in gzip.decompress(fp.read(block["size"])).decode().splitlines(True):
+                        if packet_line_matches(line, start, end, devices, codes):
+                            yield line
+
+    def get_stats(self) -> dict:
+        return {"archived": self.archived, "archived_lines": self.archived_lines, "pruned": self.pruned, "errors": self.errors,
+            "archive_s": round(self.archive_time, 3)}
+
+
+def query_packet_logs(start=None, end=None, devices=None, codes=None):
+    """ Yield the matching packet log lines from the archive, then from the packet logs not yet archived. start/end
+        are ISO datetimes
+    """
+    start = datetime.datetime.fromisoformat(start).isoformat(timespec="microseconds") if start else None
+    end = datetime.datetime.fromisoformat(end).isoformat(timespec="microseconds") if end else None
+    devices = set(devices or ())
+    codes = {code.upper() for code in codes or ()}
+    if PACKET_ARCHIVER:
+        yield from PACKET_ARCHIVER.query(start, end, devices, codes)
+    for file_name in get_rotated_files(PACKET_LOG_FILE) + [PACKET_LOG_FILE]:
+        if os.path.isfile(file_name):
+            with open(file_name, "r") as fp:
+                yield from (line for line in fp if packet_line_matches(line, start, end, devices, codes))
+
+
+class BackgroundLogWriter():
+    """ Writes log records from a background thread, so that slow disk writes/rotations (e.g. SD cards) do not hold
+        up msg processing. Records are queued by a LogQueueHandler, along with the handlers to write them to, and
+        are written in batches with one flush per batch. If the queue is full, records are dropped.
+    """
+
+    def __init__(self, max_queued, max_batch=500):
+        self.max_batch = max_batch
+        self.queued = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.write_time = 0
+        self._queue = queue.Queue(max_queued)
+        self._thread = threading.Thread(target=self._run, name="log_writer", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, handlers, record):
+        try:
+            self._queue.put_nowait((handlers, record))
+            self.queued += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self, timeout=5):
+        """ Write out anything still queued """
+        if self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = batch[:batch.index(None)]
+
+            start = time.perf_counter()
+            flush_handlers = set()
+            for handlers, record in batch:
+                for handler in handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+                        flush_handlers.add(handler)
+            for handler in flush_handlers:
+                try:
+                    getattr(handler, "flush_batch", handler.flush)()
+                except Exception:
+                    pass
+            self.written += len(batch)
+            self.batches += 1 if batch else 0
+            self.write_time += time.perf_counter() - start
+
+    def get_stats(self) -> dict:
+        return {"queued": self.queued, "queue_depth": self._queue.qsize(), "written": self.written,
+            "dropped": self.dropped, "batches": self.batches, "write_s": round(self.write_time, 3)}
+
+
+class LogQueueHandler(logging.Handler):
+    """ Hands records to the BackgroundLogWriter, to be written to the given handlers """
+
+    def __init__(self, writer, handlers):
+        super().__init__(min(h.level for h in handlers))
+        self.writer = writer
+        self.handlers = handlers
+
+    def emit(self, record):
+        if record.args:
+            # Merge now, in case the args are changed before the record is written
+            record.msg = record.getMessage()
+            record.args = None
+        self.writer.enqueue(self.handlers, record)
+
+
+def write_file_atomic(file_name, text):
+    """ Write to a temp file, fsync and then rename over file_name, so that file_name is always either the old or the
+        new version, even after a crash/power cut part way through
+    """
+    tmp_file = f"{file_name}.tmp"
+    with open(tmp_file, "w") as fp:
+        fp.write(text)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_file, file_name)
+    try:
+        dir_fd = os.open(os.path.dirname(os.path.abspath(file_name)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd) # Make the rename itself durable
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass # e.g. Windows, where directories cannot be opened
+
+
+class StateWriter():
+    """ Saves json files (devices, zones, schema) from a background thread, so that saving never holds up msg
+        processing. Repeated saves of the same file within debounce_secs are coalesced, and each file is written
+        atomically (see write_file_atomic). Instead of numbered backup files, every saved version is appended (as a
+        json line) to a single store file, which is compacted to the last max_versions per file as it grows.
+    """
+
+    def __init__(self, store_file, max_versions, debounce_secs):
+        self.store_file = store_file
+        self.max_versions = max_versions
+        self.debounce_secs = debounce_secs
+        self.requested = 0
+        self.written = 0
+        self.unchanged = 0
+        self.errors = 0
+        self.write_time = 0
+        self._pending = {}
+        self._last_text = {}
+        self._store_lines = None
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="state_writer", daemon=True)
+        self._thread.start()
+
+    def save(self, file_content, file_name, sorted=False, versioned=True):
+        """ Queue file_content to be saved to file_name, replacing any earlier save still waiting for the same file.
+            If not versioned, previous versions are not kept in the store
+        """
+        text = json.dumps(file_content, sort_keys=sorted, indent=4 if versioned else None) # Serialise now, as the content may then change
+        with self._cond:
+            due = self._pending[file_name][1] if file_name in self._pending else time.monotonic() + self.debounce_secs
+            self._pending[file_name] = (text, due, versioned)
+            self.requested += 1
+            self._cond.notify()
+
+    def flush(self, timeout=10):
+        """ Write out any pending saves now, waiting until they are done """
+        with self._cond:
+            self._pending = {f: (text, 0, versioned) for f, (text, due, versioned) in self._pending.items()}
+            self._cond.notify()
+            self._cond.wait_for(lambda: not self._pending, timeout)
+
+    def stop(self, timeout=10):
+        self.flush(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    now = time.monotonic()
+                    due = [f for f, (text, t, versioned) in self._pending.items() if t <= now]
+                    if due:
+                        break
+                    timeout = min(t for text, t, versioned in self._pending.values()) - now if self._pending else None
+                    self._cond.wait(timeout)
+                if self._stopping and not self._pending:
+                    return
+                now = time.monotonic()
+                to_write = {f: (text, versioned) for f, (text, t, versioned) in self._pending.items() if t <= now or self._stopping}
+
+            for file_name, (text, versioned) in to_write.items():
+                self._write(file_name, text, versioned)
+
+            with self._cond:
+                for file_name, (text, versioned) in to_write.items():
+                    if file_name in self._pending and self._pending[file_name][0] is text:
+                        del self._pending[file_name]
+                self._cond.notify_all()
+
+    def _write(self, file_name, text, versioned=True):
+        start = time.perf_counter()
+        try:
+            if self._last_text.get(file_name) is None and os.path.isfile(file_name):
+                with open(file_name, "r") as fp:
+                    self._last_text[file_name] = fp.read()
+            if text == self._last_text.get(file_name):
+                self.unchanged += 1
+                return
+
+            if self.store_file and versioned:
+                self._append_version(file_name, text)
+            write_file_atomic(file_name, text)
+            self._last_text[file_name] = text
+            self.written += 1
+        except Exception as e:
+            self.errors += 1
+            log.error(f"Exception occured saving file '{file_name}': {e}", exc_info=True)
+        finally:
+            self.write_time += time.perf_counter() - start
+
+    def _append_version(self, file_name, text):
+        if self._store_lines is None:
+            self._store_lines = self._load_store()
+        self._store_lines.append(json.dumps({"file": file_name, "saved": datetime.datetime.now().isoformat(timespec="seconds"),
+            "content": json.loads(text)}))
+
+        file_count = len({json.loads(line)["file"] for line in self._store_lines})
+        if len(self._store_lines) > 2 * max(self.max_versions, 1) * file_count:
+            # Compact, keeping only the most recent versions of each file
+            counts = {}
+            kept = []
+            for line in reversed(self._store_lines):
+                f = json.loads(line)["file"]
+                counts[f] = counts.get(f, 0) + 1
+                if counts[f] <= self.max_versions:
+                    kept.append(line)
+            self._store_lines = kept[::-1]
+            write_file_atomic(self.store_file, "".join(f"{line}\n" for line in self._store_lines))
+        else:
+            with open(self.store_file, "a") as fp:
+                fp.write(f"{self._store_lines[-1]}\n")
+                fp.flush()
+                os.fsync(fp.fileno())
+
+    def _load_store(self) -> list:
+        lines = []
+        if os.path.isfile(self.store_file):
+            with open(self.store_file, "r") as fp:
+                for line in fp:
+                    try:
+                        json.loads(line)["file"]
+                        lines.append(line.rstrip("\n"))
+                    except (ValueError, KeyError, TypeError):
+                        pass # e.g. a partial last line, after a crash while appending
+        return lines
+
+    def get_stats(self) -> dict:
+        return {"requested": self.requested, "pending": len(self._pending), "written": self.written,
+            "unchanged": self.unchanged, "errors": self.errors, "write_s": round(self.write_time, 3)}
+
+
+class HistoryStore():
+    """ Time series of numeric payload values (e.g. temperatures, setpoints, heat demand, OpenTherm values), kept in a
+        local SQLite db by a background thread. Samples are inserted in batches every flush_interval seconds, and are
+        rolled up at the same time into 1 min, 15 min and 1 h buckets (count/sum/min/max/last), so that longer time
+        spans can be queried without the raw samples. Each resolution is kept for its own number of retention days
+        (DEFAULT_RETENTION_DAYS for any not given, and for ever if 0).
+        Queries are also run on the background thread, with the result handed to a callback.
+    """
+
+    TIERS = {"raw": 0, "1min": 60, "15min": 900, "1h": 3600}
+    DEFAULT_RETENTION_DAYS = {"raw": 2, "1min": 14, "15min": 180, "1h": 1825}
+    MAX_POINTS = 1000 # Per series, when choosing the resolution for a query
+
+    def __init__(self, db_file, codes, retention_days, flush_interval, max_queued=100000):
+        self.db_file = db_file
+        self.codes = set(codes)
+        self.retention_days = {tier: retention_days.get(tier, self.DEFAULT_RETENTION_DAYS[tier]) or None for tier in self.TIERS}
+        self.flush_interval = flush_interval
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.queries = 0
+        self.errors = 0
+        self.write_time = 0
+        self._series_ids = {}
+        self._last_pruned = 0
+        self._queue = queue.Queue(max_queued)
+        self._stop_now = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="history_writer", daemon=True)
+        self._thread.start()
+
+    def record(self, msg):
+        """ Queue the msg's numeric payload values, if its code is one of those kept """
+        if msg.code_name not in self.codes:
+            return
+        ts = msg.dtm.timestamp()
+        items = msg.payload if isinstance(msg.payload, list) else [msg.payload]
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            idx = str(item.get("zone_idx") or item.get("ufh_idx") or item.get("parent_idx") or item.get("domain_id") or "")
+            for key, value in item.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                if msg.code_name == "opentherm_msg":
+                    if key != "value" or not isinstance(item.get("msg_name"), str):
+                        continue
+                    key = item["msg_name"]
+                try:
+                    self._queue.put_nowait(((msg.src.id, msg.code_name, idx, key), ts, value))
+                    self.recorded += 1
+                except queue.Full:
+                    self.dropped += 1
+
+    def query(self, request, callback):
+        """ Run the query (see _query) on the background thread, then call callback(result). If the queue is full,
+            callback is called straight away with an error, rather than holding up the caller (i.e. the event loop)
+        """
+        try:
+            self._queue.put_nowait(("query", request, callback))
+        except queue.Full:
+            self.errors += 1
+            log.error(f"History query dropped, as the history queue is full: {request}")
+            result = {"error": "History queue is full. Please try again later"}
+            if "query_id" in request:
+                result["query_id"] = request["query_id"]
+            callback(result)
+
+    def stop(self, timeout=10):
+        """ Write out anything still queued. If the queue is full (i.e. the writer has stalled), just write out what
+            has been taken off the queue so far, rather than waiting for room to queue the stop
+        """
+        if self._thread.is_alive():
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                self._stop_now.set()
+            self._thread.join(timeout)
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_file)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS series (id INTEGER PRIMARY KEY, device_id TEXT NOT NULL, code TEXT NOT NULL, "
+            "idx TEXT NOT NULL, key TEXT NOT NULL, UNIQUE (device_id, code, idx, key))")
+        conn.execute("CREATE TABLE IF NOT EXISTS samples (series INTEGER NOT NULL, ts REAL NOT NULL, value REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS samples_series_ts ON samples (series, ts)")
+        for tier, secs in self.TIERS.items():
+            if secs:
+                conn.execute(f"CREATE TABLE IF NOT EXISTS rollup_{secs} (series INTEGER NOT NULL, bucket INTEGER NOT NULL, "
+                    "count INTEGER, sum REAL, min REAL, max REAL, last REAL, PRIMARY KEY (series, bucket)) WITHOUT ROWID")
+        conn.commit()
+        self._series_ids = {tuple(row[1:]): row[0] for row in conn.execute("SELECT id, device_id, code, idx, key FROM series")}
+
+        samples = []
+        next_flush = time.monotonic() + self.flush_interval
+        stopping = False
+        while not stopping:
+            try:
+                item = self._queue.get(timeout=max(next_flush - time.monotonic(), 0))
+            except queue.Empty:
+                item = ()
+
+            if item is None or self._stop_now.is_set():
+                stopping = True
+            elif item and item[0] == "query":
+                self._flush(conn, samples) # So that the query includes everything received so far
+                samples = []
+                self._run_query(conn, *item[1:])
+            elif item:
+                samples.append(item)
+
+            if stopping or time.monotonic() >= next_flush:
+                self._flush(conn, samples)
+                samples = []
+                next_flush = time.monotonic() + self.flush_interval
+        conn.close()
+
+    def _flush(self, conn, samples):
+        if not samples:
+            return
+        start = time.perf_counter()
+        try:
+            with conn:
+                rows = []
+                rollups = {secs: {} for secs in self.TIERS.values() if secs}
+                for series, ts, value in samples:
+                    series_id = self._series_ids.get(series)
+                    if series_id is None:
+                        series_id = conn.execute("INSERT INTO series (device_id, code, idx, key) VALUES (?, ?, ?, ?)", series).lastrowid
+                        self._series_ids[series] = series_id
+                    rows.append((series_id, ts, value))
+                    for secs, buckets in rollups.items():
+                        key = (series_id, int(ts // secs) * secs)
+                        count, total, low, high, _ = buckets.get(key, (0, 0, value, value, value))
+                        buckets[key] = (count + 1, total + value, min(low, value), max(high, value), value)
+
+                conn.executemany("INSERT INTO samples (series, ts, value) VALUES (?, ?, ?)", rows)
+                for secs, buckets in rollups.items():
+                    conn.executemany(f"INSERT INTO rollup_{secs} (series, bucket, count, sum, min, max, last) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (series, bucket) DO UPDATE SET count = count + excluded.count, sum = sum + excluded.sum, "
+                        "min = min(min, excluded.min), max = max(max, excluded.max), last = excluded.last",
+                        [(*key, *agg) for key, agg in buckets.items()])
+
+                if time.monotonic() - self._last_pruned > 3600:
+                    self._prune(conn)
+            self.written += len(samples)
+            self.batches += 1
+        except Exception as e:
+            self.errors += 1
+            log.error(f"Exception occured writing history to '{self.db_file}': {e}", exc_info=True)
+        finally:
+            self.write_time += time.perf_counter() - start
+
+    def _prune(self, conn):
+        now = time.time()
+        for tier, secs in self.TIERS.items():
+            if not self.retention_days[tier]:
+                continue # Kept for ever
+            cutoff = now - self.retention_days[tier] * 86400
+            if secs:
+                conn.execute(f"DELETE FROM rollup_{secs} WHERE bucket < ?", (cutoff,))
+            else:
+                conn.execute("DELETE FROM samples WHERE ts < ?", (cutoff,))
+        self._last_pruned = time.monotonic()
+
+    @staticmethod
+    def _to_timestamp(value, default):
+        """ Epoch seconds from an ISO datetime string, epoch seconds, or (if negative) seconds before now """
+        if value is None:
+            return default
+        if isinstance(value, (int, float)):
+            return time.time() + value if value < 0 else value
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+    def _run_query(self, conn, request, callback):
+        self.queries += 1
+        try:
+            result = self._query(conn, request)
+        except Exception as e:
+            log.error(f"History query failed: {request}: {e}")
+            result = {"error": str(e)}
+        if "query_id" in request:
+            result["query_id"] = request["query_id"]
+        callback(result)
+
+    def _query(self, conn, request) -> dict:
+        """ request: any of 'device_id', 'code', 'idx' and 'key' (SQL LIKE patterns) to select the series, 'start' and
+            'end' (default the last 24 hours) and 'resolution' (one of TIERS, or by default the finest resolution
+            that is still kept for 'start' and gives no more than MAX_POINTS points per series)
+        """
+        end = self._to_timestamp(request.get("end"), time.time())
+        start = self._to_timestamp(request.get("start"), end - 86400)
+        resolution = request.get("resolution", "auto")
+        if resolution == "auto":
+            resolution = next((tier for tier, secs in self.TIERS.items()
+                if (not self.retention_days[tier] or start >= time.time() - self.retention_days[tier] * 86400)
+                and (end - start) / max(secs, 60) <= self.MAX_POINTS), "1h")
+        if resolution not in self.TIERS:
+            raise ValueError(f"resolution must be one of {list(self.TIERS)} or 'auto'")
+
+        filters = [(field, request[field]) for field in ("device_id", "code", "idx", "key") if field in request]
+        where = " AND ".join(f"{field} LIKE ?" for field, _ in filters) or "1"
+        series = conn.execute(f"SELECT id, device_id, code, idx, key FROM series WHERE {where} ORDER BY device_id, code, idx, key",
+            [value for _, value in filters]).fetchall()
+
+        secs = self.TIERS[resolution]
+        result = []
+        for series_id, device_id, code, idx, key in series:
+            if secs:
+                rows = conn.execute(f"SELECT bucket, sum / count, min, max FROM rollup_{secs} WHERE series = ? AND bucket >= ? AND bucket <= ? ORDER BY bucket",
+                    (series_id, int(start // secs) * secs, end)).fetchall()
+            else:
+                rows = conn.execute("SELECT ts, value FROM samples WHERE series = ? AND ts >= ? AND ts <= ? ORDER BY ts",
+                    (series_id, start, end)).fetchall()
+            if rows:
+                points = [[datetime.datetime.fromtimestamp(row[0]).isoformat(timespec="seconds"), *(round(v, 3) for v in row[1:])] for row in rows]
+                result.append({"device_id": device_id, "code": code, "idx": idx, "key": key, "points": points})
+
+        return {"start": datetime.datetime.fromtimestamp(start).isoformat(timespec="seconds"),
+            "end": datetime.datetime.fromtimestamp(end).isoformat(timespec="seconds"), "resolution": resolution,
+            "fields": ["ts", "value"] if not secs else ["ts", "avg", "min", "max"], "series": result}
+
+    def get_stats(self) -> dict:
+        return {"recorded": self.recorded, "queue_depth": self._queue.qsize(), "written": self.written, "dropped": self.dropped,
+            "batches": self.batches, "queries": self.queries, "errors": self.errors, "write_s": round(self.write_time, 3)}
+
+
+def queue_log_handlers(logger):
+    """ Move the logger's file/console handlers behind the background LOG_WRITER """
+    handlers = [h for h in logger.handlers if not isinstance(h, LogQueueHandler)]
+    if not handlers:
+        return
+
+    for i, handler in enumerate(handlers):
+        logger.removeHandler(handler)
+        if type(handler) is RotatingFileHandler:
+            # e.g. ramses_rf packet log. Replace with one that can be flushed per batch
+            batched = BatchedRotatingFileHandler(handler.baseFilename, maxBytes=handler.maxBytes, backupCount=handler.backupCount)
+        elif isinstance(handler, TimedRotatingFileHandler):
+            # ramses_rf packet log, rotated at midnight (no LOG_FILE_ROTATE_BYTES)
+            batched = BatchedTimedRotatingFileHandler(handler.baseFilename, when=handler.when, backupCount=handler.backupCount)
+        else:
+            continue
+        batched.setLevel(handler.level)
+        batched.setFormatter(handler.formatter)
+        for f in handler.filters:
+            batched.addFilter(f)
+        handler.close()
+        handlers[i] = batched
+        if PACKET_ARCHIVER and logger.name == PACKET_LOGGER_NAME:
+            # Archived here, before the log writer thread can roll the same files over
+            PACKET_ARCHIVER.archive_rotated(batched.baseFilename)
+            batched.archiver = PACKET_ARCHIVER
+
+    logger.addHandler(LogQueueHandler(LOG_WRITER, handlers))
+
+
+LOG_WRITER = BackgroundLogWriter(LOG_QUEUE_SIZE)
+atexit.register(LOG_WRITER.stop)
+
+PACKET_ARCHIVER = PacketLogArchiver(PACKET_ARCHIVE_DIR, PACKET_ARCHIVE_BLOCK_LINES, PACKET_ARCHIVE_MAX_MB) if PACKET_ARCHIVE_DIR else None
+
+STATE_WRITER = StateWriter(STATE_STORE_FILE, MAX_SAVE_FILE_COUNT, SAVE_DEBOUNCE_SECS)
+atexit.register(STATE_WRITER.stop)
+
 log = logging.getLogger(f"evogateway_log")
-log.setLevel(logging.DEBUG)
 formatter = logging.Formatter('%(asctime)s [%(lineno)s] %(message)s')
 # %(funcName)20s() [%(levelname)s]
 
 # Log file handler
-file_handler = RotatingFileHandler(EVENTS_FILE, maxBytes=LOG_FILE_ROTATE_BYTES, backupCount=LOG_FILE_ROTATE_COUNT)
+file_handler = BatchedRotatingFileHandler(EVENTS_FILE, maxBytes=LOG_FILE_ROTATE_BYTES, backupCount=LOG_FILE_ROTATE_COUNT)
 file_handler.setLevel(logging.INFO)
 file_handler.setFormatter(formatter)
 log.addHandler(file_handler)
@@ -192,9 +1035,15 @@ console_handler.setLevel(logging.WARNING)
 console_handler.setFormatter(formatter)
 log.addHandler(console_handler)
 
+# Records below the handlers' levels (e.g. debug) are discarded before being created/queued
+log.setLevel(min(file_handler.level, console_handler.level))
+queue_log_handlers(log)
+STARTUP.mark("logging")
+
 
 _first_cap_re = re.compile('(.)([A-Z][a-z]+)')
 _all_cap_re = re.compile('([a-z0-9])([A-Z])')
+@functools.lru_cache(maxsize=2048)
 def to_snake(name):
     if name:
         name=name.strip().replace("'","").replace(" ","_")
@@ -217,31 +1066,293 @@ def _proc_kwargs(obj, kwargs) -> Tuple[dict, dict]:
     return lib_kwargs, cli_kwargs
 
 
-def get_parent_keys(d, value):
-    for k,v in d.items():
-        if isinstance(v, dict):
-            p = get_parent_keys(v, value)
-            if p:
-                return [k] + p
-        elif v == value:
-            return [k]
+def get_device_display_name(device_id, dev_type, alias=None):
+    """ Device name as shown on the console, e.g. 'TRV Kitchen TRV:123456' """
+    if device_id == HGI_DEVICE_ID or (FORCE_SINGLE_HGI and dev_type in "18"):
+        name = THIS_GATEWAY_NAME
+    elif dev_type in "01":
+        name = "Controller"
+    elif dev_type in "63":
+        name = "UNBOUND"
+    else:
+        name = alias if alias else device_id
+    if name == NON_DEVICE_ID:
+        name = ""
+    type_name = _OUT_DEVICE_TABLE[dev_type]["type"].replace("---", "").replace("NUL", "") if dev_type in _OUT_DEVICE_TABLE else ""
+    return f"{type_name} {name}".strip()
+
+
+def get_schema_device_zones(zones_schema) -> dict:
+    """ Zone id of each device in the zones section of a ramses_rf schema """
+    device_zones = {}
+    for zone_id, zone_items in zones_schema.items():
+        if isinstance(zone_items, dict):
+            for value in zone_items.values():
+                for device_id in (value if isinstance(value, list) else [value]):
+                    if isinstance(device_id, str) and device_id not in device_zones:
+                        device_zones[device_id] = zone_id
+    return device_zones
+
+
+class DeviceEntry():
+    __slots__ = ("id", "type", "alias", "zone_id", "ctl_id", "display_name", "topic_name")
+
+    def __init__(self, device_id, alias, zone_id=None, ctl_id=None):
+        self.id = device_id
+        self.type = device_id.split(":")[0]
+        self.alias = alias
+        self.zone_id = zone_id
+        self.ctl_id = ctl_id
+        self.display_name = get_device_display_name(device_id, self.type, alias)
+        self.topic_name = to_snake(self.display_name)
+
+    def as_dict(self) -> dict:
+        return {SZ_ALIAS: self.alias, "zone_id": self.zone_id} if self.zone_id is not None else {SZ_ALIAS: self.alias}
+
+
+class ZoneEntry():
+    __slots__ = ("idx", "name", "ctl_id", "topic_name")
+
+    def __init__(self, idx, name, ctl_id=None):
+        self.idx = idx
+        self.name = name
+        self.ctl_id = ctl_id
+        self.topic_name = to_snake(name)
+
+
+class UfhCircuitEntry():
+    __slots__ = ("idx", "ufc_id", "zone_idx", "params")
+
+    def __init__(self, idx, params, ufc_id=None):
+        self.idx = idx
+        self.ufc_id = ufc_id
+        self.zone_idx = params.get("zone_idx") if isinstance(params, dict) else None
+        self.params = params
+
+
+class Registry():
+    """ Devices, zones and UFH circuits known to the gateway, with devices also indexed by zone, device type and
+        controller. Entries are only replaced if changed, and version is incremented on every change (e.g. so that
+        anything derived from the registry can be invalidated). Serialises to the devices.json/zones.json formats
+    """
+
+    def __init__(self):
+        self.devices = {}
+        self.zones = {}
+        self.ufh_circuits = {}
+        self.devices_by_zone = {}
+        self.devices_by_type = {}
+        self.devices_by_controller = {}
+        self.version = 0
+
+    def _index(self, entry, add=True):
+        for index, key in ((self.devices_by_zone, entry.zone_id), (self.devices_by_type, entry.type),
+            (self.devices_by_controller, entry.ctl_id)):
+            if key is None:
+                continue
+            if add:
+                index.setdefault(key, set()).add(entry.id)
+            elif key in index:
+                index[key].discard(entry.id)
+                if not index[key]:
+                    del index[key]
+
+    def set_device(self, device_id, alias, zone_id=None, ctl_id=None) -> bool:
+        if not device_id: # e.g. not yet known in the schema
+            return False
+        entry = self.devices.get(device_id)
+        if entry:
+            if entry.alias == alias and entry.zone_id == zone_id and entry.ctl_id == ctl_id:
+                return False
+            self._index(entry, add=False)
+        entry = self.devices[device_id] = DeviceEntry(device_id, alias, zone_id, ctl_id)
+        self._index(entry)
+        self.version += 1
+        return True
+
+    def set_zone(self, idx, name, ctl_id=None) -> bool:
+        entry = self.zones.get(idx)
+        if entry and entry.name == name and entry.ctl_id == ctl_id:
+            return False
+        self.zones[idx] = ZoneEntry(idx, name, ctl_id)
+        self.version += 1
+        return True
+
+    def set_ufh_circuit(self, idx, params, ufc_id=None) -> bool:
+        entry = self.ufh_circuits.get(idx)
+        if entry and entry.params == params and entry.ufc_id == ufc_id:
+            return False
+        self.ufh_circuits[idx] = UfhCircuitEntry(idx, params, ufc_id)
+        self.version += 1
+        return True
+
+    def get_device_alias(self, device_id):
+        entry = self.devices.get(device_id)
+        return entry.alias if entry else None
+
+    def get_device_zone_id(self, device_id):
+        entry = self.devices.get(device_id)
+        return entry.zone_id if entry else None
+
+    def get_zone_name(self, idx):
+        entry = self.zones.get(idx)
+        return entry.name if entry else None
+
+    def load_devices(self, devices):
+        """ Replace all devices with those from a devices.json dict """
+        self.devices.clear()
+        self.devices_by_zone.clear()
+        self.devices_by_type.clear()
+        self.devices_by_controller.clear()
+        for device_id, device in devices.items():
+            self.set_device(device_id, device.get(SZ_ALIAS), device.get("zone_id"))
+        self.version += 1
+
+    def load_zones(self, zones):
+        """ Replace all zones with those from a zones.json dict """
+        self.zones = {idx: ZoneEntry(idx, name) for idx, name in zones.items()}
+        self.version += 1
+
+    def devices_as_dict(self, with_zones=True) -> dict:
+        if with_zones:
+            return {k: v.as_dict() for k, v in self.devices.items()}
+        return {k: {SZ_ALIAS: v.alias} for k, v in self.devices.items()}
+
+    def zones_as_dict(self) -> dict:
+        return {k: v.name for k, v in self.zones.items()}
+
+    def ufh_circuits_as_dict(self) -> dict:
+        return {k: v.params for k, v in self.ufh_circuits.items()}
+
+
+REGISTRY = Registry()
+
+
+class LookupMissCache():
+    """ Remembers REGISTRY device/zone lookups that were still not found after refreshing from the gateway schema (e.g. for
+        neighbours' devices), so that the schema is not walked again for the same lookup until ttl seconds have passed
+    """
+
+    def __init__(self, ttl, max_entries=4096):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.negative_hits = 0
+        self.refreshes = 0
+        self.resolved = 0
+        self._expiry = {}
+
+    def lookup(self, key, is_found, refresh) -> bool:
+        """ Call refresh() and return is_found(), unless the same lookup failed less than ttl seconds ago """
+        now = time.monotonic()
+        expiry = self._expiry.get(key)
+        if expiry is not None:
+            if now < expiry:
+                self.negative_hits += 1
+                return False
+            del self._expiry[key]
+
+        self.refreshes += 1
+        refresh_start = time.perf_counter()
+        refresh()
+        STAGE_TIMER.add("schema_refresh", time.perf_counter() - refresh_start)
+        if is_found():
+            self.resolved += 1
+            return True
+
+        if len(self._expiry) >= self.max_entries:
+            self.purge(now)
+        self._expiry[key] = now + self.ttl
+        return False
+
+    def purge(self, now=None):
+        now = now if now is not None else time.monotonic()
+        self._expiry = {k: v for k, v in self._expiry.items() if v > now}
+        if len(self._expiry) >= self.max_entries:
+            # Still full of unexpired entries, so drop the oldest half
+            for k in sorted(self._expiry, key=self._expiry.get)[:self.max_entries // 2]:
+                del self._expiry[k]
+
+    def clear(self):
+        self._expiry.clear()
+
+    def get_stats(self) -> dict:
+        self.purge()
+        return {"negative_hits": self.negative_hits, "refreshes": self.refreshes, "resolved": self.resolved,
+            "unresolved": self.refreshes - self.resolved, "negative_entries": len(self._expiry),
+            "negative_devices": sorted({k[1] for k in self._expiry if k[0] == "device"})}
+
+
+LOOKUP_MISSES = LookupMissCache(LOOKUP_MISS_TTL)
+
+
+class StageTimer():
+    """ Rolling samples of the time (in seconds) spent in each stage of processing a received msg. Stage times are
+        accumulated with add() between begin_msg() and end_msg(), and recorded as one sample per stage by end_msg().
+        Times added outside of a msg (e.g. a schema refresh from a command) are recorded as samples of their own.
+        Quantiles are over the last max_samples msgs, while the sums/counts are since startup
+    """
+
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self.msg_count = 0
+        self.sums = {}
+        self.counts = {}
+        self._samples = {}
+        self._current = None
+
+    def begin_msg(self):
+        self._current = {}
+
+    def add(self, stage, seconds):
+        if self._current is None:
+            self._record(stage, seconds)
+        else:
+            self._current[stage] = self._current.get(stage, 0) + seconds
+
+    def end_msg(self):
+        self.msg_count += 1
+        for stage, seconds in (self._current or {}).items():
+            self._record(stage, seconds)
+        self._current = None
+
+    def _record(self, stage, seconds):
+        samples = self._samples.get(stage)
+        if samples is None:
+            samples = self._samples[stage] = collections.deque(maxlen=self.max_samples)
+            self.sums[stage] = 0
+            self.counts[stage] = 0
+        samples.append(seconds)
+        self.sums[stage] += seconds
+        self.counts[stage] += 1
+
+    def clear(self):
+        self.msg_count = 0
+        self.sums.clear()
+        self.counts.clear()
+        self._samples.clear()
+        self._current = None
+
+    def get_quantiles(self, stage, quantiles=STAGE_QUANTILES) -> list:
+        samples = sorted(self._samples[stage])
+        return [samples[min(len(samples) - 1, int(len(samples) * q))] for q in quantiles]
+
+    def get_stats(self) -> dict:
+        stats = {}
+        for stage, samples in self._samples.items():
+            p50, p90, p99 = self.get_quantiles(stage, (0.5, 0.9, 0.99))
+            stats[stage] = {"count": self.counts[stage], "mean_ms": round(self.sums[stage] / self.counts[stage] * 1000, 3),
+                "p50_ms": round(p50 * 1000, 3), "p90_ms": round(p90 * 1000, 3), "p99_ms": round(p99 * 1000, 3),
+                "max_ms": round(max(samples) * 1000, 3)}
+        return stats
+
+
+STAGE_TIMER = StageTimer()
 
 
 def get_device_name(device_address):
     try:
-        if device_address.id == HGI_DEVICE_ID or (FORCE_SINGLE_HGI and device_address.type in "18"):
-            name = THIS_GATEWAY_NAME
-        elif device_address.type in "01":
-            name = "Controller"
-        elif device_address.type in "63":
-            name = "UNBOUND"
-        else:
-            name = DEVICES[device_address.id][SZ_ALIAS] if device_address.id in DEVICES else device_address.id
-        if name == NON_DEVICE_ID:
-            name = ""
-        dev_type = _OUT_DEVICE_TABLE[device_address.type]["type"].replace("---", "").replace("NUL", "")
-        name = "{} {}".format(dev_type, name).strip()
-        return name
+        entry = REGISTRY.devices.get(device_address.id)
+        return entry.display_name if entry else get_device_display_name(device_address.id, device_address.type)
 
     except Exception as ex:
         log.error(f"{Style.BRIGHT}{DISPLAY_COLOURS.get('ERROR')}Exception occured for device_address '{device_address}': {ex}{Style.RESET_ALL}", exc_info=True)
@@ -249,7 +1360,7 @@ def get_device_name(device_address):
 
 
 def get_msg_zone_name(src, target_zone_id=None):
-    """ Use any 'target' zone name given in the payload, otherwise fall back to zone name of the sending device"""
+    """ Use any 'target' zone (topic) name given in the payload, otherwise fall back to zone of the sending device"""
 
     # If target of the message is a zone, use that unless the device type is a BDR or OTB etc.
     if src.type not in "13 10" and target_zone_id and int(target_zone_id, 16) >= 0:
@@ -257,14 +1368,15 @@ def get_msg_zone_name(src, target_zone_id=None):
         # zone = GWY.evo.zone_by_idx[target_zone_id] if GWY.evo else None
         # zone_name = zone.name if zone else "_zone_{}".format(target_zone_id)
 
-        if target_zone_id not in ZONES:
-            update_zones_from_gwy()
-        zone_name = ZONES[target_zone_id] if target_zone_id in ZONES else "_zone_{}".format(target_zone_id)
+        if target_zone_id not in REGISTRY.zones:
+            LOOKUP_MISSES.lookup(("zone", target_zone_id), lambda: target_zone_id in REGISTRY.zones, lambda: sync_zone(target_zone_id))
+        zone = REGISTRY.zones.get(target_zone_id)
+        zone_name = zone.topic_name if zone else "_zone_{}".format(target_zone_id)
     else:
-        if src.id not in DEVICES or "zone_id" not in DEVICES[src.id]:
-            update_devices_from_gwy()
+        if REGISTRY.get_device_zone_id(src.id) is None:
+            LOOKUP_MISSES.lookup(("device_zone", src.id), lambda: REGISTRY.get_device_zone_id(src.id) is not None, lambda: sync_device(src.id))
 
-        src_zone_id = DEVICES[src.id]["zone_id"] if src.id in DEVICES and "zone_id" in DEVICES[src.id] else None
+        src_zone_id = REGISTRY.get_device_zone_id(src.id)
         if src_zone_id and not isinstance(src_zone_id, str):
             print(f"{Style.BRIGHT}{Fore.RED}[DEBUG] -----------> src_zone_id ({src_zone_id}) is not string: type = {type(src_zone_id)}. src.id: {src.id}, target_zone_id: {target_zone_id}. {Style.RESET_ALL}")
             traceback.print_stack()
@@ -275,11 +1387,11 @@ def get_msg_zone_name(src, target_zone_id=None):
         elif (src_zone_id and int(src_zone_id, 16) > 11) or src.type in "02 10 13":
             # Relay types, e.g. BDR, OTB, UFC
             zone_name = f"{MQTT_ZONE_IND_TOPIC}/relays"
-        elif src_zone_id and int(src_zone_id, 16) >= 0 and src_zone_id in ZONES:
+        elif src_zone_id and int(src_zone_id, 16) >= 0 and src_zone_id in REGISTRY.zones:
             # Normal 'zones'
-            zone_name = ZONES[src_zone_id]
+            zone_name = REGISTRY.zones[src_zone_id].topic_name
         else:
-            log.error(f"----> Unknown zone for src: '{src} {DEVICES[src.id] if src.id in DEVICES else ''}'")
+            log.error(f"----> Unknown zone for src: '{src} {REGISTRY.devices[src.id].as_dict() if src.id in REGISTRY.devices else ''}'")
             zone_name = MQTT_ZONE_UNKNOWN
 
     return zone_name
@@ -318,24 +1430,93 @@ def spawn_schedule_task(action, **kwargs):
             log.error("'zone_idx' must be defined in 'schedule' json")
             return
         zone_idx = schedule["zone_idx"]
-        kwargs = {"ctl_id": ctl_id, "schedule": schedule}
-        tasks = [GWY._loop.create_task(set_schedule_async(GWY, **kwargs))]
+        queue_schedule_writes([schedule])
+        return
 
     GWY._tasks.extend(tasks)
     print_formatted_row(SYSTEM_MSG_TAG, text=f"{tasks}")
     log.info(f"'{action}' for zone {zone_idx} task spawned : {tasks}")
 
 
+def queue_schedule_writes(schedules):
+    """ Queue the schedules (each a dict with 'zone_idx' and 'schedule') for the schedule_writer() task. Must be called
+        on the gateway's event loop, as are the MQTT callbacks (see AsyncioMqttHelper)
+    """
+    global SCHEDULE_WRITES
+    if SCHEDULE_WRITES is None:
+        SCHEDULE_WRITES = asyncio.Queue()
+        GWY._tasks.append(asyncio.get_running_loop().create_task(schedule_writer()))
+    for schedule in schedules:
+        mqtt_publish_schedule_status(schedule["zone_idx"], "queued")
+        SCHEDULE_WRITES.put_nowait(schedule)
+
+
+async def schedule_writer():
+    """ Write the queued schedules one after the other, so that a batch doesn't contend for the controller """
+    while True:
+        schedule = await SCHEDULE_WRITES.get()
+        try:
+            await set_schedule_async(GWY, GWY.evo.id, schedule)
+        except Exception as e:
+            # Keep going, as otherwise the schedules queued after this one would never be written
+            log.error(f"schedule_writer(): Error: {e}", exc_info=True)
+        finally:
+            SCHEDULE_WRITES.task_done()
+
+
+def normalise_schedule(schedule) -> dict:
+    """ Return the schedule's switchpoints by day_of_week, for comparing schedules """
+    days = {}
+    for day in schedule or []:
+        days[int(day["day_of_week"])] = [(sp["time_of_day"], float(sp["heat_setpoint"]) if "heat_setpoint" in sp
+            else sp.get("enabled")) for sp in day["switchpoints"]]
+    return days
+
+
+def get_changed_days(current, requested) -> list:
+    """ Return the days of the week whose switchpoints differ between the two schedules """
+    current, requested = normalise_schedule(current), normalise_schedule(requested)
+    return sorted(day for day in set(current) | set(requested) if current.get(day) != requested.get(day))
+
+
+def mqtt_publish_schedule_status(zone_idx, status, changed_days=None):
+    topic = f"{MQTT_SUB_TOPIC}/_set_schedule/{zone_idx}"
+    update = {"zone_idx": zone_idx, "status": status, "status_ts": datetime.datetime.now().strftime("%Y-%m-%dT%X")}
+    if changed_days is not None:
+        update["changed_days"] = changed_days
+    MQTT_PUBLISHER.publish(topic, json.dumps(update), "command", retain=False)
+    MQTT_PUBLISHER.flush()
+
+
 async def set_schedule_async(gwy, ctl_id: str, schedule: str) -> None:
+    """ Write the schedule, unless it matches the zone's current schedule. The schedule in SCHEDULES_FILE is only taken
+        to be current if it was received at the controller's current schedule change counter (0006), otherwise the
+        schedule is always sent, and changed_days is not known.
+        NB: the controller only accepts a zone's schedule as a whole, so if any day has changed, all are sent
+    """
     zone_idx = schedule["zone_idx"]
-    zone = gwy._get_device(ctl_id, ctl_id=ctl_id)._evo._get_zone(zone_idx)
+    changed_days = None
     try:
+        zone = gwy._get_device(ctl_id, ctl_id=ctl_id)._evo._get_zone(zone_idx)
+        cached = get_schedule_cache().get(zone_idx)
+        if cached and cached.get("change_counter") is not None and cached["change_counter"] == await get_schedule_change_counter():
+            changed_days = get_changed_days(cached["schedule"], schedule["schedule"])
+        if changed_days == []:
+            print_formatted_row(SYSTEM_MSG_TAG, text=f"Schedule for zone {zone_idx} ({zone.name}) unchanged - not sent")
+            mqtt_publish_schedule_status(zone_idx, "unchanged", changed_days)
+            return
+
+        mqtt_publish_schedule_status(zone_idx, "sending", changed_days)
         await zone.set_schedule(schedule["schedule"])
+        # The controller's change counter will have moved on, so it is not kept (get_all_schedules will re-fetch)
+        cache_schedule(zone_idx, schedule["schedule"], with_change_counter=False)
         print_formatted_row(
                             SYSTEM_MSG_TAG,
-                            text="Schedule updated for zone {zone_idx} ({zone.name})")
+                            text=f"Schedule updated for zone {zone_idx} ({zone.name}), changed days: {changed_days}")
+        mqtt_publish_schedule_status(zone_idx, "updated", changed_days)
     except Exception as e:
         log.error(f"set_schedule_async(): Error: {e}", exc_info=True)
+        mqtt_publish_schedule_status(zone_idx, "failed", changed_days)
         # traceback.print_stack()
 
 
@@ -360,23 +1541,125 @@ def process_schedule_message(msg):
 
             # zone = GWY.system_by_id[GWY.evo.id].zone_by_idx[zone_idx]
             schedule = zone.schedule
-
-            dtm = f"{msg.dtm:%H:%M:%S.%f}"[:-3]
-            if DISPLAY_FULL_JSON:
-                print(f"{DISPLAY_COLOURS.get(msg.verb)}{dtm} "
-                    "Schedule for '{zone.name}' [{zone_idx}]: {schedule}"[:CONSOLE_COLS])
-            else:
-                print_formatted_row(SYSTEM_MSG_TAG,
-                    text=f"Schedule for '{zone.name}' ({zone_idx}): {schedule}")
-
-            msg.payload["topic_idx"] = "schedule"
-            mqtt_publish_received_msg(msg, {"schedule": schedule, "zone_idx": zone_idx})
+            display_and_publish_schedule(msg, zone, zone_idx, schedule)
+            if schedule is not None:
+                cache_schedule(zone_idx, schedule)
 
     except Exception as e:
         log.error(f"Exception occured: {e}", exc_info=True)
         log.error(f"msg: {msg}")
 
 
+def display_and_publish_schedule(msg, zone, zone_idx, schedule, source=""):
+    dtm = f"{msg.dtm:%H:%M:%S.%f}"[:-3]
+    if DISPLAY_FULL_JSON:
+        print(f"{DISPLAY_COLOURS.get(msg.verb)}{dtm} "
+            "Schedule for '{zone.name}' [{zone_idx}]: {schedule}"[:CONSOLE_COLS])
+    else:
+        print_formatted_row(SYSTEM_MSG_TAG,
+            text=f"Schedule for '{zone.name}' ({zone_idx}){source}: {schedule}")
+
+    msg.payload["topic_idx"] = "schedule"
+    mqtt_publish_received_msg(msg, {"schedule": schedule, "zone_idx": zone_idx})
+
+
+class CachedScheduleMsg():
+    """ Stand-in for the last 0404 fragment of a zone's schedule, so that a schedule from SCHEDULES_FILE is published
+        to the same topics as one received from the controller
+    """
+
+    def __init__(self, ctl, zone_idx):
+        self.src = ctl
+        self.dst = ctl
+        self.verb = "RP"
+        self.code = "0404"
+        self.code_name = CODE_NAMES[self.code]
+        self.dtm = datetime.datetime.now()
+        self.payload = {"zone_idx": zone_idx}
+
+
+def get_schedule_cache() -> dict:
+    global SCHEDULE_CACHE
+    if SCHEDULE_CACHE is None:
+        SCHEDULE_CACHE = load_json_from_file(SCHEDULES_FILE) if SCHEDULES_FILE else {}
+    return SCHEDULE_CACHE
+
+
+def cache_schedule(zone_idx, schedule, with_change_counter=True):
+    """ Keep the zone's schedule, with the controller's current schedule change counter (0006) """
+    change_counter = get_last_schedule_change_counter() if with_change_counter else None
+    get_schedule_cache()[zone_idx] = {"change_counter": change_counter, "schedule": schedule,
+        "received": datetime.datetime.now().isoformat(timespec="seconds")}
+    if SCHEDULES_FILE:
+        save_json_to_file(SCHEDULE_CACHE, SCHEDULES_FILE, True)
+
+
+def get_last_schedule_change_counter():
+    msg = GWY.evo._msgs.get("0006") if GWY and GWY.evo else None
+    return msg.payload.get("change_counter") if msg else None
+
+
+async def get_schedule_change_counter():
+    """ Ask the controller for its current schedule change counter (0006), falling back to the last one received """
+    evo = GWY.evo
+    if not GWY.config.disable_sending:
+        start = datetime.datetime.now()
+        COMMAND_QUEUE.submit(Command("RQ", "0006", "00", evo.id), {"code": "0006", "verb": "RQ", "payload": "00"})
+        while (datetime.datetime.now() - start).total_seconds() < COMMAND_TIMEOUT:
+            msg = evo._msgs.get("0006")
+            if msg and msg.dtm >= start:
+                break
+            await asyncio.sleep(0.1)
+    return get_last_schedule_change_counter()
+
+
+def mqtt_publish_schedule_progress(zone_idx, status, progress):
+    topic = f"{MQTT_SUB_TOPIC}/_get_all_schedules"
+    MQTT_PUBLISHER.publish(f"{topic}/{zone_idx}", json.dumps({"zone_idx": zone_idx, "status": status,
+        "status_ts": datetime.datetime.now().strftime("%Y-%m-%dT%X")}), "command", retain=False)
+    MQTT_PUBLISHER.publish(f"{topic}/progress", json.dumps(progress), "command", retain=False)
+    MQTT_PUBLISHER.flush()
+
+
+async def get_all_schedules_async(force_refresh=False):
+    """ Get the schedules of all zones (and DHW), with up to SCHEDULE_CONCURRENCY zones being fetched at a time.
+        Zones whose schedule in SCHEDULES_FILE was received at the controller's current schedule change counter are
+        published from there instead of being fetched again.
+        NB: the change counter is for the whole system, so if it has changed, all the zones are fetched again
+    """
+    evo = GWY.evo
+    change_counter = await get_schedule_change_counter()
+    cache = get_schedule_cache()
+    zones = {zone.idx: zone for zone in evo.zones}
+    if evo.dhw:
+        zones["HW"] = evo.dhw
+
+    progress = {"total": len(zones), "cached": 0, "fetched": 0, "failed": 0, "change_counter": change_counter}
+    semaphore = asyncio.Semaphore(max(SCHEDULE_CONCURRENCY, 1))
+
+    async def get_zone_schedule(zone_idx, zone):
+        cached = cache.get(zone_idx)
+        if not force_refresh and cached and change_counter is not None and cached.get("change_counter") == change_counter:
+            display_and_publish_schedule(CachedScheduleMsg(evo._ctl, zone_idx), zone, zone_idx, cached["schedule"], " (cached)")
+            progress["cached"] += 1
+            mqtt_publish_schedule_progress(zone_idx, "cached", progress)
+            return
+
+        async with semaphore:
+            mqtt_publish_schedule_progress(zone_idx, "fetching", progress)
+            try:
+                schedule = await zone.get_schedule(force_refresh=True)
+            except Exception as e:
+                log.error(f"get_all_schedules_async(): zone {zone_idx}: {e}")
+                schedule = None
+        status = "failed" if schedule is None else "fetched"
+        progress[status] += 1
+        mqtt_publish_schedule_progress(zone_idx, status, progress)
+
+    await asyncio.gather(*[get_zone_schedule(zone_idx, zone) for zone_idx, zone in zones.items()])
+    print_formatted_row(SYSTEM_MSG_TAG, text=f"get_all_schedules: {progress}")
+
+
 def cleanup_display_text(msg, display_text):
     """ Clean up/Simplify the displayed text for given message. display_text must be a dict """
     try:
@@ -420,18 +1703,80 @@ def cleanup_display_text(msg, display_text):
         log.error(f"msg.payload: {msg.payload}, display_text: {display_text}")
 
 
+def get_msg_age(msg) -> float:
+    """ Seconds since the msg's packet was received from the radio (or read from the packet log, when replaying) """
+    if PACKET_RX_TIME is not None:
+        return time.perf_counter() - PACKET_RX_TIME
+    return (datetime.datetime.now() - msg.dtm).total_seconds()
+
+
+class DuplicateFilter():
+    """ Spots repeats of a msg (same src, dst, verb, code and payload) within window seconds (of the packet timestamps),
+        e.g. devices repeating their I packets, or retried RQ/RPs. Recent msgs are kept in a fixed number of hashed
+        slots, so memory is bounded - a hash collision just overwrites the older msg, which may then be missed as a
+        duplicate. The duplicates per src device are also a measure of its radio link
+    """
+
+    def __init__(self, slots, window):
+        self.window = window
+        self.checked = 0
+        self.duplicates = 0
+        self.by_device = collections.Counter()
+        self._slots = [None] * max(slots, 1)
+
+    def is_duplicate(self, msg) -> bool:
+        if self.window <= 0:
+            return False
+        self.checked += 1
+        dtm = msg.dtm # i.e. when received by the radio (or as logged, when replaying)
+        key = (msg.src.id, msg.dst.id, msg.verb, msg.code, msg._pkt._payload)
+        i = hash(key) % len(self._slots)
+        slot = self._slots[i]
+        if slot and slot[0] == key and (dtm - slot[1]).total_seconds() <= self.window:
+            self.duplicates += 1
+            self.by_device[msg.src.id] += 1
+            return True
+        self._slots[i] = (key, dtm)
+        return False
+
+    def get_stats(self) -> dict:
+        return {"checked": self.checked, "duplicates": self.duplicates,
+            "duplicate_pct": round(100 * self.duplicates / self.checked, 1) if self.checked else 0,
+            "by_device": dict(self.by_device.most_common(10))}
+
+
+DUPLICATES = DuplicateFilter(DEDUP_SLOTS, DEDUP_WINDOW)
+
+
 def process_gwy_message(msg, prev_msg=None) -> None:
     """ Process received ramses_rf message from Gateway """
     #if not hasattr(msg, 'rssi'):
     #    setattr(msg,'rssi',int(msg._pkt.rssi))
+    if not STARTUP.done and not RESTORING_STATE:
+        STARTUP.finish()
+    start = time.perf_counter()
+    STAGE_TIMER.begin_msg()
+    STAGE_TIMER.add("age", get_msg_age(msg))
     log.debug("") # spacer, as we have other debug entries for a given received msg
-    log.info(msg)  # Log event to file
+    if not RESTORING_STATE:
+        log.info(msg)  # Log event to file (restored msgs were logged when first received)
+
+    if DUPLICATES.is_duplicate(msg):
+        # Already displayed/published (NB: ramses_rf has still processed it)
+        log.debug("Duplicate msg ignored: %s", msg)
+        STAGE_TIMER.end_msg()
+        return
 
     # Message class in ramses_rf lib does not seem to have the code name, so add it
     msg.code_name = CODE_NAMES[msg.code]
 
+    # Merge any newly discovered zone names/devices before resolving topics for this msg
+    sync_registry_from_msg(msg)
+
     if DISPLAY_FULL_JSON:
+        display_start = time.perf_counter()
         display_full_msg(msg)
+        STAGE_TIMER.add("display", time.perf_counter() - display_start)
 
     # As some payloads are arrays, and others not, make consistent
     payload = [msg.payload] if not isinstance(msg.payload, list) else msg.payload
@@ -444,7 +1789,9 @@ def process_gwy_message(msg, prev_msg=None) -> None:
                 item = {msg.code_name: str(item) }
             if not DISPLAY_FULL_JSON:
                 zone_id = item["zone_idx"] if "zone_idx" in item else None
+                display_start = time.perf_counter()
                 display_simple_msg(msg, item, zone_id, "")
+                STAGE_TIMER.add("display", time.perf_counter() - display_start)
             mqtt_publish_received_msg(msg, item)
 
         except Exception as e:
@@ -455,6 +1802,18 @@ def process_gwy_message(msg, prev_msg=None) -> None:
     if msg.code == "0404" and msg.verb == "RP":
         process_schedule_message(msg)
 
+    if HISTORY and not RESTORING_STATE:
+        HISTORY.record(msg)
+
+    # Hand everything published for this msg to the MQTT client in one go
+    flush_start = time.perf_counter()
+    MQTT_PUBLISHER.flush()
+    end = time.perf_counter()
+    STAGE_TIMER.add("publish", end - flush_start)
+    STAGE_TIMER.add("total", end - start)
+    STAGE_TIMER.add("latency", get_msg_age(msg))
+    STAGE_TIMER.end_msg()
+
 
 def print_ramsesrf_gwy_schema(gwy):
     if gwy.evo is None:
@@ -478,31 +1837,111 @@ def print_ramsesrf_gwy_schema(gwy):
 
     update_devices_from_gwy()
 
-    if DEVICES:
-        devices = {str(k) : {SZ_ALIAS : DEVICES[k][SZ_ALIAS]} for k in DEVICES if k is not None}
+    if REGISTRY.devices:
+        devices = REGISTRY.devices_as_dict(with_zones=False)
     print(f"DEVICES = {json.dumps(devices, indent=4)}")
 
 
+class ConsoleRenderer():
+    """ Renders console rows off the message processing path. Each row is queued as the function (and args) to
+        format it, and the queue is rendered and printed in batches from the event loop once the current msg has
+        been processed. If the queue is full, the oldest rows are dropped. As rendering is off the message processing
+        path, the time taken by each batch is recorded as a 'render' stage sample of its own (the 'display' stage of
+        a msg being just the time to queue its rows).
+    """
+
+    def __init__(self, max_queued, headless):
+        self.max_queued = max_queued
+        self.headless = headless
+        self.rendered = 0
+        self.dropped = 0
+        self.render_time = 0
+        self._queue = collections.deque()
+        self._scheduled = False
+
+    def submit(self, format_row, *args):
+        if len(self._queue) >= self.max_queued:
+            self._queue.popleft()
+            self.dropped += 1
+        self._queue.append((format_row, args))
+
+        if not self._scheduled:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError: # e.g. on startup/exit
+                self.flush()
+                return
+            self._scheduled = True
+            loop.call_soon(self.render)
+
+    def render(self, max_rows=100):
+        self._scheduled = False
+        start = time.perf_counter()
+        rows = []
+        while self._queue and (max_rows is None or len(rows) < max_rows):
+            format_row, args = self._queue.popleft()
+            try:
+                row = format_row(*args)
+            except Exception as e:
+                log.error(f"Exception occured rendering console row: {e}", exc_info=True)
+                continue
+            if row:
+                rows.append(row)
+
+        if rows:
+            print("\n".join(rows))
+            self.rendered += len(rows)
+        elapsed = time.perf_counter() - start
+        self.render_time += elapsed
+        STAGE_TIMER.add("render", elapsed)
+
+        if self._queue and not self._scheduled:
+            # Let other callbacks in before rendering the rest
+            self._scheduled = True
+            asyncio.get_running_loop().call_soon(self.render)
+
+    def flush(self):
+        self.render(max_rows=None)
+
+    def get_stats(self) -> dict:
+        return {"headless": self.headless, "queued": len(self._queue), "rendered": self.rendered,
+            "dropped": self.dropped, "render_s": round(self.render_time, 3)}
+
+
+CONSOLE = ConsoleRenderer(DISPLAY_QUEUE_SIZE, DISPLAY_HEADLESS)
+
+
 def display_full_msg(msg):
     """ Show the full json payload (as in the ramses_rf cli client) """
+    if not CONSOLE.headless:
+        CONSOLE.submit(format_full_msg, msg)
+
+
+def format_full_msg(msg) -> str:
     dtm = f"{msg.dtm:%H:%M:%S.%f}"[:-3]
     if msg.src.type == "18":
-        print(f"{Style.BRIGHT}{DISPLAY_COLOURS.get(msg.verb)}{dtm} {msg}"[:CONSOLE_COLS])
+        return f"{Style.BRIGHT}{DISPLAY_COLOURS.get(msg.verb)}{dtm} {msg}"[:CONSOLE_COLS]
     elif msg.verb:
-        print(f"{DISPLAY_COLOURS.get(msg.verb)}{dtm} {msg}"[:CONSOLE_COLS])
+        return f"{DISPLAY_COLOURS.get(msg.verb)}{dtm} {msg}"[:CONSOLE_COLS]
     else:
-        print(f"{Style.RESET_ALL}{dtm} {msg}"[:CONSOLE_COLS])
+        return f"{Style.RESET_ALL}{dtm} {msg}"[:CONSOLE_COLS]
 
 
 def display_simple_msg(msg, payload_dict, target_zone_id, suffix_text=""):
+    if not CONSOLE.headless:
+        # Copied, as the payload may be changed (e.g. 'until' patched for MQTT) before the row is rendered
+        display_dict = payload_dict.copy() if isinstance(payload_dict, dict) else payload_dict
+        CONSOLE.submit(format_simple_msg, msg, display_dict, target_zone_id, suffix_text)
+
+
+def format_simple_msg(msg, payload_dict, target_zone_id, suffix_text="") -> str:
     src = get_device_name(msg.src)
     dst = get_device_name(msg.dst) if msg.src.id != msg.dst.id else ""
 
-    # Make a copy as we are deleting elements from the displayed text
-    display_text = payload_dict.copy() if isinstance(payload_dict, dict) else payload_dict
-    filtered_text = cleanup_display_text(msg, display_text)
+    # NB: display_simple_msg() has already copied payload_dict, so elements can be deleted from the displayed text
+    filtered_text = cleanup_display_text(msg, payload_dict)
     try:
-        zone_name = "@ {:<20}".format(truncate_str(ZONES[target_zone_id], 20)) if target_zone_id and int(target_zone_id, 16) >= 0 and target_zone_id in ZONES else ""
+        zone_name = "@ {:<20}".format(truncate_str(REGISTRY.zones[target_zone_id].name, 20)) if target_zone_id and int(target_zone_id, 16) >= 0 and target_zone_id in REGISTRY.zones else ""
         zone_id = "[Zone {:<3}]".format(target_zone_id) if target_zone_id and int(target_zone_id, 16) >= 0 else ""
 
         if msg.src.type == "18": # Messages from the HGI device
@@ -515,47 +1954,490 @@ def display_simple_msg(msg, payload_dict, target_zone_id, suffix_text=""):
             style_prefix = f"{Style.RESET_ALL}"
 
         main_txt = f"{filtered_text if filtered_text else '-': <45} {zone_name:<25}"
-        print_formatted_row(src, dst, msg.verb, msg.code_name, f"{main_txt: <75} {zone_id} {suffix_text}", msg._pkt.rssi, style_prefix)
+        return format_row(src, dst, msg.verb, msg.code_name, f"{main_txt: <75} {zone_id} {suffix_text}", msg._pkt.rssi, style_prefix)
 
     except Exception as e:
         log.error(f"Exception occured: {e}", exc_info=True)
         log.error(f"msg: {msg}, payload_dict: {payload_dict}, target_zone_id: {target_zone_id}, suffix_text: {suffix_text}")
-        log.error(f"type(display_text): {type(display_text)}")
+        log.error(f"type(payload_dict): {type(payload_dict)}")
         log.error(f"filtered_text: {filtered_text}" if filtered_text else "filtered_text is None")
-        log.error(f"Display row: {msg.code_name}: {msg.verb}| {src} -> {dst} | {display_text} {zone_name} [Zone {target_zone_id}] {suffix_text}")
+        log.error(f"Display row: {msg.code_name}: {msg.verb}| {src} -> {dst} | {payload_dict} {zone_name} [Zone {target_zone_id}] {suffix_text}")
         log.error(f"|rssi '{msg._pkt.rssi}'| src '{src}' -> dst '{dst}' | verb '{msg.verb}'| cmd '{msg.code_name}'")
 
 def print_formatted_row(src="", dst="", verb="", cmd="", text="", rssi="   ", style_prefix=""):
-    dtm = datetime.datetime.now().strftime("%Y-%m-%d %X")
+    CONSOLE.submit(format_row, src, dst, verb, cmd, text, rssi, style_prefix, datetime.datetime.now())
+
+
+def format_row(src="", dst="", verb="", cmd="", text="", rssi="   ", style_prefix="", dtm=None) -> str:
+    dtm = (dtm or datetime.datetime.now()).strftime("%Y-%m-%d %X")
     if src:
         row = f"{dtm} |{rssi}| {truncate_str(src, 21) if src else '':<21} -> {truncate_str(dst, 21) if dst else '':<21} |{verb:<2}| {cmd:<15} | {text}"
     else:
         row = f"{dtm} | {text}"
     row = "{:<{min_row_width}}".format(row, min_row_width=MIN_ROW_LENGTH)
-    print(f"{Style.RESET_ALL}{style_prefix}{row.strip()}{Style.RESET_ALL}")
-
+    return f"{Style.RESET_ALL}{style_prefix}{row.strip()}{Style.RESET_ALL}"
 
-def send_command_callback(msg) -> None:
-    """ Callback receives msg object on success, and False on failure """
-    status=SEND_STATUS_SUCCESS if msg else SEND_STATUS_FAILED
-    mqtt_publish_send_status(None, status)
 
+def send_command_callback(queued_cmd, msg) -> None:
+    """ Called with the response msg object on success, and False/None on failure or time out """
     if msg:
         # print(f"code_name: {msg.code_name}, code: {msg.code}, is_expired: {msg.is_expired}")
-        display_text = f"COMMAND SEND SUCCESS: '{msg.code_name}'"
+        display_text = f"COMMAND SEND SUCCESS [{queued_cmd.id}]: '{msg.code_name}'"
     else:
-        if "code" in LAST_SEND_MSG:
-            cmd = LAST_SEND_MSG["code"]
-        elif "command" in LAST_SEND_MSG:
-            cmd = LAST_SEND_MSG["command"]
-        else:
-            cmd = "UNKNOWN"
-        display_text = f"COMMAND SEND FAILED for '{LAST_SEND_MSG}'"
+        display_text = f"COMMAND SEND {queued_cmd.status.upper()} [{queued_cmd.id}] for '{queued_cmd.json_data}'"
+        if queued_cmd.error:
+            display_text += f": {queued_cmd.error}"
 
     print_formatted_row(THIS_GATEWAY_NAME, text=display_text, style_prefix=f"{DISPLAY_COLOURS['mqtt_command']}")
     log.info(display_text)
 
 
+class QueuedCommand():
+    """ A command received via MQTT, with its send status. The id is used in the command's status topic, so a
+        given cmd_id is limited to letters, digits, '_' and '-'
+    """
+
+    def __init__(self, cmd, json_data, priority, cmd_id=None):
+        if cmd_id is not None and not re.fullmatch(r"[A-Za-z0-9_-]{1,64}", str(cmd_id)):
+            raise ValueError(f"Invalid cmd_id '{cmd_id}'. Only letters, digits, '_' and '-' are allowed (max 64)")
+        if type(priority) is not int: # NB: excludes bools
+            raise ValueError(f"Invalid priority '{priority}'. Must be an integer")
+        self.id = str(cmd_id) if cmd_id is not None else uuid.uuid4().hex[:12]
+        self.cmd = cmd
+        self.json_data = json_data
+        self.priority = priority
+        self.status = SEND_STATUS_QUEUED
+        self.error = None
+        self.queued_dtm = datetime.datetime.now()
+        self.status_dtm = self.queued_dtm
+        self.keys = []
+
+    def set_status(self, status, error=None):
+        self.status = status
+        self.error = error
+        self.status_dtm = datetime.datetime.now()
+        mqtt_publish_send_status(json.dumps(self.json_data), status, self)
+
+    def as_dict(self) -> dict:
+        return {"cmd_id": self.id, "command": self.json_data, "status": self.status, "error": self.error,
+            "priority": self.priority, "queued_ts": self.queued_dtm.strftime("%Y-%m-%dT%X"),
+            "status_ts": self.status_dtm.strftime("%Y-%m-%dT%X")}
+
+
+def estimate_airtime(cmd) -> float:
+    """ Rough on-air time (seconds) of a command. Each frame byte is Manchester encoded and sent with start/stop
+        bits, so takes 20 bits on air
+    """
+    frame_bytes = 1 + 3 * 3 + 1 + len(cmd.payload) // 2 + 1 # header, addresses, length, payload, checksum
+    return (RF_FRAME_OVERHEAD_BYTES * 10 + frame_bytes * 20) / RF_BIT_RATE
+
+
+def normalise_zone_idx(zone_idx):
+    """ zone_idx as the 2 digit (upper case) hex string used by ramses_rf, e.g. 1 or '1' -> '01'. Anything else
+        (e.g. 'HW', or None) is returned as is
+    """
+    if isinstance(zone_idx, int) and not isinstance(zone_idx, bool) and 0 <= zone_idx <= 0xFF:
+        return f"{zone_idx:02X}"
+    if isinstance(zone_idx, str) and re.fullmatch(r"[0-9A-Fa-f]{1,2}", zone_idx):
+        return zone_idx.upper().zfill(2)
+    return zone_idx
+
+
+def get_supersede_keys(cmd, json_data) -> list:
+    """ A queued command is made redundant by a newer one with any of the same keys: an identical packet, or a
+        write from the same named command to the same device and zone (e.g. repeated set_zone_mode calls)
+    """
+    keys = [("packet", cmd.verb, cmd.code, cmd.dst.id, cmd.payload)]
+    if "command" in json_data and cmd.verb in (" W", " I"):
+        keys.append(("write", cmd.verb, cmd.code, cmd.dst.id, normalise_zone_idx(json_data.get("zone_idx"))))
+    return keys
+
+
+class DutyCycleBudget():
+    """ Rolling budget of RF transmit time, of limit x window seconds in any window seconds """
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.total_airtime = 0
+        self.deferred = 0
+        self._used = 0
+        self._transmits = collections.deque()
+
+    @property
+    def budget(self) -> float:
+        return self.limit * self.window
+
+    def _expire(self, now):
+        while self._transmits and self._transmits[0][0] + self.window <= now:
+            self._used -= self._transmits.popleft()[1]
+
+    def wait_time(self, airtime, now=None) -> float:
+        """ Seconds until there is enough budget left to transmit for airtime seconds """
+        if self.limit <= 0:
+            return 0
+        now = now if now is not None else time.monotonic()
+        self._expire(now)
+        excess = self._used + airtime - self.budget
+        if excess <= 0:
+            return 0
+        for ts, used in self._transmits:
+            excess -= used
+            if excess <= 0:
+                return ts + self.window - now
+        return self.window
+
+    def record(self, airtime, now=None):
+        now = now if now is not None else time.monotonic()
+        self._transmits.append((now, airtime))
+        self._used += airtime
+        self.total_airtime += airtime
+
+    def get_stats(self) -> dict:
+        self._expire(time.monotonic())
+        return {"limit": self.limit, "window_s": self.window, "used_s": round(self._used, 3),
+            "remaining_s": round(max(self.budget - self._used, 0), 3) if self.limit > 0 else None,
+            "remaining_pct": round(100 * max(1 - self._used / self.budget, 0), 1) if self.limit > 0 else None,
+            "deferred": self.deferred, "total_airtime_s": round(self.total_airtime, 3)}
+
+
+class CommandQueue():
+    """ Priority queue of commands to be sent by the gateway, with up to max_in_flight commands awaiting a response
+        at any one time. Lower priority numbers are sent first; equal priorities in the order received.
+
+        Transmits are held back to keep within the RF duty cycle budget, and a queued command that is made redundant
+        by a newer one (see get_supersede_keys) is dropped in favour of the newer one.
+    """
+
+    def __init__(self, max_in_flight, timeout, budget):
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.budget = budget
+        self.in_flight = 0
+        self.counts = {}
+        self._seq = 0
+        self._queue = None
+        self._workers = []
+        self._queued_by_key = {}
+
+    def submit(self, cmd, json_data, priority=None, cmd_id=None) -> QueuedCommand:
+        """ Queue cmd to be sent. Raises a ValueError if the priority or cmd_id is not valid """
+        queued_cmd = QueuedCommand(cmd, json_data, COMMAND_DEFAULT_PRIORITY if priority is None else priority, cmd_id)
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_in_flight)]
+
+        queued_cmd.keys = get_supersede_keys(cmd, json_data)
+        for key in queued_cmd.keys:
+            older_cmd = self._queued_by_key.get(key)
+            if older_cmd and older_cmd.status == SEND_STATUS_QUEUED:
+                self._forget(older_cmd)
+                older_cmd.set_status(SEND_STATUS_SUPERSEDED, f"Superseded by command '{queued_cmd.id}'")
+                self.counts[SEND_STATUS_SUPERSEDED] = self.counts.get(SEND_STATUS_SUPERSEDED, 0) + 1
+            self._queued_by_key[key] = queued_cmd
+
+        self._seq += 1
+        self._queue.put_nowait((queued_cmd.priority, self._seq, queued_cmd))
+        queued_cmd.set_status(SEND_STATUS_QUEUED)
+        log.debug("Command [%s] queued: %s", queued_cmd.id, cmd)
+        return queued_cmd
+
+    def _forget(self, queued_cmd):
+        for key in queued_cmd.keys:
+            if self._queued_by_key.get(key) is queued_cmd:
+                del self._queued_by_key[key]
+
+    async def _worker(self):
+        while True:
+            _, _, queued_cmd = await self._queue.get()
+            if queued_cmd.status != SEND_STATUS_QUEUED: # i.e. superseded
+                continue
+
+            self.in_flight += 1
+            try:
+                await self._send(queued_cmd)
+            except Exception as ex:
+                log.error(f"Exception occured sending command [{queued_cmd.id}]: {ex}", exc_info=True)
+            finally:
+                self.in_flight -= 1
+                if queued_cmd.status != SEND_STATUS_SUPERSEDED:
+                    self.counts[queued_cmd.status] = self.counts.get(queued_cmd.status, 0) + 1
+
+    async def _send(self, queued_cmd):
+        loop = asyncio.get_running_loop()
+        response = loop.create_future()
+
+        def callback(msg):
+            if not response.done():
+                response.set_result(msg)
+
+        airtime = estimate_airtime(queued_cmd.cmd)
+        wait_time = self.budget.wait_time(airtime)
+        if wait_time > 0:
+            self.budget.deferred += 1
+            log.warning(f"RF duty cycle budget used up. Command [{queued_cmd.id}] deferred for {wait_time:.0f}s")
+            while wait_time > 0:
+                await asyncio.sleep(wait_time)
+                wait_time = self.budget.wait_time(airtime)
+            if queued_cmd.status != SEND_STATUS_QUEUED:
+                return # superseded whilst waiting
+
+        self._forget(queued_cmd)
+        try:
+            self.budget.record(airtime)
+            await asyncio.wrap_future(GWY.send_cmd(queued_cmd.cmd, callback=lambda msg: loop.call_soon_threadsafe(callback, msg)))
+            queued_cmd.set_status(SEND_STATUS_DISPATCHED)
+            mqtt_publish_stats(["duty_cycle"])
+            msg = await asyncio.wait_for(response, self.timeout)
+            queued_cmd.set_status(SEND_STATUS_SUCCESS if msg else SEND_STATUS_FAILED)
+        except asyncio.TimeoutError:
+            msg = None
+            queued_cmd.set_status(SEND_STATUS_TIMED_OUT, f"No response after {self.timeout}s")
+        except Exception as ex:
+            msg = None
+            queued_cmd.set_status(SEND_STATUS_FAILED, str(ex))
+
+        send_command_callback(queued_cmd, msg)
+
+    def get_stats(self) -> dict:
+        return {"queued": self._queue.qsize() if self._queue else 0, "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight, **{k.lower().replace(" ", "_"): v for k, v in self.counts.items()}}
+
+
+COMMAND_QUEUE = CommandQueue(COMMAND_MAX_IN_FLIGHT, COMMAND_TIMEOUT, DutyCycleBudget(DUTY_CYCLE_LIMIT, DUTY_CYCLE_WINDOW))
+
+
+class CommandSpec():
+    """ A ramses_rf Command constructor, with the type, default and whether required of each of its parameters """
+    __slots__ = ("name", "method", "params", "description", "ctl_param")
+
+    def __init__(self, name, method, params, description, ctl_param=None):
+        self.name = name
+        self.method = method
+        self.params = params
+        self.description = description
+        self.ctl_param = ctl_param # Parameter for the controller id, if any
+
+    def as_dict(self) -> dict:
+        return {"description": self.description, "params": self.params}
+
+
+class CommandRegistry():
+    """ The ramses_rf Command constructors (get_zone_temp, set_zone_mode etc), with their parameters worked out once
+        from their signatures. 'command' msgs received via MQTT are checked and coerced against these before anything
+        is queued. The destination (ctl_id/dev_id) is taken from the msg's dst_id if not given, and ctl_id defaults to
+        the controller
+    """
+
+    EXCLUDED = ("from_str", "packet") # Not constructors of a particular command ('code' msgs are used for these)
+    RESERVED = ("command", "cmd_id", "priority", "dst_id")
+    DESTINATIONS = ("ctl_id", "dev_id", "dst_id")
+    QOS_PARAMS = tuple(k for k in QOS_KEYS if k != "priority") # Passed through to ramses_rf
+
+    def __init__(self, command_class, aliases=None, gateway_commands=None):
+        self.aliases = aliases or {}
+        self.gateway_commands = gateway_commands or {}
+        self.commands = {}
+        for name, method in inspect.getmembers(command_class, inspect.ismethod):
+            if name.startswith("_") or name in self.EXCLUDED:
+                continue
+            # ramses_rf's validate_api_params() wrappers may rename the leading parameters, e.g. ctl_id to dst_id
+            wrapper_names = [p.name for p in self._get_params(inspect.signature(method, follow_wrapped=False))]
+            params = {}
+            ctl_param = None
+            for i, param in enumerate(self._get_params(inspect.signature(method))):
+                param_name = wrapper_names[i] if i < len(wrapper_names) else param.name
+                params[param_name] = {"type": self._get_param_type(param), "required": param.default is param.empty}
+                if param.default is not param.empty:
+                    params[param_name]["default"] = param.default
+                if param_name != param.name:
+                    params[param_name]["alias"] = param.name
+                if param.name == "ctl_id":
+                    ctl_param = param_name
+            description = (method.__doc__ or "").strip().split("\n")[0]
+            self.commands[name] = CommandSpec(name, method, params, description, ctl_param)
+
+    @staticmethod
+    def _get_params(signature) -> list:
+        return [p for p in signature.parameters.values() if p.kind not in (p.VAR_KEYWORD, p.VAR_POSITIONAL)]
+
+    @staticmethod
+    def _get_param_type(param) -> str:
+        annotation = param.annotation
+        if annotation in (str, int, float, bool):
+            return annotation.__name__
+        if annotation is datetime.datetime:
+            return "datetime"
+        if getattr(annotation, "__origin__", None) is Union:
+            return "idx" # e.g. zone_idx as 1 or "01", normalised by ramses_rf
+        if isinstance(param.default, bool):
+            return "bool"
+        if isinstance(param.default, (int, float)):
+            return "number"
+        return "any"
+
+    @staticmethod
+    def coerce(param_type, value):
+        """ value as param_type, e.g. "21.5" as 21.5 for a float. Raises ValueError/TypeError if not possible """
+        if value is None or param_type == "any":
+            return value
+        if param_type == "bool":
+            if isinstance(value, str) and value.strip().lower() in ("true", "false", "on", "off", "1", "0"):
+                return value.strip().lower() in ("true", "on", "1")
+            if isinstance(value, (bool, int)) and value in (0, 1):
+                return bool(value)
+            raise ValueError("not a bool")
+        if isinstance(value, bool):
+            raise TypeError("unexpected bool")
+        if param_type == "str":
+            return value if isinstance(value, str) else str(value)
+        if param_type == "int":
+            if isinstance(value, float) and not value.is_integer():
+                raise ValueError("not an int")
+            return int(value)
+        if param_type == "float":
+            return float(value)
+        if param_type == "number":
+            return value if isinstance(value, (int, float)) else float(value)
+        if param_type == "datetime":
+            return value if isinstance(value, datetime.datetime) else datetime.datetime.fromisoformat(value)
+        if param_type == "idx":
+            if not isinstance(value, (int, str)):
+                raise TypeError("not an int or str")
+        return value
+
+    def get_command(self, json_data):
+        """ The Command constructor and kwargs for the 'command' msg. Raises ValueError if the msg is not valid """
+        name = json_data["command"]
+        spec = self.commands.get(self.aliases.get(name, name))
+        if not spec:
+            raise ValueError(f"unknown command '{name}'")
+
+        aliases = {details["alias"] for details in spec.params.values() if "alias" in details}
+        unknown = [k for k in json_data if not (k in spec.params or k in aliases or k in self.RESERVED or k in self.QOS_PARAMS)]
+        if unknown:
+            raise ValueError(f"unknown argument(s) {unknown} for '{name}'. Arguments are: {list(spec.params)}")
+
+        kwargs = {k: json_data[k] for k in self.QOS_PARAMS if k in json_data}
+        for param, details in spec.params.items():
+            keys = [param, details.get("alias")]
+            if param in self.DESTINATIONS or details.get("alias") in self.DESTINATIONS:
+                keys.append("dst_id")
+            key = next((k for k in keys if k in json_data), None)
+            if key:
+                value = json_data[key]
+            elif param == spec.ctl_param and GWY and GWY.evo:
+                value = GWY.evo.id
+            elif details["required"]:
+                raise ValueError(f"'{name}' requires '{details.get('alias', param)}'")
+            else:
+                continue # ramses_rf's default
+            try:
+                kwargs[param] = self.coerce(details["type"], value)
+            except (TypeError, ValueError):
+                raise ValueError(f"'{param}' must be of type {details['type']} for '{name}', not {value!r}")
+        return spec.method, kwargs
+
+    def get_catalogue(self) -> dict:
+        catalogue = {name: spec.as_dict() for name, spec in sorted(self.commands.items())}
+        catalogue.update({alias: {"description": f"Same as '{name}'", "params": catalogue[name]["params"]}
+            for alias, name in self.aliases.items() if name in catalogue})
+        catalogue.update(self.gateway_commands)
+        return catalogue
+
+
+COMMAND_REGISTRY = CommandRegistry(Command, aliases={"ping": "get_system_time"}, gateway_commands={
+    GET_SCHED: {"description": "Get the schedule of a zone, or of the DHW ('HW')",
+        "params": {"zone_idx": {"type": "idx", "required": True}, "force_refresh": {"type": "bool", "required": False}}},
+    SET_SCHED: {"description": "Set the schedule of a zone, unless unchanged. Either 'schedule' or 'schedule_json_file' is required",
+        "params": {"schedule": {"type": "object", "required": False}, "schedule_json_file": {"type": "str", "required": False}}},
+    "set_schedules": {"description": "Set the schedules of several zones, one after the other",
+        "params": {"schedules": {"type": "list", "required": True}}},
+    "get_all_schedules": {"description": "Get the schedules of all zones (and DHW), from SCHEDULES_FILE if unchanged",
+        "params": {"force_refresh": {"type": "bool", "required": False, "default": False}}}})
+
+
+def mqtt_publish_state_validity(topic, msg):
+    """ Mark a topic's retained state as restored from the snapshot and stale (i.e. older than STATE_SNAPSHOT_MAX_AGE),
+        or as valid - either restored and recent enough, or when first updated by a live msg after being stale
+    """
+    stale = RESTORING_STATE and get_msg_age(msg) > STATE_SNAPSHOT_MAX_AGE
+    if stale:
+        STALE_TOPICS.add(topic.stale_topic)
+    else:
+        STALE_TOPICS.discard(topic.stale_topic)
+    MQTT_PUBLISHER.publish(topic.stale_topic, str(stale), "timestamp")
+
+
+def save_state_snapshot():
+    """ Save the last known state of the gateway, i.e. the most recent I/RP packet of each device/zone and code (as used
+        by ramses_rf to restore its state), along with the schema and params
+    """
+    if not GWY or not STATE_SNAPSHOT_FILE:
+        return
+    try:
+        schema, packets = GWY._get_state()
+        params = GWY.evo.params if GWY.evo else GWY.params
+        snapshot = {"saved": datetime.datetime.now().isoformat(timespec="seconds"), "schema": schema, "params": params, "packets": packets}
+        STATE_WRITER.save(snapshot, STATE_SNAPSHOT_FILE, versioned=False)
+    except Exception as e:
+        log.error(f"Exception occured saving the state snapshot: {e}", exc_info=True)
+
+
+async def save_state_snapshot_periodically():
+    while True:
+        await asyncio.sleep(STATE_SNAPSHOT_INTERVAL)
+        save_state_snapshot()
+
+
+async def restore_state_snapshot():
+    """ Restore GWY's state from the STATE_SNAPSHOT_FILE, before the serial port is opened. The restored msgs are
+        published as usual, but with their original timestamps, and with a '_stale' topic for each. If the whole
+        snapshot is recent, discovery is held off until it is STATE_SNAPSHOT_MAX_AGE old
+    """
+    global RESTORING_STATE
+    snapshot = load_json_from_file(STATE_SNAPSHOT_FILE) if STATE_SNAPSHOT_FILE else {}
+    packets = snapshot.get("packets") if isinstance(snapshot, dict) else None
+    if not packets:
+        return
+    if GWY.config.enforce_known_list and not GWY.pkt_protocol:
+        # ramses_rf checks any new device id against the HGI's id, which is not known until GWY.start() creates
+        # GWY.pkt_protocol, so only restore the msgs between known devices
+        packets = {dtm: pkt for dtm, pkt in packets.items()
+            if all(dev_id in GWY._include for dev_id in pkt.split()[3:6] if dev_id not in ("--:------", "63:262142"))}
+
+    cutoff = (datetime.datetime.now() - td(seconds=STATE_SNAPSHOT_MAX_AGE)).isoformat(timespec="microseconds")
+    fresh = sum(1 for dtm in packets if dtm >= cutoff)
+    start = time.perf_counter()
+    RESTORING_STATE = True
+    try:
+        await GWY._set_state(packets)
+    except Exception as e:
+        log.error(f"Exception occured restoring the state snapshot: {e}", exc_info=True)
+        return
+    finally:
+        RESTORING_STATE = False
+        MQTT_PUBLISHER.flush()
+        STAGE_TIMER.clear() # The restored msgs' ages would skew the stage timings
+
+    print_formatted_row("", text=f"Restored {len(packets)} msgs ({fresh} fresh, {len(packets) - fresh} stale) from "
+        f"'{STATE_SNAPSHOT_FILE}' in {time.perf_counter() - start:.2f}s")
+
+    try:
+        saved_age = (datetime.datetime.now() - datetime.datetime.fromisoformat(snapshot["saved"])).total_seconds()
+    except (KeyError, TypeError, ValueError):
+        saved_age = STATE_SNAPSHOT_MAX_AGE
+    if 0 <= saved_age < STATE_SNAPSHOT_MAX_AGE and not GWY.config.disable_discovery:
+        GWY.config.disable_discovery = True
+        GWY._loop.call_later(STATE_SNAPSHOT_MAX_AGE - saved_age, resume_discovery)
+        log.info(f"State snapshot is {saved_age:.0f}s old. Discovery held off for {STATE_SNAPSHOT_MAX_AGE - saved_age:.0f}s")
+
+
+def resume_discovery():
+    GWY.config.disable_discovery = RAMSESRF_DISABLE_DISCOVERY
+    log.info("Discovery resumed")
+
+
 def save_schema_and_devices():
     if not GWY:
         log.error("Schema cannot be saved as GWY is none")
@@ -570,12 +2452,11 @@ def save_schema_and_devices():
         update_zones_from_gwy()
         update_devices_from_gwy()
 
-        if DEVICES:
-            devices_simple = {str(k) : {SZ_ALIAS : DEVICES[k][SZ_ALIAS]} for k in DEVICES if k is not None}
-            save_json_to_file(devices_simple, DEVICES_FILE, True)
+        if REGISTRY.devices:
+            save_json_to_file(REGISTRY.devices_as_dict(with_zones=False), DEVICES_FILE, True)
 
-        if ZONES:
-            save_json_to_file(ZONES, ZONES_FILE, False)
+        if REGISTRY.zones:
+            save_json_to_file(REGISTRY.zones_as_dict(), ZONES_FILE, False)
 
         print(f"Updated '{DEVICES_FILE}' and ramses_rf schema files generated")
     except Exception as e:
@@ -585,100 +2466,227 @@ def save_schema_and_devices():
 
 def save_zones():
     update_zones_from_gwy()
-    if ZONES:
-        save_json_to_file(ZONES, ZONES_FILE, False)
+    if REGISTRY.zones:
+        save_json_to_file(REGISTRY.zones_as_dict(), ZONES_FILE, False)
 
 
 def get_existing_device_name(device_id):
-    return DEVICES[device_id][SZ_ALIAS] if device_id in DEVICES and SZ_ALIAS in DEVICES[device_id] else None
+    return REGISTRY.get_device_alias(device_id)
+
+
+def get_controller_id():
+    if not GWY:
+        return None
+    return GWY.evo.id if GWY.evo else GWY.schema.get("controller")
+
+
+def set_registry_device(device_id, alias, zone_id=None, ctl_id=None, changed=None):
+    """ REGISTRY.set_device(), adding device_id to the changed set if its entry was changed """
+    if REGISTRY.set_device(device_id, alias, zone_id, ctl_id) and changed is not None:
+        changed.add(device_id)
+
+
+def merge_zone_devices(zone_id, zone_items, controller_id, changed, ignore_unnamed_zones=False):
+    """ Merge the devices in a single zone's schema into REGISTRY """
+    if "sensor" in zone_items:
+        sensor_id = zone_items["sensor"]
+        org_name = get_existing_device_name(sensor_id)
+        set_registry_device(sensor_id, org_name if org_name else f"{get_device_type_and_id(sensor_id)}", zone_id, controller_id, changed)
+
+    if "devices" in zone_items:
+        if zone_id in REGISTRY.zones:
+            zone_name = REGISTRY.zones[zone_id].name
+        elif not ignore_unnamed_zones:
+            zone_name = f"Zone_{zone_id}"
+        else:
+            zone_name = None
+
+        for device_id in zone_items["devices"]:
+            if device_id is not None:
+                org_name = get_existing_device_name(device_id)
+                set_registry_device(device_id, org_name if org_name else f"{zone_name} {get_device_type_and_id(device_id)}", zone_id, controller_id, changed)
+
+
+def merge_dhw_devices(dhw_schema, controller_id, changed):
+    for dhw_device_type in dhw_schema:
+        device_id = dhw_schema[dhw_device_type]
+        if device_id:
+            set_registry_device(device_id, dhw_device_type.replace("_"," ").title(), ctl_id=controller_id, changed=changed)
+
+
+def merge_ufh_controller(ufc_id, controller_id, changed):
+    org_name = get_existing_device_name(ufc_id)
+    set_registry_device(ufc_id, org_name if org_name else f"UFH Controller {get_device_type_and_id(ufc_id)}", ctl_id=controller_id, changed=changed)
+
+
+def merge_ufh_circuits(ufc_id, ufc_schema) -> bool:
+    #TODO! If there are multiple ufh controllers, circuit numbers in ufh_circuits will have to be dependent on controller ID - is this available in messages?
+    changed = False
+    if SZ_UFH_CIRCUITS in ufc_schema and ufc_schema[SZ_UFH_CIRCUITS]:
+        for c in ufc_schema[SZ_UFH_CIRCUITS]:
+            changed = REGISTRY.set_ufh_circuit(c, ufc_schema[SZ_UFH_CIRCUITS][c], ufc_id) or changed
+    return changed
+
+
+def apply_registry_changes(device_ids=None, zone_ids=None, ufh_circuits=False):
+    """ Update whatever is derived from the registry for just the devices/zones that have changed.
+        UFH circuits only map ufh_idx to a zone before the topic lookup, so no cached topics depend on them
+    """
+    if not (device_ids or zone_ids or ufh_circuits):
+        return
+    if device_ids or zone_ids:
+        invalidate_topic_cache(device_ids or set(), zone_ids or set())
+    request_schema_publish()
 
 
 def update_devices_from_gwy(ignore_unnamed_zones=False):
-    """ Refresh the local DEVICES collection with the devices that GWY has found """
+    """ Refresh the REGISTRY devices with all the devices that GWY has found, by walking the full schema.
+        Only needed at startup or on POST_SCHEMA etc., as otherwise sync_device()/sync_zone() merge any changes
+    """
     schema = GWY.evo.schema if GWY.evo else  GWY.schema
-    global DEVICES
+    changed = set()
 
-    controller_id = GWY.evo.id if GWY and GWY.evo else (GWY.schema["controller"] if "controller" in GWY.schema else None)
-    if not controller_id is None and not controller_id in DEVICES:
-        DEVICES[controller_id] = {SZ_ALIAS: f"Controller"}
+    controller_id = get_controller_id()
+    if not controller_id is None and not controller_id in REGISTRY.devices:
+        set_registry_device(controller_id, f"Controller", ctl_id=controller_id, changed=changed)
 
     if "system" in schema and schema["system"] and "heating_control" in schema["system"]:
         device_id = schema["system"]["heating_control"]
         org_name = get_existing_device_name(device_id)
-        DEVICES[device_id] = {SZ_ALIAS: org_name if org_name else get_device_type_and_id(device_id)}
+        set_registry_device(device_id, org_name if org_name else get_device_type_and_id(device_id), ctl_id=controller_id, changed=changed)
 
     if "zones" in schema:
         for zone_id, zone_items in schema["zones"].items():
-            if "sensor" in zone_items:
-                sensor_id = zone_items["sensor"]
-                org_name = get_existing_device_name(sensor_id)
-                DEVICES[sensor_id] = {SZ_ALIAS: org_name if org_name else f"{get_device_type_and_id(sensor_id)}", "zone_id": zone_id}
-
-            if "devices" in zone_items:
-                if zone_id in ZONES:
-                    zone_name = ZONES[zone_id]
-                elif not ignore_unnamed_zones:
-                    zone_name = f"Zone_{zone_id}"
-                else:
-                    zone_name = None
-
-                for device_id in zone_items["devices"]:
-                    if device_id is not None:
-                        org_name = get_existing_device_name(device_id)
-                        DEVICES[device_id] = {SZ_ALIAS: org_name if org_name else f"{zone_name} {get_device_type_and_id(device_id)}", "zone_id": zone_id}
+            merge_zone_devices(zone_id, zone_items, controller_id, changed, ignore_unnamed_zones)
 
     if "stored_hotwater" in schema:
-        for dhw_device_type in schema["stored_hotwater"]:
-            device_id = schema["stored_hotwater"][dhw_device_type]
-            if device_id:
-                DEVICES[device_id] = {SZ_ALIAS: dhw_device_type.replace("_"," ").title()}
+        merge_dhw_devices(schema["stored_hotwater"], controller_id, changed)
 
     if SZ_UFH_SYSTEM in schema:
-        ufc_ids = list(schema[SZ_UFH_SYSTEM].keys())
-        for ufc_id in ufc_ids:
-            org_name = get_existing_device_name(ufc_id)
-            DEVICES[ufc_id] =  {SZ_ALIAS: org_name if org_name else f"UFH Controller {get_device_type_and_id(ufc_id)}"}
+        for ufc_id in schema[SZ_UFH_SYSTEM]:
+            merge_ufh_controller(ufc_id, controller_id, changed)
 
     if "orphans" in schema and schema["orphans"]:
         for device_id in schema["orphans"]:
             org_name = get_existing_device_name(device_id)
-            DEVICES[device_id] = {SZ_ALIAS: org_name if org_name else get_device_type_and_id(device_id)}
+            set_registry_device(device_id, org_name if org_name else get_device_type_and_id(device_id), changed=changed)
 
-    mqtt_publish_schema()
+    apply_registry_changes(changed)
 
 
-def update_zones_from_gwy(schema={}, params={}):
-    """ Refresh local ZONES with zones detected by GWY and has got zone names """
+def update_zones_from_gwy(schema={}, params={}, ctl_id=None):
+    """ Refresh REGISTRY zones with all zones detected by GWY and has got zone names, by walking the full schema.
+        Only needed at startup or on POST_SCHEMA etc., as otherwise sync_zone() merges any changes
+    """
     
     if GWY:
         if not schema:            
             schema = GWY.evo.schema if GWY.evo else GWY.schema
         if not params:
             params = GWY.evo.params if GWY.evo else GWY.params
+        ctl_id = ctl_id or get_controller_id()
 
-    global ZONES
-    global UFH_CIRCUITS
+    changed = set()
+    ufh_changed = False
 
     # GWY.evo.zones contains list of zone
     # GWY.evo.zone_by_idx['00'] gets zone object (e.g GWY.evo.zone_by_idx['00'].name)
 
-    # ZONES = {}
     if "zones" in schema and params:
         for zone_id in schema["zones"]:
             if "zones" in params and SZ_ZONE_NAME in params["zones"][zone_id] and params["zones"][zone_id][SZ_ZONE_NAME]:
-                ZONES[zone_id] = params["zones"][zone_id][SZ_ZONE_NAME]
+                if REGISTRY.set_zone(zone_id, params["zones"][zone_id][SZ_ZONE_NAME], ctl_id):
+                    changed.add(zone_id)
 
     if schema and SZ_UFH_SYSTEM in schema:
-        ufc_ids = list(schema[SZ_UFH_SYSTEM].keys())
-        for ufc_id in ufc_ids:
-            #TODO! If there are multiple ufh controllers, circuit numbers in ufh_circuits will have to be dependent on controller ID - is this available in messages?
-            if SZ_UFH_CIRCUITS in schema[SZ_UFH_SYSTEM][ufc_id] and len(schema[SZ_UFH_SYSTEM][ufc_id][SZ_UFH_CIRCUITS]) > 0:
-                for c in schema[SZ_UFH_SYSTEM][ufc_id][SZ_UFH_CIRCUITS]:
-                    UFH_CIRCUITS[c] = schema[SZ_UFH_SYSTEM][ufc_id][SZ_UFH_CIRCUITS][c]
+        for ufc_id in schema[SZ_UFH_SYSTEM]:
+            ufh_changed = merge_ufh_circuits(ufc_id, schema[SZ_UFH_SYSTEM][ufc_id]) or ufh_changed
 
     # Only publish if GWY initialised
     if GWY:
-        mqtt_publish_schema()
+        apply_registry_changes(zone_ids=changed, ufh_circuits=ufh_changed)
+    elif changed or ufh_changed:
+        invalidate_topic_cache()
+
+
+def sync_zone(zone_id) -> bool:
+    """ Merge a single zone (its name and devices) from GWY into REGISTRY, without walking the full schema """
+    zone = GWY.evo.zone_by_idx.get(zone_id) if GWY and GWY.evo and zone_id else None
+    if zone is None:
+        return False
+
+    controller_id = get_controller_id()
+    zone_changed = bool(zone.name) and REGISTRY.set_zone(zone_id, zone.name, controller_id)
+    changed = set()
+    merge_zone_devices(zone_id, zone.schema, controller_id, changed)
+    apply_registry_changes(changed, {zone_id} if zone_changed else None)
+    return zone_changed or bool(changed)
+
+
+def sync_device(device_id) -> bool:
+    """ Merge a single device found by GWY into REGISTRY (along with the rest of its zone, DHW or UFH controller),
+        without walking the full schema
+    """
+    device = GWY.device_by_id.get(device_id) if GWY else None
+    if device is None:
+        return False
+
+    evo = GWY.evo
+    zone_idx = getattr(getattr(device, "zone", None), "idx", None)
+    if evo and zone_idx in evo.zone_by_idx:
+        return sync_zone(zone_idx)
+
+    controller_id = get_controller_id()
+    changed = set()
+    ufh_changed = False
+    if device_id == controller_id:
+        if device_id not in REGISTRY.devices:
+            set_registry_device(device_id, f"Controller", ctl_id=controller_id, changed=changed)
+    elif evo and zone_idx == "HW" and evo.dhw:
+        merge_dhw_devices(evo.dhw.schema, controller_id, changed)
+    elif evo and device.type == "02":
+        merge_ufh_controller(device_id, controller_id, changed)
+        ufh_changed = merge_ufh_circuits(device_id, device.schema)
+    elif evo and evo.heating_control is device:
+        org_name = get_existing_device_name(device_id)
+        set_registry_device(device_id, org_name if org_name else get_device_type_and_id(device_id), ctl_id=controller_id, changed=changed)
+    elif not evo and getattr(device, "_ctl", None) is None and device._is_present:
+        # An orphan, as listed in GWY.schema
+        org_name = get_existing_device_name(device_id)
+        set_registry_device(device_id, org_name if org_name else get_device_type_and_id(device_id), changed=changed)
+
+    apply_registry_changes(changed, ufh_circuits=ufh_changed)
+    return bool(changed) or ufh_changed
+
+
+def sync_ufh_circuits() -> bool:
+    """ Merge the circuits of each UFH controller found by GWY into REGISTRY """
+    changed = False
+    for device in (GWY.devices if GWY else []):
+        if device.type == "02":
+            changed = merge_ufh_circuits(device.id, device.schema) or changed
+    apply_registry_changes(ufh_circuits=changed)
+    return changed
+
+
+def sync_registry_from_msg(msg):
+    """ Merge any zone changes reported by our controller's zone_name/zone_devices msgs (e.g. discovery results),
+        or a known device having been placed in a zone by ramses_rf (e.g. by eavesdropping)
+    """
+    if not GWY or not GWY.evo:
+        return
+
+    src_entry = REGISTRY.devices.get(msg.src.id)
+    src_zone_idx = getattr(getattr(msg.src, "zone", None), "idx", None)
+    if src_entry and src_zone_idx != src_entry.zone_id and src_zone_idx in GWY.evo.zone_by_idx:
+        sync_zone(src_zone_idx)
+
+    if msg.code_name not in ("zone_name", "zone_devices") or msg.src.id != GWY.evo.id:
+        return
+
+    for payload in (msg.payload if isinstance(msg.payload, list) else [msg.payload]):
+        if isinstance(payload, dict) and payload.get("zone_idx") in GWY.evo.zone_by_idx:
+            sync_zone(payload["zone_idx"])
 
 
 def get_device_type_and_id(device_id):
@@ -687,28 +2695,215 @@ def get_device_type_and_id(device_id):
         dev_type = _OUT_DEVICE_TABLE[id_parts[0]]["type"]
         return f"{dev_type}:{id_parts[1]}"
     else:
-        log.debug(f"get_device_type_and_id: Ignorning invalid device_id of '{device_id}'")
-        log.debug(traceback.format_exc())
+        log.debug("get_device_type_and_id: Ignorning invalid device_id of '%s'", device_id, exc_info=True)
 
 
 def get_sys_status_dict(status):
     return {"status": status, "status_ts": datetime.datetime.now().strftime("%Y-%m-%dT%X")}
 
 
+class MqttPublisher():
+    """ Publish pipeline stage between the gateway and the MQTT client.
+
+        Publishes are collected (e.g. all of those for a received message) and handed to the client in one burst
+        on flush(). If the client's outgoing queue already holds max_queued messages (e.g. the broker is slow), the
+        batch is either dropped, or held back and coalesced to the latest payload per topic until the queue drains.
+    """
+
+    def __init__(self, max_queued, policy, qos):
+        self.max_queued = max_queued
+        self.policy = policy
+        self.qos = qos
+        self.published = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.batches = 0
+        self._batch = []
+        self._pending = {}
+        self._timestamp = None
+        self._drain_scheduled = False
+        self._in_flight = 0
+
+    @property
+    def timestamp(self):
+        """ Timestamp shared by all publishes in the current batch """
+        if not self._timestamp:
+            self._timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%X")
+        return self._timestamp
+
+    def publish(self, topic, payload, topic_class="state", retain=True):
+        """ Add to the current batch. QoS is as configured for the topic_class """
+        self._batch.append((topic, payload, self.qos.get(topic_class, 0), retain))
+
+    def get_queue_depth(self) -> int:
+        """ Number of messages handed to the paho client that it has not yet sent (QoS 0) or had acknowledged """
+        return self._in_flight
+
+    def on_publish(self, client, userdata, mid):
+        """ paho callback """
+        self._in_flight = max(self._in_flight - 1, 0)
+
+    def on_connect(self):
+        # paho discards any unsent QoS 0 messages when the connection is lost, without an on_publish callback
+        self._in_flight = 0
+
+    def flush(self):
+        batch, self._batch = self._batch, []
+        self._timestamp = None
+        if batch:
+            self.batches += 1
+        elif not self._pending:
+            return
+
+        if self.get_queue_depth() >= self.max_queued:
+            self._hold_back(batch)
+            return
+
+        if self._pending:
+            # Send any held back publishes first, unless superseded by this batch
+            batch_topics = {b[0] for b in batch}
+            pending, self._pending = self._pending, {}
+            batch = [(t, *v) for t, v in pending.items() if t not in batch_topics] + batch
+
+        for topic, payload, qos, retain in batch:
+            self._in_flight += 1 # Before publish(), as paho may call on_publish() before returning
+            info = MQTT_CLIENT.publish(topic, payload, qos, retain)
+            if getattr(info, "rc", None) != 0:
+                self._in_flight -= 1
+        self.published += len(batch)
+
+    def _hold_back(self, batch):
+        if self.policy != "coalesce":
+            self.dropped += len(batch)
+            self._forget(topic for topic, *_ in batch)
+            log.warning(f"MQTT outgoing queue is full. Dropped {len(batch)} publishes")
+            return
+
+        for topic, payload, qos, retain in batch:
+            if topic in self._pending:
+                del self._pending[topic] # re-insert, so that the most recently updated topics are dropped last
+                self.coalesced += 1
+            self._pending[topic] = (payload, qos, retain)
+
+        while len(self._pending) > self.max_queued:
+            topic = next(iter(self._pending))
+            del self._pending[topic]
+            self._forget([topic])
+            self.dropped += 1
+
+        if GWY and not self._drain_scheduled:
+            self._drain_scheduled = True
+            GWY._loop.call_later(1, self._drain)
+
+    def _drain(self):
+        self._drain_scheduled = False
+        self.flush()
+
+    @staticmethod
+    def _forget(topics):
+        """ Dropped topics were recorded in LAST_PUBLISHED by is_publish_due(), so would not be published again until
+            their heartbeat. Forget them, so that the next value is published whether changed or not
+        """
+        for topic in topics:
+            LAST_PUBLISHED.pop(topic, None)
+
+    def get_stats(self) -> dict:
+        return {"queue_depth": self.get_queue_depth(), "pending": len(self._pending), "published": self.published,
+            "dropped": self.dropped, "coalesced": self.coalesced, "batches": self.batches}
+
+
+MQTT_PUBLISHER = MqttPublisher(MQTT_MAX_QUEUED, MQTT_QUEUE_POLICY, MQTT_QOS)
+
+
+class AsyncioMqttHelper():
+    """ Runs the paho client's network loop on the asyncio event loop, instead of on paho's own thread.
+
+        MQTT callbacks (and so any commands received) are then run on the same loop as the ramses_rf gateway, which
+        keeps REGISTRY etc. single-writer. Reconnection (normally done by paho's thread) is handled here too.
+    """
+
+    def __init__(self, loop, client, err_no_conn):
+        self.loop = loop
+        self.client = client
+        self.err_no_conn = err_no_conn # paho's MQTT_ERR_NO_CONN (paho is only imported by mqtt_initialise)
+        self._loop_thread = threading.get_ident()
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+        self._misc_task = None
+
+    def _on_loop(self, func, *args):
+        """ Socket callbacks also come from the executor thread that runs reconnect() """
+        if threading.get_ident() == self._loop_thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self._on_loop(self.loop.add_reader, sock, client.loop_read)
+        self._on_loop(self._start_misc_loop)
+
+    def _start_misc_loop(self):
+        if not self._misc_task:
+            self._misc_task = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self._on_loop(self.loop.remove_reader, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._on_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._on_loop(self.loop.remove_writer, sock)
+
+    async def misc_loop(self):
+        """ Keepalive pings, retries etc. Also reconnects (with backoff) if the connection to the broker is lost """
+        reconnect_delay = 1
+        while True:
+            if self.client.loop_misc() == self.err_no_conn:
+                try:
+                    # DNS lookup and TCP connect can block for up to paho's connect timeout, so not on the event loop
+                    await self.loop.run_in_executor(None, self.client.reconnect)
+                    reconnect_delay = 1
+                except Exception as ex:
+                    log.warning(f"Unable to reconnect to MQTT broker (retry in {reconnect_delay}s): {ex}")
+                    await asyncio.sleep(reconnect_delay)
+                    reconnect_delay = min(reconnect_delay * 2, 60)
+                    continue
+            await asyncio.sleep(1)
+
+    async def stop(self, timeout=2):
+        """ Give any queued publishes a chance to be sent, then disconnect """
+        end = time.monotonic() + timeout
+        while self.client.want_write() and time.monotonic() < end:
+            await asyncio.sleep(0.05)
+
+        self.client.disconnect()
+        if self._misc_task:
+            self._misc_task.cancel()
+            self._misc_task = None
+
+
 def mqtt_initialise():
     if not MQTT_SERVER:
         log.error("MQTT Server details not found. Exiting...")
         raise SystemExit
 
+    import paho.mqtt.client as mqtt
     global MQTT_CLIENT
     MQTT_CLIENT = mqtt.Client()
     MQTT_CLIENT.on_connect = mqtt_on_connect
     MQTT_CLIENT.on_message = mqtt_on_message
+    MQTT_CLIENT.on_publish = MQTT_PUBLISHER.on_publish
     MQTT_CLIENT.will_set(f"{MQTT_PUB_TOPIC}/{MQTT_STATUS_SUBTOPIC}",
         payload=json.dumps(get_sys_status_dict(MQTT_OFFLINE), indent=4), qos=0, retain=True)
 
     if MQTT_USER:
         MQTT_CLIENT.username_pw_set(MQTT_USER, MQTT_PW)
+
+    global MQTT_LOOP_HELPER
+    MQTT_LOOP_HELPER = AsyncioMqttHelper(asyncio.get_running_loop(), MQTT_CLIENT, mqtt.MQTT_ERR_NO_CONN)
     MQTT_CLIENT.connect(MQTT_SERVER)
 
     return MQTT_CLIENT
@@ -718,7 +2913,14 @@ def mqtt_on_connect(client, *_):
     log.info(f"Connected to MQTT broker. Subscribing to topic {MQTT_SUB_TOPIC} for commands")
     client.subscribe(MQTT_SUB_TOPIC)
     client.publish(f"{MQTT_PUB_TOPIC}/{MQTT_STATUS_SUBTOPIC}", MQTT_ONLINE)
+    # Broker may not have kept our retained messages, so make sure that everything is published in full again
+    SCHEMA_SECTION_HASHES.clear()
+    LAST_PUBLISHED.clear()
+    MQTT_PUBLISHER.on_connect()
     mqtt_publish_status(MQTT_ONLINE)
+    mqtt_publish_command_catalogue()
+    if GWY: # Otherwise published in full once GWY has been created
+        mqtt_publish_schema(force=True)
 
 
 def mqtt_on_message(client, _, msg):
@@ -728,8 +2930,201 @@ def mqtt_on_message(client, _, msg):
     mqtt_process_msg(payload)
 
 
+def mqtt_publish_command_catalogue():
+    """ The available commands and their arguments, so that clients can discover them """
+    MQTT_PUBLISHER.publish(f"{MQTT_SUB_TOPIC}/_command_catalogue", json.dumps(COMMAND_REGISTRY.get_catalogue(), default=str), "schema")
+    MQTT_PUBLISHER.flush()
+
+
 def mqtt_publish_status(status):
-    MQTT_CLIENT.publish(f"{MQTT_PUB_TOPIC}/{MQTT_STATUS_SUBTOPIC}", json.dumps(get_sys_status_dict(status), indent=4), 0, True)
+    MQTT_PUBLISHER.publish(f"{MQTT_PUB_TOPIC}/{MQTT_STATUS_SUBTOPIC}", json.dumps(get_sys_status_dict(status), indent=4), "status")
+    MQTT_PUBLISHER.flush()
+
+
+class MsgTopic():
+    """ Resolved MQTT topic prefix for a given src device, code, zone and topic_idx, with memoised leaf topics """
+    __slots__ = ("topic_base", "ts_topic", "stale_topic", "_leaves")
+
+    def __init__(self, topic_base, code_name):
+        self.topic_base = topic_base
+        self.ts_topic = f"{topic_base}/{code_name}_ts"
+        self.stale_topic = f"{topic_base}/{code_name}_stale"
+        self._leaves = {}
+
+    def leaf(self, key, sub_key=None):
+        """ Full topic for the given payload key, optionally nested under sub_key (e.g. opentherm msg_name) """
+        try:
+            return self._leaves[(sub_key, key)]
+        except KeyError:
+            topic = f"{self.topic_base}/{to_snake(sub_key)}" if sub_key else self.topic_base
+            if key is not None:
+                topic = f"{topic}/{to_snake(key)}"
+            self._leaves[(sub_key, key)] = topic
+            return topic
+
+
+class ZoneStateDocs():
+    """ Alternative to a retained topic per payload key. The same topic tree is kept in memory as one document per
+        zone (or per device, if not MQTT_GROUP_BY_ZONE), updated from each received msg, and published as JSON to
+        e.g. evohome/evogateway/lounge/_state. A changed document is published at most once every interval seconds
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.docs = {}
+        self.updates = 0
+        self.published = 0
+        self._pending = set()
+        self._last_published = {}
+
+    @staticmethod
+    def split_topic(topic):
+        """ Document topic, and the path to the value within the document, for the given (leaf) topic """
+        parts = topic[len(MQTT_PUB_TOPIC):].strip("/").split("/")
+        return f"{MQTT_PUB_TOPIC}/{parts[0]}/_state", parts[1:]
+
+    def update(self, topic, value):
+        doc_topic, path = self.split_topic(topic)
+        node = self.docs.setdefault(doc_topic, {})
+        for key in path[:-1]:
+            if not isinstance(node.get(key), dict):
+                node[key] = {} if node.get(key) is None else {"value": node[key]}
+            node = node[key]
+        key = path[-1] if path else "value"
+        if isinstance(node.get(key), dict):
+            node, key = node[key], "value"
+        node[key] = value
+        self.updates += 1
+
+    def request_publish(self, topic):
+        """ Publish the document holding topic now, or once interval seconds have passed since it was last published """
+        doc_topic = self.split_topic(topic)[0]
+        if doc_topic in self._pending:
+            return
+        delay = self._last_published.get(doc_topic, float("-inf")) + self.interval - time.monotonic()
+        if delay > 0 and GWY:
+            self._pending.add(doc_topic)
+            GWY._loop.call_later(delay, self._publish_pending, doc_topic)
+        else:
+            self.publish(doc_topic)
+
+    def publish(self, doc_topic):
+        self._pending.discard(doc_topic)
+        self._last_published[doc_topic] = time.monotonic()
+        MQTT_PUBLISHER.publish(doc_topic, json.dumps(self.docs[doc_topic], default=str))
+        self.published += 1
+
+    def _publish_pending(self, doc_topic):
+        if doc_topic in self._pending:
+            self.publish(doc_topic)
+            MQTT_PUBLISHER.flush()
+
+    def flush(self):
+        """ Publish any documents still waiting for their interval to pass, e.g. on exit """
+        for doc_topic in list(self._pending):
+            self.publish(doc_topic)
+        MQTT_PUBLISHER.flush()
+
+    def get_stats(self) -> dict:
+        return {"docs": len(self.docs), "updates": self.updates, "published": self.published, "pending": len(self._pending)}
+
+
+ZONE_DOCS = ZoneStateDocs(MQTT_ZONE_DOC_INTERVAL)
+
+
+def invalidate_topic_cache(device_ids=None, zone_ids=None):
+    """ Clear the cached topics of the given devices and zones (including the zones' devices), or all of them """
+    if not TOPIC_CACHE:
+        return
+    if device_ids is None and zone_ids is None:
+        log.debug("Clearing %s cached MQTT topics", len(TOPIC_CACHE))
+        TOPIC_CACHE.clear()
+        return
+
+    device_ids = set(device_ids or ())
+    zone_ids = set(zone_ids or ())
+    for zone_id in zone_ids:
+        device_ids |= REGISTRY.devices_by_zone.get(zone_id, set())
+    stale = [k for k in TOPIC_CACHE if k[0] in device_ids or k[2] in zone_ids or k[3] in zone_ids]
+    log.debug("Clearing %s cached MQTT topics, for devices %s and zones %s", len(stale), device_ids, zone_ids)
+    for k in stale:
+        del TOPIC_CACHE[k]
+
+
+def get_msg_topic(msg, payload, target_zone_id, src_zone_id):
+    """ Return the MsgTopic for the msg/payload, resolving and caching it if not seen before """
+
+    # Need separate topics for certain payloads under CTL or HGI, such as fault log entries
+    if "topic_idx" in payload:
+        # topic_idx is not currently sent in ramses_rf payloads. Use here for custom topics, e.g. schedules
+        idx = ("topic_idx", payload["topic_idx"])
+    elif "log_idx" in payload:
+        idx = ("log_idx", payload["log_idx"])
+    elif "zone_idx" in payload:
+        idx = ("zone_idx", payload["zone_idx"])
+    else:
+        idx = None
+
+    key = (msg.src.id, msg.code_name, target_zone_id, src_zone_id, idx)
+    topic = TOPIC_CACHE.get(key)
+    if topic:
+        TOPIC_CACHE.move_to_end(key)
+        return topic
+
+    src_zone = to_snake(get_msg_zone_name(msg.src, target_zone_id))
+    src_entry = REGISTRY.devices.get(msg.src.id)
+    src_device = src_entry.topic_name if src_entry else to_snake(get_device_name(msg.src))
+
+    if ("dhw_" in msg.code_name or "dhw_" in src_device or (src_zone_id and "HW" in src_zone_id)) and DHW_ZONE_PREFIX:
+        # treat DHW as a zone if we are grouping by zone, otherwise as a device prefix
+        if MQTT_GROUP_BY_ZONE:
+            src_zone = f"{DHW_ZONE_PREFIX}"
+        else:
+            src_device = f"{DHW_ZONE_PREFIX}/{src_device}"
+
+    if idx and idx[0] in ("topic_idx", "log_idx"):
+        topic_idx = f"/{idx[1]}"
+    elif idx and src_zone == MQTT_ZONE_IND_TOPIC and (src_device.startswith("hgi_") or src_device.startswith("ctl_")):
+        topic_idx = f"/{idx[1]}"
+    else:
+        topic_idx = ""
+
+    if MQTT_GROUP_BY_ZONE and src_zone:
+        topic_base = f"{MQTT_PUB_TOPIC}/{src_zone}/{src_device}/{msg.code_name}{topic_idx}"
+    else:
+        topic_base = f"{MQTT_PUB_TOPIC}/{src_device}/{msg.code_name}{topic_idx}"
+
+    topic = MsgTopic(topic_base, msg.code_name)
+    TOPIC_CACHE[key] = topic
+    if len(TOPIC_CACHE) > TOPIC_CACHE_SIZE:
+        TOPIC_CACHE.popitem(last=False)
+    return topic
+
+
+def get_deadband(code_name, key=None):
+    """ Numeric deadband for the given code, or failing that, for the payload key """
+    deadband = MQTT_PUB_DEADBANDS.get(code_name)
+    return deadband if deadband is not None else MQTT_PUB_DEADBANDS.get(key, 0)
+
+
+def is_publish_due(topic, value, deadband, now) -> bool:
+    """ True if value has changed (by more than any numeric deadband) since last published to topic, or if it
+        was last published more than MQTT_PUB_MAX_INTERVAL seconds ago. Always True if MQTT_PUB_CHANGES_ONLY is off
+    """
+    if not MQTT_PUB_CHANGES_ONLY:
+        return True
+
+    last = LAST_PUBLISHED.get(topic)
+    if last is not None and now - last[1] < MQTT_PUB_MAX_INTERVAL:
+        last_value = last[0]
+        if value == last_value:
+            return False
+        if (deadband and isinstance(value, (int, float)) and isinstance(last_value, (int, float))
+            and not isinstance(value, bool) and abs(value - last_value) < deadband - 1e-9):
+            return False
+
+    LAST_PUBLISHED[topic] = (value, now)
+    return True
 
 
 def mqtt_publish_received_msg(msg, payload, no_unpack=False):
@@ -757,14 +3152,13 @@ def mqtt_publish_received_msg(msg, payload, no_unpack=False):
         elif "zone_idx" in payload:
             target_zone_id = payload["zone_idx"]
         elif "ufh_idx" in str(payload):
-            if not UFH_CIRCUITS: # May just need an update
-                update_zones_from_gwy()
-            if UFH_CIRCUITS and payload["ufh_idx"] in UFH_CIRCUITS:
-                target_zone_id = UFH_CIRCUITS[payload["ufh_idx"]]["zone_idx"]
+            if not REGISTRY.ufh_circuits: # May just need an update
+                LOOKUP_MISSES.lookup(("ufh_circuits",), lambda: bool(REGISTRY.ufh_circuits), sync_ufh_circuits)
+            if payload["ufh_idx"] in REGISTRY.ufh_circuits:
+                target_zone_id = REGISTRY.ufh_circuits[payload["ufh_idx"]].zone_idx
 
-        if msg.src.id not in DEVICES: # Refresh zones/devices list
-            update_zones_from_gwy()
-            update_devices_from_gwy()
+        if msg.src.id not in REGISTRY.devices: # Refresh zones/devices list, unless recently tried for this device
+            LOOKUP_MISSES.lookup(("device", msg.src.id), lambda: msg.src.id in REGISTRY.devices, lambda: sync_device(msg.src.id))
 
         if hasattr(msg.src, "zone") and msg.src.zone and hasattr(msg.src.zone, "idx") and msg.src.zone.idx and not "HW" in msg.src.zone.idx:
             src_zone_id = msg.src.zone.idx
@@ -774,24 +3168,17 @@ def mqtt_publish_received_msg(msg, payload, no_unpack=False):
             src_zone_id = None
 
         if (target_zone_id and 0 <= int(target_zone_id, 16) < 12) or (src_zone_id and 0 <= int(src_zone_id, 16) < 12):
-            if MQTT_GROUP_BY_ZONE and MQTT_REQUIRE_ZONE_NAMES and (not ZONES or (target_zone_id not in ZONES and src_zone_id not in ZONES)):
+            zones = REGISTRY.zones
+            if MQTT_GROUP_BY_ZONE and MQTT_REQUIRE_ZONE_NAMES and (not zones or (target_zone_id not in zones and src_zone_id not in zones)):
                 # MQTT topic requires zone name...
-                update_zones_from_gwy()
-                if target_zone_id and target_zone_id not in ZONES and src_zone_id not in ZONES:
-                    log.error(f"Both 'target_zone_id' and 'src_zone_id' not found in ZONES")
+                LOOKUP_MISSES.lookup(("zone", target_zone_id, src_zone_id),
+                    lambda: bool(zones) and (target_zone_id in zones or src_zone_id in zones),
+                    lambda: sync_zone(target_zone_id) | sync_zone(src_zone_id))
+                if target_zone_id and target_zone_id not in zones and src_zone_id not in zones:
+                    log.error(f"Both 'target_zone_id' and 'src_zone_id' not found in zones")
                     return # Return unless we have the zone name, as otherwise cannot build topic
 
-        src_zone = to_snake(get_msg_zone_name(msg.src, target_zone_id)) #if not target_zone_id or target_zone_id <1 else get_device_zone_name(target_zone_id)
-        src_device = to_snake(get_device_name(msg.src))
-
-        if ("dhw_" in msg.code_name or "dhw_" in src_device or (src_zone_id and "HW" in src_zone_id)) and DHW_ZONE_PREFIX:
-            # treat DHW as a zone if we are grouping by zone, otherwise as a device prefix
-            if MQTT_GROUP_BY_ZONE:
-                src_zone = f"{DHW_ZONE_PREFIX}"
-            else:
-                src_device = f"{DHW_ZONE_PREFIX}/{src_device}"
-
-        if not MQTT_PUB_AS_JSON and "until" in payload and payload["until"] and " " in payload["until"]:
+        if (MQTT_PUB_ZONE_DOCS or not MQTT_PUB_AS_JSON) and "until" in payload and payload["until"] and " " in payload["until"]:
             # Patch with T separator
             try:
                 d, t = payload["until"].split(" ")
@@ -799,31 +3186,21 @@ def mqtt_publish_received_msg(msg, payload, no_unpack=False):
             except Exception as ex:
                 log.error(f"Exception occured in patching 'until' value '{payload['until']}': {ex}", exc_info=True)
 
-        # Need separate topics for certain payloads under CTL or HGI, such as fault log entries
-        if "topic_idx" in payload:
-            # topic_idx is not currently sent in ramses_rf payloads. Use here for custom topics, e.g. schedules
-            topic_idx = f"/{payload['topic_idx']}"
-        elif "log_idx" in payload:
-            topic_idx = f"/{payload['log_idx']}"
-        elif src_zone == MQTT_ZONE_IND_TOPIC and (src_device.startswith("hgi_") or src_device.startswith("ctl_")) and "zone_idx" in payload:
-            topic_idx = f"/{payload['zone_idx']}"
-        else:
-            topic_idx = ""
-
-        if MQTT_GROUP_BY_ZONE and src_zone:
-            topic_base = f"{MQTT_PUB_TOPIC}/{src_zone}/{src_device}/{msg.code_name}{topic_idx}"
-        else:
-            topic_base = f"{MQTT_PUB_TOPIC}/{src_device}/{msg.code_name}{topic_idx}"
+        topic_start = time.perf_counter()
+        topic = get_msg_topic(msg, payload, target_zone_id, src_zone_id)
+        topic_base = topic.topic_base
+        now = time.monotonic()
+        publish_start = time.perf_counter()
+        STAGE_TIMER.add("topic", publish_start - topic_start)
+        published = False
 
-        subtopic = topic_base
-        if not MQTT_PUB_AS_JSON and not no_unpack:
+        if (MQTT_PUB_ZONE_DOCS or not MQTT_PUB_AS_JSON) and not no_unpack:
             if msg.code_name == "opentherm_msg":
                 # This is an opentherm_msg. Extract msg item and updated_payload as new dict, with msg_name as key
                 new_key, updated_payload = get_opentherm_msg(msg)
             else:
                 updated_payload = payload
                 new_key = None
-            subtopic = f"{topic_base}/{to_snake(new_key)}" if new_key else topic_base
 
             # As some payloads are received as lists, others not, convert everything to a list so we can process in same way
             if updated_payload and not isinstance(updated_payload, list):
@@ -835,20 +3212,45 @@ def mqtt_publish_received_msg(msg, payload, no_unpack=False):
                     try:
                         if isinstance(payload_item, dict): # we may have a further dict in the updated_payload - e.g. opentherm msg, system_fault etc
                             for k in payload_item:
-                                MQTT_CLIENT.publish(f"{subtopic}/{to_snake(k)}", str(payload_item[k]), 0, True)
-                                log.debug(f"        -> mqtt_publish_received_msg: 2. Posted subtopic: {subtopic}/{to_snake(k)}, value: {payload_item[k]}")
+                                subtopic = topic.leaf(k, new_key)
+                                if is_publish_due(subtopic, payload_item[k], get_deadband(msg.code_name, k), now):
+                                    if MQTT_PUB_ZONE_DOCS:
+                                        ZONE_DOCS.update(subtopic, payload_item[k])
+                                    else:
+                                        MQTT_PUBLISHER.publish(subtopic, str(payload_item[k]))
+                                    published = True
+                                    log.debug("        -> mqtt_publish_received_msg: 2. Posted subtopic: %s, value: %s", subtopic, payload_item[k])
                         else:
-                            MQTT_CLIENT.publish(subtopic, str(payload_item), 0, True)
-                            log.info(f"        -> mqtt_publish_received_msg: 3. item is not a dict. Posted subtopic: {subtopic}, value: {payload_item}, type(playload_item): {type(payload_item)}")
+                            subtopic = topic.leaf(None, new_key)
+                            if is_publish_due(subtopic, payload_item, get_deadband(msg.code_name), now):
+                                if MQTT_PUB_ZONE_DOCS:
+                                    ZONE_DOCS.update(subtopic, payload_item)
+                                else:
+                                    MQTT_PUBLISHER.publish(subtopic, str(payload_item))
+                                published = True
+                                log.info(f"        -> mqtt_publish_received_msg: 3. item is not a dict. Posted subtopic: {subtopic}, value: {payload_item}, type(playload_item): {type(payload_item)}")
                     except Exception as e:
                         log.error(f"Exception occured: {e}", exc_info=True)
                         log.error(f"------------> payload_item: \"{payload_item}\", type(payload_item): \"{type(payload_item)}\", updated_payload: \"{updated_payload}\"")
                         log.error(f"------------> msg: {msg}")
         else:
-            MQTT_CLIENT.publish(subtopic, json.dumps(msg.payload), 0, True)
-
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%X")
-        MQTT_CLIENT.publish(f"{topic_base}/{msg.code_name}_ts", timestamp, 0, True)
+            json_payload = json.dumps(msg.payload)
+            if is_publish_due(topic_base, json_payload, 0, now):
+                MQTT_PUBLISHER.publish(topic_base, json_payload)
+                published = True
+
+        # Timestamp only changes with a published value, or as a heartbeat
+        if published or is_publish_due(topic.ts_topic, None, 0, now):
+            timestamp = msg.dtm.strftime("%Y-%m-%dT%X") if RESTORING_STATE else MQTT_PUBLISHER.timestamp
+            if MQTT_PUB_ZONE_DOCS:
+                ZONE_DOCS.update(topic.ts_topic, timestamp)
+                ZONE_DOCS.request_publish(topic.topic_base)
+            else:
+                MQTT_PUBLISHER.publish(topic.ts_topic, timestamp, "timestamp")
+            LAST_PUBLISHED[topic.ts_topic] = (None, now)
+        if RESTORING_STATE or topic.stale_topic in STALE_TOPICS:
+            mqtt_publish_state_validity(topic, msg)
+        STAGE_TIMER.add("publish", time.perf_counter() - publish_start)
         # print("published to mqtt topic {}: {}".format(topic, msg))
     except Exception as e:
         log.error(f"Exception occured: {e}", exc_info=True)
@@ -859,40 +3261,152 @@ def mqtt_publish_received_msg(msg, payload, no_unpack=False):
         pass
 
 
-def mqtt_publish_send_status(cmd, status):
+def mqtt_publish_send_status(cmd, status, queued_cmd=None):
     if not cmd and not status:
         log.error("mqtt_publish_send_status: Both 'cmd' and 'status' cannot be None")
         return
 
     topic = f"{MQTT_SUB_TOPIC}/_last_command"
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%X")
     if cmd:
-        MQTT_CLIENT.publish(f"{topic}/command", cmd, 0, True)
-        MQTT_CLIENT.publish(f"{topic}/command_ts", timestamp, 0, True)
+        MQTT_PUBLISHER.publish(f"{topic}/command", cmd, "command")
+        MQTT_PUBLISHER.publish(f"{topic}/command_ts", MQTT_PUBLISHER.timestamp, "command")
 
-    MQTT_CLIENT.publish(f"{topic}/status", status, 0, True)
-    MQTT_CLIENT.publish(f"{topic}/status_ts", timestamp, 0, True)
+    MQTT_PUBLISHER.publish(f"{topic}/status", status, "command")
+    MQTT_PUBLISHER.publish(f"{topic}/status_ts", MQTT_PUBLISHER.timestamp, "command")
 
+    if queued_cmd:
+        MQTT_PUBLISHER.publish(f"{topic}/cmd_id", queued_cmd.id, "command")
+        # Per command status, so that concurrent commands can be told apart
+        MQTT_PUBLISHER.publish(f"{MQTT_SUB_TOPIC}/_commands/{queued_cmd.id}/status", json.dumps(queued_cmd.as_dict()), "command", retain=False)
+    MQTT_PUBLISHER.flush()
 
-def mqtt_publish_schema():
-    topic = f"{MQTT_PUB_TOPIC}/{MQTT_ZONE_IND_TOPIC}/_gateway_config"
 
-    MQTT_CLIENT.publish(f"{topic}/gwy_mode", "eavesdrop" if SCHEMA_EAVESDROP else "monitor", 0, True)
-    MQTT_CLIENT.publish(f"{topic}/schema", json.dumps(GWY.schema if GWY.evo is None else GWY.evo.schema, sort_keys=True), 0, True)
-    MQTT_CLIENT.publish(f"{topic}/params", json.dumps(GWY.params if GWY.evo is None else GWY.evo.params, sort_keys=True), 0, True)
-    MQTT_CLIENT.publish(f"{topic}/status", json.dumps(GWY.status if GWY.evo is None else GWY.evo.status, sort_keys=True), 0, True)
-    MQTT_CLIENT.publish(f"{topic}/config", json.dumps(vars(GWY.config), sort_keys=True), 0, True)
+def request_schema_publish():
+    """ Coalesce schema publish requests, so that any changed sections are published once MQTT_SCHEMA_PUBLISH_DELAY has elapsed """
+    global SCHEMA_PUBLISH_PENDING
+
+    if MQTT_SCHEMA_PUBLISH_DELAY <= 0 or not GWY:
+        mqtt_publish_schema()
+        return
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # e.g. saving the schema on exit, after the loop (and the MQTT client) has stopped. The full schema is
+        # published again on the next start anyway
+        SCHEMA_PUBLISH_PENDING = False
+        return
 
-    MQTT_CLIENT.publish(f"{topic}/devices", json.dumps({str(k):  v for k, v in DEVICES.items()}, sort_keys=True), 0, True)
-    MQTT_CLIENT.publish(f"{topic}/zones", json.dumps(ZONES), 0, True)
-    MQTT_CLIENT.publish(f"{topic}/uhf_circuits", json.dumps(UFH_CIRCUITS, sort_keys=True), 0, True)
+    if SCHEMA_PUBLISH_PENDING:
+        return
 
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%X")
-    MQTT_CLIENT.publish(f"{topic}/_gateway_config_ts", timestamp, 0, True)
+    SCHEMA_PUBLISH_PENDING = True
+    loop.call_later(MQTT_SCHEMA_PUBLISH_DELAY, publish_pending_schema)
+
+
+def publish_pending_schema():
+    global SCHEMA_PUBLISH_PENDING
+    SCHEMA_PUBLISH_PENDING = False
+    mqtt_publish_schema()
+
+
+def mqtt_publish_schema(force=False):
+    """ Publish the _gateway_config sections that have changed since last published (or all of them if force is set) """
+    topic = f"{MQTT_PUB_TOPIC}/{MQTT_ZONE_IND_TOPIC}/_gateway_config"
+
+    sections = {
+        "gwy_mode": "eavesdrop" if SCHEMA_EAVESDROP else "monitor",
+        "schema": json.dumps(GWY.schema if GWY.evo is None else GWY.evo.schema, sort_keys=True),
+        "params": json.dumps(GWY.params if GWY.evo is None else GWY.evo.params, sort_keys=True),
+        "status": json.dumps(GWY.status if GWY.evo is None else GWY.evo.status, sort_keys=True),
+        "config": json.dumps(vars(GWY.config), sort_keys=True),
+        "devices": json.dumps(REGISTRY.devices_as_dict(), sort_keys=True),
+        "zones": json.dumps(REGISTRY.zones_as_dict()),
+        "uhf_circuits": json.dumps(REGISTRY.ufh_circuits_as_dict(), sort_keys=True)
+    }
+
+    published = []
+    for section, payload in sections.items():
+        digest = hashlib.sha1(payload.encode()).digest()
+        if force or SCHEMA_SECTION_HASHES.get(section) != digest:
+            MQTT_PUBLISHER.publish(f"{topic}/{section}", payload, "schema")
+            SCHEMA_SECTION_HASHES[section] = digest
+            published.append(section)
+
+    if published:
+        MQTT_PUBLISHER.publish(f"{topic}/_gateway_config_ts", MQTT_PUBLISHER.timestamp, "schema")
+        MQTT_PUBLISHER.flush()
+        log.debug("Published _gateway_config sections: %s", published)
+
+
+def get_gateway_stats(names=None) -> dict:
+    """ All gateway stats sections, or just those given in names (so that the other sections are not computed) """
+    sections = {"device_lookups": LOOKUP_MISSES.get_stats, "mqtt_publish": MQTT_PUBLISHER.get_stats,
+        "commands": COMMAND_QUEUE.get_stats, "duty_cycle": COMMAND_QUEUE.budget.get_stats,
+        "stages": STAGE_TIMER.get_stats, "console": CONSOLE.get_stats, "logging": LOG_WRITER.get_stats,
+        "persistence": STATE_WRITER.get_stats, "startup": STARTUP.get_stats,
+        "duplicates": DUPLICATES.get_stats, **({"radios": RADIOS.get_stats} if RADIOS else {}),
+        **({"zone_docs": ZONE_DOCS.get_stats} if MQTT_PUB_ZONE_DOCS else {}),
+        **({"history": HISTORY.get_stats} if HISTORY else {}),
+        **({"packet_archive": PACKET_ARCHIVER.get_stats} if PACKET_ARCHIVER else {})}
+    return {name: get_stats() for name, get_stats in sections.items() if not names or name in names}
+
+
+def get_prometheus_metrics() -> str:
+    """ Stage timings (as summaries) and the other numeric gateway stats, in the Prometheus text format """
+    lines = ["# HELP evogateway_stage_seconds Time spent in each stage of processing a received msg (age: since the packet was received)",
+        "# TYPE evogateway_stage_seconds summary"]
+    for stage in STAGE_TIMER.counts:
+        for q, value in zip(STAGE_QUANTILES, STAGE_TIMER.get_quantiles(stage)):
+            lines.append(f'evogateway_stage_seconds{{stage="{stage}",quantile="{q}"}} {value:.6f}')
+        lines.append(f'evogateway_stage_seconds_sum{{stage="{stage}"}} {STAGE_TIMER.sums[stage]:.6f}')
+        lines.append(f'evogateway_stage_seconds_count{{stage="{stage}"}} {STAGE_TIMER.counts[stage]}')
+
+    for name, stats in get_gateway_stats().items():
+        if name == "stages":
+            continue
+        for key, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f"evogateway_{name}_{key} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def save_metrics_file():
+    """ Write the metrics for the Prometheus node_exporter textfile collector (via a rename, so never read part written) """
+    tmp_file = f"{METRICS_FILE}.tmp"
+    with open(tmp_file, "w") as f:
+        f.write(get_prometheus_metrics())
+    os.replace(tmp_file, METRICS_FILE)
+
+
+def mqtt_publish_stats(names=None):
+    """ Publish all gateway stats, or just those given in names """
+    topic = f"{MQTT_PUB_TOPIC}/{MQTT_ZONE_IND_TOPIC}/_gateway_stats"
+    for name, stats in get_gateway_stats(names).items():
+        MQTT_PUBLISHER.publish(f"{topic}/{name}", json.dumps(stats, sort_keys=True), "stats")
+
+    MQTT_PUBLISHER.publish(f"{topic}/_gateway_stats_ts", MQTT_PUBLISHER.timestamp, "stats")
+    MQTT_PUBLISHER.flush()
+
+
+def mqtt_publish_history(reply_topic, result):
+    MQTT_PUBLISHER.publish(reply_topic, json.dumps(result), "command", retain=False)
+    MQTT_PUBLISHER.flush()
+
+
+async def publish_stats_periodically():
+    while True:
+        await asyncio.sleep(MQTT_STATS_PUBLISH_INTERVAL)
+        try:
+            mqtt_publish_stats()
+            if METRICS_FILE:
+                save_metrics_file()
+        except Exception as ex:
+            log.error(f"Exception occured publishing gateway stats: {ex}", exc_info=True)
 
 
 def mqtt_process_msg(msg):
-    log.debug(f"MQTT message received: {msg}")
+    log.debug("MQTT message received: %s", msg)
 
     try:
         json_data = json.loads(msg)
@@ -909,8 +3423,19 @@ def mqtt_process_msg(msg):
                 global DISPLAY_COLOURS
                 DISPLAY_COLOURS = get_display_colorscheme(True)
             elif json_data[SYS_CONFIG_COMMAND].upper().strip() == "POST_SCHEMA":
+                LOOKUP_MISSES.clear()
                 update_zones_from_gwy()
                 update_devices_from_gwy()
+                mqtt_publish_schema(force=True)
+            elif json_data[SYS_CONFIG_COMMAND].upper().strip() == "POST_STATS":
+                mqtt_publish_stats()
+            elif json_data[SYS_CONFIG_COMMAND].upper().strip() == "QUERY_HISTORY":
+                if not HISTORY:
+                    log.error("QUERY_HISTORY requires HISTORY_DB_FILE to be configured")
+                    return
+                reply_topic = json_data.get("reply_topic", f"{MQTT_SUB_TOPIC}/_history")
+                request = {k: v for k, v in json_data.items() if k not in (SYS_CONFIG_COMMAND, "reply_topic")}
+                HISTORY.query(request, lambda result: GWY._loop.call_soon_threadsafe(mqtt_publish_history, reply_topic, result))
             elif json_data[SYS_CONFIG_COMMAND].upper().strip() == "SAVE_SCHEMA":
                 update_zones_from_gwy()
                 update_devices_from_gwy()
@@ -933,16 +3458,29 @@ def mqtt_process_msg(msg):
                 payload = json_data["payload"]
                 dest_id = json_data["dest_id"] if "dest_id" in json_data else GWY.evo.id
                 gw_cmd = Command(verb, command_code, payload, dest_id)
-                log.debug(f"--------> MQTT message converted to Command: '{gw_cmd}'")
+                log.debug("--------> MQTT message converted to Command: '%s'", gw_cmd)
 
             elif "command" in json_data:
                 command_name = json_data["command"]
-                if command_name in GET_SCHED:
+                if command_name == "get_all_schedules":
+                    task = GWY._loop.create_task(get_all_schedules_async(json_data.get("force_refresh", False)))
+                    GWY._tasks.append(task)
+                    log.info(f"'get_all_schedules' task spawned : {task}")
+                    return
+                elif command_name == "set_schedules":
+                    schedules = json_data.get("schedules")
+                    if not schedules or not all("zone_idx" in x and "schedule" in x for x in schedules):
+                        log.error("'set_schedules' requires a 'schedules' list, each with 'zone_idx' and 'schedule'")
+                    else:
+                        queue_schedule_writes(schedules)
+                        log.info(f"'set_schedules' queued for zones {[x['zone_idx'] for x in schedules]}")
+                    return
+                elif command_name == GET_SCHED:
                     zone_idx = json_data["zone_idx"] if "zone_idx" in json_data else None
                     force_refresh = json_data["force_refresh"] if "force_refresh" in json_data else None
                     spawn_schedule_task(GET_SCHED, zone_idx=zone_idx, force_refresh=force_refresh)
                     return
-                elif command_name in SET_SCHED:
+                elif command_name == SET_SCHED:
                     if "schedule" in json_data:
                         spawn_schedule_task(action=SET_SCHED, schedule=json_data["schedule"])
                     elif "schedule_json_file" in json_data:
@@ -952,36 +3490,40 @@ def mqtt_process_msg(msg):
                     else:
                         log.error("'set_schedule' command requires a 'schedule' json")
                     return
-                elif command_name and command_name == "ping":
-                    command_name = "get_system_time"
-
-                cmd_method = getattr(Command, command_name)
-                cmd_kwargs = sorted(list(inspect.signature(cmd_method).parameters.keys()))
-                kwargs = {x: json_data[x] for x in json_data if x not in "command"}
-                if not "dst_id" in kwargs:
-                    kwargs["dst_id"] = GWY.evo.id
 
-                # !TODO - not sure why just 'setpoint' requires this, and not others, e.g. datetime
-                if command_name == "set_zone_mode" and not "ctl_id" in kwargs:
-                    kwargs["ctl_id"] = GWY.evo.id
+                try:
+                    cmd_method, kwargs = COMMAND_REGISTRY.get_command(json_data)
+                except ValueError as ex:
+                    log.error(f"Invalid command '{msg}': {ex}")
+                    print_formatted_row(SYSTEM_MSG_TAG, text=f"Invalid command: {ex}")
+                    mqtt_publish_send_status(json.dumps(json_data), "Invalid")
+                    return
 
                 try:
                     gw_cmd = cmd_method(**kwargs)
                 except Exception as ex:
                     log.error(f"Error in sending command '{msg}': {ex}")
-                    log.error(f"Command keywords: {cmd_kwargs}")
                     log.error(f"kwargs: {kwargs}")
                     print(traceback.format_exc())
+                    mqtt_publish_send_status(json.dumps(json_data), "Invalid")
+                    return
+                if gw_cmd is None:
+                    # ramses_rf logs (rather than raises) any errors from its validate_api_params() checks
+                    log.error(f"Invalid command '{msg}': rejected by ramses_rf. kwargs: {kwargs}")
+                    mqtt_publish_send_status(json.dumps(json_data), "Invalid")
+                    return
 
             else:
                 log.error(f"Invalid mqtt payload received: '{json.dumps(json_data)}'. Either 'command' or 'code' must be specified")
                 return
 
-            global LAST_SEND_MSG
-            LAST_SEND_MSG = json_data
-            log.debug(f"Sending command: {gw_cmd}")
-            GWY.send_cmd(gw_cmd, callback=send_command_callback)
-            mqtt_publish_send_status(msg, SEND_STATUS_TRANSMITTED)
+            log.debug("Queueing command: %s", gw_cmd)
+            try:
+                COMMAND_QUEUE.submit(gw_cmd, json_data, json_data.get("priority"), json_data.get("cmd_id"))
+            except ValueError as ex:
+                log.error(f"Invalid command '{msg}': {ex}")
+                print_formatted_row(SYSTEM_MSG_TAG, text=f"Invalid command: {ex}")
+                mqtt_publish_send_status(json.dumps(json_data), "Invalid")
 
     except TimeoutError:
         log.warning(f"Command '{gw_cmd if gw_cmd else msg}' failed due to time out")
@@ -1012,36 +3554,129 @@ def normalise_config_schema(config) -> Tuple[str, dict]:
     return serial_port, config
 
 
+class RadioSet():
+    """ Several radios (e.g. evofw3 dongles on different serial ports) feeding the one GWY, for better coverage.
+
+        Packets from every radio go through receive(), where a packet already received by another radio within the
+        last dedup_window seconds is dropped, so each is only processed (and published) once. The RSSI of each
+        device's packets at each radio is tracked (as a moving average, where lower values are stronger), and
+        commands are sent via the radio with the best link to the command's target device.
+
+        ramses_rf logs each packet to the packet log as it is parsed, i.e. once per radio, so the RadioSet is also
+        a filter on the packet logger, dropping the repeats of a packet already logged within dedup_window seconds.
+
+        NB: ramses_rf has no public hooks for this, so attach() and route_sends() swap in their own callbacks for
+        GWY.msg_transport's _pkt_receiver and _dispatcher. If these are not there (i.e. another ramses_rf version),
+        attach() returns False, and only the one radio is used.
+    """
+
+    def __init__(self, ports, dedup_window):
+        self.ports = ports
+        self.dedup_window = dedup_window
+        self.protocols = {}
+        self.link_rssi = {}
+        self.received = collections.Counter()
+        self.delivered = collections.Counter()
+        self.sent = collections.Counter()
+        self.duplicates = 0
+        self._recent = collections.OrderedDict()
+        self._logged = collections.OrderedDict()
+        self._deliver = None
+
+    def attach(self, gwy) -> bool:
+        """ Route the packets from GWY's own serial port through receive(), and open the other ports. Must be called
+            after GWY.create_client(), but before GWY.start()
+        """
+        if not all(hasattr(gwy.msg_transport, attr) for attr in ("_pkt_receiver", "_dispatcher")):
+            log.error(f"Unable to use more than one radio with this version of ramses_rf. Only using '{self.ports[0]}'")
+            return False
+
+        self._deliver = gwy.msg_transport._pkt_receiver
+        gwy.msg_transport._pkt_receiver = functools.partial(self.receive, self.ports[0])
+
+        for port in self.ports[1:]:
+            try:
+                protocol, transport = create_pkt_stack(gwy, functools.partial(self.receive, port), ser_port=port)
+            except Exception as e:
+                log.error(f"Unable to open radio on '{port}': {e}")
+                continue
+            self.protocols[port] = protocol
+            if transport.get_extra_info(POLLER_TASK):
+                gwy._tasks.append(transport.get_extra_info(POLLER_TASK))
+        logging.getLogger(PACKET_LOGGER_NAME).addFilter(self)
+        print_formatted_row("", text=f"Receiving from {len(self.protocols) + 1} radios: {', '.join([self.ports[0], *self.protocols])}")
+        return True
+
+    async def route_sends(self, gwy):
+        """ Once GWY has started (and set up its own port for sending), send all commands via send_data() instead """
+        while gwy.pkt_protocol is None or gwy.msg_transport._dispatcher is None:
+            await asyncio.sleep(0.1)
+        self.protocols = {self.ports[0]: gwy.pkt_protocol, **self.protocols}
+        gwy.msg_transport._dispatcher = self.send_data
+
+    def receive(self, port, pkt):
+        now = time.monotonic()
+        self.received[port] += 1
+        self._update_rssi(port, pkt)
+
+        while self._recent and next(iter(self._recent.values())) < now - self.dedup_window:
+            self._recent.popitem(last=False)
+        frame = pkt._frame[4:] # i.e. without the RSSI, which will differ between radios
+        if frame in self._recent:
+            self.duplicates += 1
+            return
+        self._recent[frame] = now
+
+        self.delivered[port] += 1
+        self._deliver(pkt)
+
+    def filter(self, record) -> bool:
+        """ Packet logger filter. False for a packet already logged (from another radio) within dedup_window seconds """
+        frame = getattr(record, "frame", "").strip()[4:] # i.e. without the RSSI, as for receive()
+        if not frame:
+            return True
+        now = time.monotonic()
+        while self._logged and next(iter(self._logged.values())) < now - self.dedup_window:
+            self._logged.popitem(last=False)
+        if frame in self._logged:
+            return False
+        self._logged[frame] = now
+        return True
+
+    def _update_rssi(self, port, pkt):
+        if not pkt._rssi.isdigit(): # e.g. '...' for HGI80s
+            return
+        links = self.link_rssi.setdefault(pkt.src.id, {})
+        rssi = int(pkt._rssi)
+        links[port] = rssi if port not in links else round(0.8 * links[port] + 0.2 * rssi, 1)
+
+    def get_best_port(self, device_id):
+        links = {port: rssi for port, rssi in self.link_rssi.get(device_id, {}).items() if port in self.protocols}
+        return min(links, key=links.get) if links else self.ports[0]
+
+    async def send_data(self, cmd):
+        port = self.get_best_port(cmd.dst.id)
+        if port not in self.protocols:
+            port = next(iter(self.protocols))
+        self.sent[port] += 1
+        log.debug("Sending %s via radio %s", cmd, port)
+        await self.protocols[port].send_data(cmd)
+
+    def get_stats(self) -> dict:
+        stats = {"duplicates": self.duplicates}
+        for i, port in enumerate(self.ports, 1):
+            stats.update({f"radio_{i}_received": self.received[port], f"radio_{i}_delivered": self.delivered[port],
+                f"radio_{i}_sent": self.sent[port], f"radio_{i}_best_links": sum(1 for d in self.link_rssi if self.get_best_port(d) == port)})
+        return stats
+
+
 def save_json_to_file(file_content, file_name, sorted=False):
+    """ Queue the file to be saved (atomically, with the previous versions kept in STATE_STORE_FILE) by STATE_WRITER """
     try:
-        if os.path.isfile(file_name):
-
-            if os.path.isfile(f"{file_name}.{MAX_SAVE_FILE_COUNT}"):
-                # Remove any files with extension over and above MAX_SAVE_FILE_COUNT
-                files = glob.glob(f"{file_name}.*")
-                for f in files:
-                    ext = f.split(".")[-1]
-                    if ext.isnumeric():
-                        if int(ext) > MAX_SAVE_FILE_COUNT:
-                            os.remove(f)
-                if os.path.isfile(f"{file_name}.1"):
-                    os.remove(f"{file_name}.1")
-                for j in range(2, MAX_SAVE_FILE_COUNT + 1):
-                    if os.path.isfile(f"{file_name}.{j}"):
-                        os.rename(f"{file_name}.{j}", f"{file_name}.{j-1}")
-
-            # If we are already at max count. Delete .1, and take away 1 from all others.
-            i = 1
-            while os.path.exists(f"{file_name}.{i}"):
-                i += 1
-            os.rename(file_name, f"{file_name}.{i}")
-
-        with open(file_name,'w') as fp:
-            fp.write(json.dumps(file_content, sort_keys=sorted, indent=4))
-        fp.close()
+        STATE_WRITER.save(file_content, file_name, sorted)
     except Exception as e:
         log.error(f"Exception occured saving file '{file_name}': {e}", exc_info=True)
-        log.error(f"{json.dumps(file_content)}")
+        log.error(f"{file_content}")
 
 
 def load_json_from_file(file_path):
@@ -1058,10 +3693,11 @@ def load_json_from_file(file_path):
 
 def initialise_sys(kwargs):
 
-    mqtt_initialise()
+    STARTUP.mark("module_init")
+    if not MQTT_CLIENT: # i.e. unless already set up for replaying a packet log
+        mqtt_initialise()
+        STARTUP.mark("mqtt_initialise")
 
-    global DEVICES
-    global ZONES
     global SCHEMA_EAVESDROP
     global SCHEMA_FILE
 
@@ -1109,43 +3745,44 @@ def initialise_sys(kwargs):
     lib_kwargs[CONFIG][DISABLE_SENDING] = GATEWAY_DISABLE_SENDING
 
     # Load local devices file if available. This forms the 'known_list' and also allows for custom naming of devices
-    DEVICES = load_json_from_file(DEVICES_FILE)
+    REGISTRY.load_devices(load_json_from_file(DEVICES_FILE))
 
     # Add this server/gateway as a known device
-    DEVICES[HGI_DEVICE_ID] = { SZ_ALIAS : THIS_GATEWAY_NAME}
-    SCHEMA_EAVESDROP = len(DEVICES) <= 1
+    REGISTRY.set_device(HGI_DEVICE_ID, THIS_GATEWAY_NAME)
+    SCHEMA_EAVESDROP = len(REGISTRY.devices) <= 1
 
-    if not SCHEMA_EAVESDROP and not KNOWN_LIST in lib_kwargs and DEVICES:
-        # Create 'known_list' from DEVICES
+    if not SCHEMA_EAVESDROP and not KNOWN_LIST in lib_kwargs and REGISTRY.devices:
+        # Create 'known_list' from the devices
         known_list = {KNOWN_LIST: {HGI_DEVICE_ID: { SZ_ALIAS : THIS_GATEWAY_NAME}}}
-        # allowed_list = [{d: {"name": DEVICES[d]["name"]}} for d in DEVICES]
-        for d in DEVICES:
-            known_list[KNOWN_LIST][d] = {SZ_ALIAS : DEVICES[d][SZ_ALIAS]}
+        known_list[KNOWN_LIST].update(REGISTRY.devices_as_dict(with_zones=False))
         lib_kwargs.update(known_list)
 
     if LOAD_ZONES_FROM_FILE:
-        ZONES = load_json_from_file(ZONES_FILE)
+        REGISTRY.load_zones(load_json_from_file(ZONES_FILE))
+    invalidate_topic_cache()
 
     import re
     device_regex = r"^01:[0-9]{6}$"
     for ctl_id, schema in lib_kwargs.items():
         if re.match(device_regex, ctl_id):
-            update_zones_from_gwy(schema, {})
+            update_zones_from_gwy(schema, {}, ctl_id)
 
-    if DEVICES and len(DEVICES) >1:
+    if len(REGISTRY.devices) >1:
         print_formatted_row("", text="")
         print_formatted_row("", text="------------------------------------------------------------------------------------------")
         print_formatted_row("", text=f"{Style.BRIGHT}{Fore.YELLOW}Devices loaded from '{DEVICES_FILE}' file:")
 
-        for key in sorted(DEVICES):
-            dev_type = _OUT_DEVICE_TABLE[key.split(":")[0]]["type"]
-            if "schema" in lib_kwargs and "zones" in lib_kwargs["schema"]:
-                zone_ids = get_parent_keys(lib_kwargs["schema"]["zones"], key)
-                zone_id = zone_ids[0] if zone_ids else None
-                zone_details = f"- Zone {zone_id:<3}" if zone_id else ""
-            else:
-                zone_details =""
-            print_formatted_row("", text=f"{Style.BRIGHT}{Fore.BLUE}   {dev_type} {key} - {DEVICES[key][SZ_ALIAS]:<23} {zone_details}")
+        # Zone of each device from the schema file, until refreshed from the gateway
+        if "schema" in lib_kwargs and "zones" in lib_kwargs["schema"]:
+            for device_id, zone_id in get_schema_device_zones(lib_kwargs["schema"]["zones"]).items():
+                if device_id in REGISTRY.devices:
+                    REGISTRY.set_device(device_id, REGISTRY.devices[device_id].alias, zone_id)
+
+        for key in sorted(REGISTRY.devices):
+            device = REGISTRY.devices[key]
+            dev_type = _OUT_DEVICE_TABLE[device.type]["type"] if device.type in _OUT_DEVICE_TABLE else device.type
+            zone_details = f"- Zone {device.zone_id:<3}" if device.zone_id else ""
+            print_formatted_row("", text=f"{Style.BRIGHT}{Fore.BLUE}   {dev_type} {key} - {device.alias or '':<23} {zone_details}")
 
         print_formatted_row("", text="------------------------------------------------------------------------------------------")
         print_formatted_row("", text="")
@@ -1155,24 +3792,132 @@ def initialise_sys(kwargs):
 
     log.info(f"# evogateway {VERSION} (using 'ramses_rf' library {RAMSES_RF_VERSION})")
     print_formatted_row('',  text=f"{Style.BRIGHT}{Fore.YELLOW}# evogateway {VERSION} (using 'ramses_rf' library {RAMSES_RF_VERSION})")
+    STARTUP.mark("schema_load")
 
     return lib_kwargs
 
 
+class ReplayMqttClient():
+    """ In-process stand-in for the paho client and broker when replaying packet logs. Keeps the last payload
+        of each retained topic, so that the replay's output can be inspected/compared
+    """
+
+    def __init__(self):
+        self.publishes = 0
+        self.retained = {}
+
+    def is_connected(self) -> bool:
+        return True
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.publishes += 1
+        if retain:
+            self.retained[topic] = payload
+
+    def subscribe(self, *args, **kwargs):
+        pass
+
+
+def read_packet_logs(file_names, speed=0):
+    """ Yield lines from packet log files, paced at speed x the original rate (as fast as possible if speed is 0) """
+    def read_lines():
+        for file_name in file_names:
+            with open(file_name) as f:
+                yield from f
+
+    yield from pace_packet_lines(read_lines(), speed)
+
+
+def pace_packet_lines(lines, speed=0):
+    """ Yield the packet log lines, paced at speed x the original rate (as fast as possible if speed is 0) """
+    global PACKET_RX_TIME
+    first_dtm = None
+    for line in lines:
+        if speed > 0:
+            try:
+                dtm = datetime.datetime.fromisoformat(line[:26])
+            except ValueError:
+                dtm = None
+            if dtm:
+                if first_dtm is None:
+                    first_dtm, first_time = dtm, time.monotonic()
+                delay = (dtm - first_dtm).total_seconds() / speed - (time.monotonic() - first_time)
+                if delay > 0:
+                    # Blocks the loop, but nothing else is waiting on it during a replay
+                    time.sleep(delay)
+        PACKET_RX_TIME = time.perf_counter()
+        yield line
+
+
+async def replay(file_names, speed=0, lines=None):
+    """ Feed packet log files (or the given packet log lines, e.g. from query_packet_logs) through the full message
+        pipeline (decode, display, topic resolution, publish), using an in-process MQTT client, and report throughput
+        and per stage latencies
+    """
+    global GWY
+    global MQTT_CLIENT
+    MQTT_CLIENT = ReplayMqttClient()
+    lib_kwargs = initialise_sys({})
+    _, lib_kwargs = normalise_config_schema(lib_kwargs)
+    lib_kwargs[CONFIG][DISABLE_SENDING] = True
+    lib_kwargs[CONFIG][PACKET_LOG] = PACKET_LOG_SCHEMA({LOG_FILE_NAME: ""}) # Don't log the replayed packets again
+
+    packet_lines = pace_packet_lines(lines, speed) if lines is not None else read_packet_logs(file_names, speed)
+    GWY = Gateway(None, input_file=packet_lines, **lib_kwargs)
+    GWY.create_client(process_gwy_message)
+    update_devices_from_gwy()
+    update_zones_from_gwy()
+
+    STAGE_TIMER.clear()
+    start = time.perf_counter()
+    await GWY.start()
+    elapsed = time.perf_counter() - start
+    ZONE_DOCS.flush()
+
+    msg_count = STAGE_TIMER.msg_count
+    print_formatted_row("", text="")
+    print_formatted_row("", text="------------------------------------------------------------------------------------------")
+    print_formatted_row("", text=f"{Style.BRIGHT}{Fore.YELLOW}Replayed {msg_count} msgs from {', '.join(file_names)} in {elapsed:.2f}s (speed: {speed or 'unthrottled'})")
+    print_formatted_row("", text=f"{Style.BRIGHT}{Fore.YELLOW}   {msg_count / elapsed if elapsed else 0:.1f} msgs/s, {MQTT_CLIENT.publishes / msg_count if msg_count else 0:.2f} MQTT publishes/msg")
+    for stage, stats in STAGE_TIMER.get_stats().items():
+        print_formatted_row("", text=f"{Style.BRIGHT}{Fore.BLUE}   {stage:<14} p50: {stats['p50_ms']:>8.3f} ms   p99: {stats['p99_ms']:>8.3f} ms   max: {stats['max_ms']:>8.3f} ms")
+    print_formatted_row("", text="------------------------------------------------------------------------------------------")
+    CONSOLE.flush()
+
+
 async def main(**kwargs):
 
     lib_kwargs = initialise_sys(kwargs)
     global GWY
     serial_port, lib_kwargs = normalise_config_schema(lib_kwargs)
     GWY = Gateway(serial_port, **lib_kwargs)
+    queue_log_handlers(logging.getLogger(PACKET_LOGGER_NAME))
     GWY.create_client(process_gwy_message)
+    if HISTORY_DB_FILE:
+        global HISTORY
+        HISTORY = HistoryStore(HISTORY_DB_FILE, HISTORY_CODES, HISTORY_RETENTION_DAYS, HISTORY_FLUSH_INTERVAL)
+        atexit.register(HISTORY.stop)
+    ports = [serial_port] + [port for port in COM_PORTS if port != serial_port]
+    if len(ports) > 1:
+        global RADIOS
+        RADIOS = RadioSet(ports, RADIO_DEDUP_WINDOW)
+        if not RADIOS.attach(GWY):
+            RADIOS = None
+    STARTUP.mark("gateway_init")
     update_devices_from_gwy()
     update_zones_from_gwy()
 
-    mqtt_publish_schema()
+    mqtt_publish_schema(force=True)
 
     try:
-        MQTT_CLIENT.loop_start()
+        await restore_state_snapshot()
+        STARTUP.mark("state_restore")
+        if MQTT_STATS_PUBLISH_INTERVAL > 0:
+            asyncio.create_task(publish_stats_periodically())
+        if STATE_SNAPSHOT_FILE and STATE_SNAPSHOT_INTERVAL > 0:
+            asyncio.create_task(save_state_snapshot_periodically())
+        if RADIOS:
+            asyncio.create_task(RADIOS.route_sends(GWY))
         tasks = asyncio.create_task(GWY.start())
 
         await tasks
@@ -1183,16 +3928,38 @@ async def main(**kwargs):
         msg = " - ended without error (e.g. EOF)"
 
     mqtt_publish_schema()
+    ZONE_DOCS.flush()
 
-
-    MQTT_CLIENT.loop_stop()
+    await MQTT_LOOP_HELPER.stop()
 
 
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description=f"evogateway {VERSION}")
+    parser.add_argument("--replay", nargs="+", metavar="PACKET_LOG", help="replay packet log file(s) through an in-process MQTT client and report throughput/latencies")
+    parser.add_argument("--replay-speed", type=float, default=0, metavar="SPEED", help="replay at SPEED x the logged rate, e.g. 1 for wall-clock (default 0: as fast as possible)")
+    parser.add_argument("--startup-profile", action="store_true", help="report the time taken by each phase of starting up, until the first packet is received")
+    parser.add_argument("--query-packets", action="store_true", help="print the packets from the packet logs/archive that match --from/--to/--device/--code")
+    parser.add_argument("--replay-packets", action="store_true", help="replay the packets from the packet logs/archive that match --from/--to/--device/--code (see --replay)")
+    parser.add_argument("--from", dest="from_dtm", metavar="DATETIME", help="packets from this ISO datetime, e.g. 2021-06-01T12:00")
+    parser.add_argument("--to", dest="to_dtm", metavar="DATETIME", help="packets up to this ISO datetime")
+    parser.add_argument("--device", nargs="+", metavar="DEVICE_ID", help="packets from/to any of these devices, e.g. 04:123456")
+    parser.add_argument("--code", nargs="+", metavar="CODE", help="packets with any of these codes, e.g. 30C9")
+    args, _ = parser.parse_known_args()
+    offline = args.replay or args.query_packets or args.replay_packets
+
     try:
-        asyncio.run(main())
+        if args.query_packets:
+            for line in query_packet_logs(args.from_dtm, args.to_dtm, args.device, args.code):
+                sys.stdout.write(line)
+        elif args.replay_packets:
+            packet_lines = query_packet_logs(args.from_dtm, args.to_dtm, args.device, args.code)
+            asyncio.run(replay([PACKET_ARCHIVE_DIR or PACKET_LOG_FILE], args.replay_speed, packet_lines))
+        elif args.replay:
+            asyncio.run(replay(args.replay, args.replay_speed))
+        else:
+            asyncio.run(main())
 
     except asyncio.CancelledError:
         msg = " - ended via: CancelledError (e.g. SIGINT)"
@@ -1203,7 +3970,8 @@ if __name__ == "__main__":
     else:  # if no Exceptions raised, e.g. EOF when parsing
         msg = " - ended without error (e.g. EOF)"
 
-    if GWY:
+    CONSOLE.flush()
+    if GWY and not offline:
         # Always update the zones file on exit
         save_zones()
 
@@ -1211,4 +3979,10 @@ if __name__ == "__main__":
             print_ramsesrf_gwy_schema(GWY)
             save_schema_and_devices()
 
-    print(msg)
+        save_state_snapshot()
+    if HISTORY:
+        HISTORY.stop()
+    STATE_WRITER.stop()
+
+    if not args.query_packets: # i.e. only the matching packets on stdout
+        print(msg)
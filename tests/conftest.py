@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# evogateway reads evogateway.cfg from, and opens its log files in, the current directory when imported. Run from an
+# empty directory, so that the config defaults are used and nothing is written to the checkout
+os.chdir(tempfile.mkdtemp(prefix="evogateway_tests_"))
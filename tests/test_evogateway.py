@@ -0,0 +1,363 @@
+import datetime
+import gzip
+import json
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+sys.argv = sys.argv[:1] # evogateway checks sys.argv for its own flags when imported
+import evogateway as e
+
+
+def make_msg(src="04:111111", dst="01:145038", verb=" I", code="30C9", payload="0007D0", code_name="temperature",
+        dtm=None, msg_payload=None):
+    return SimpleNamespace(src=SimpleNamespace(id=src), dst=SimpleNamespace(id=dst), verb=verb, code=code,
+        code_name=code_name, dtm=dtm or datetime.datetime.now(), _pkt=SimpleNamespace(_payload=payload),
+        payload=msg_payload if msg_payload is not None else {})
+
+
+def packet_line(dtm, src="04:111111", code="30C9", payload="0007D0"):
+    return f"{dtm.isoformat(timespec='microseconds')} 045  I --- {src} --:------ {src} {code} {len(payload) // 2:03d} {payload}\n"
+
+
+# -----------------------------------
+# DutyCycleBudget
+
+def test_duty_cycle_budget_waits_for_oldest_transmit_to_expire():
+    budget = e.DutyCycleBudget(0.01, 100) # i.e. 1s of airtime in any 100s
+    assert budget.wait_time(0.5, now=0) == 0
+    budget.record(0.6, now=0)
+    budget.record(0.3, now=5)
+    assert budget.wait_time(0.1, now=10) == 0
+    assert budget.wait_time(0.5, now=10) == pytest.approx(90) # Once the 0.6s at t=0 has expired
+    assert budget.wait_time(0.5, now=100) == 0
+    assert budget.total_airtime == pytest.approx(0.9)
+
+
+def test_duty_cycle_budget_needing_more_than_oldest_transmit():
+    budget = e.DutyCycleBudget(0.01, 100)
+    budget.record(0.2, now=0)
+    budget.record(0.7, now=20)
+    assert budget.wait_time(0.4, now=30) == pytest.approx(90) # Needs both transmits to expire
+
+
+def test_duty_cycle_budget_unlimited():
+    budget = e.DutyCycleBudget(0, 100)
+    budget.record(1000, now=0)
+    assert budget.wait_time(1000, now=1) == 0
+    assert budget.get_stats()["remaining_s"] is None
+
+
+# -----------------------------------
+# get_supersede_keys
+
+def make_cmd(verb=" W", code="2349", dst="01:145038", payload="01079E00FFFFFF"):
+    return SimpleNamespace(verb=verb, code=code, dst=SimpleNamespace(id=dst), payload=payload)
+
+
+@pytest.mark.parametrize("zone_idx, expected", [(1, "01"), ("1", "01"), ("01", "01"), ("a", "0A"), (10, "0A"),
+    ("HW", "HW"), (None, None)])
+def test_normalise_zone_idx(zone_idx, expected):
+    assert e.normalise_zone_idx(zone_idx) == expected
+
+
+def test_supersede_keys_match_for_same_zone_however_given():
+    keys_int = e.get_supersede_keys(make_cmd(payload="01079E00FFFFFF"), {"command": "set_zone_mode", "zone_idx": 1})
+    keys_str = e.get_supersede_keys(make_cmd(payload="0107D000FFFFFF"), {"command": "set_zone_mode", "zone_idx": "01"})
+    assert keys_int[0] != keys_str[0] # Different packets...
+    assert keys_int[1] == keys_str[1] # ...but the same write
+
+
+def test_supersede_keys_differ_between_zones():
+    keys_1 = e.get_supersede_keys(make_cmd(), {"command": "set_zone_mode", "zone_idx": "01"})
+    keys_2 = e.get_supersede_keys(make_cmd(), {"command": "set_zone_mode", "zone_idx": "02"})
+    assert keys_1[1] != keys_2[1]
+
+
+def test_supersede_keys_only_packet_for_requests_and_code_msgs():
+    assert len(e.get_supersede_keys(make_cmd(verb="RQ"), {"command": "get_zone_temp", "zone_idx": "01"})) == 1
+    assert len(e.get_supersede_keys(make_cmd(), {"code": "2349", "verb": " W", "payload": "01079E00FFFFFF"})) == 1
+
+
+# -----------------------------------
+# is_publish_due
+
+@pytest.fixture
+def changes_only(monkeypatch):
+    monkeypatch.setattr(e, "MQTT_PUB_CHANGES_ONLY", True)
+    monkeypatch.setattr(e, "MQTT_PUB_MAX_INTERVAL", 900)
+    monkeypatch.setattr(e, "LAST_PUBLISHED", {})
+
+
+def test_publish_due_only_when_changed(changes_only):
+    assert e.is_publish_due("t", "on", 0, now=0)
+    assert not e.is_publish_due("t", "on", 0, now=1)
+    assert e.is_publish_due("t", "off", 0, now=2)
+    assert e.is_publish_due("other", "off", 0, now=2)
+
+
+def test_publish_due_outside_deadband(changes_only):
+    assert e.is_publish_due("t", 20.0, 0.05, now=0)
+    assert not e.is_publish_due("t", 20.04, 0.05, now=1)
+    assert not e.is_publish_due("t", 19.96, 0.05, now=2)
+    assert e.is_publish_due("t", 20.05, 0.05, now=3) # A change of exactly the deadband is published
+    assert not e.is_publish_due("t", 20.09, 0.05, now=4) # Compared with the last value published, i.e. 20.05
+    assert e.is_publish_due("t", 20.11, 0.05, now=5)
+
+
+def test_publish_due_deadband_not_applied_to_bools(changes_only):
+    assert e.is_publish_due("t", True, 5, now=0)
+    assert e.is_publish_due("t", False, 5, now=1)
+
+
+def test_publish_due_heartbeat(changes_only):
+    assert e.is_publish_due("t", 20.0, 0, now=0)
+    assert not e.is_publish_due("t", 20.0, 0, now=899)
+    assert e.is_publish_due("t", 20.0, 0, now=900)
+
+
+def test_publish_always_due_if_not_changes_only(monkeypatch):
+    monkeypatch.setattr(e, "MQTT_PUB_CHANGES_ONLY", False)
+    monkeypatch.setattr(e, "LAST_PUBLISHED", {})
+    assert e.is_publish_due("t", 20.0, 0, now=0)
+    assert e.is_publish_due("t", 20.0, 0, now=1)
+    assert not e.LAST_PUBLISHED
+
+
+# -----------------------------------
+# DuplicateFilter
+
+def test_duplicate_filter_within_window():
+    dtm = datetime.datetime(2021, 6, 1, 12)
+    duplicates = e.DuplicateFilter(64, 2)
+    assert not duplicates.is_duplicate(make_msg(dtm=dtm))
+    assert duplicates.is_duplicate(make_msg(dtm=dtm + datetime.timedelta(seconds=1)))
+    assert not duplicates.is_duplicate(make_msg(dtm=dtm + datetime.timedelta(seconds=1), payload="0007D1"))
+    assert not duplicates.is_duplicate(make_msg(dtm=dtm + datetime.timedelta(seconds=1), src="04:222222"))
+    assert duplicates.duplicates == 1
+    assert duplicates.by_device == {"04:111111": 1}
+
+
+def test_duplicate_filter_after_window():
+    dtm = datetime.datetime(2021, 6, 1, 12)
+    duplicates = e.DuplicateFilter(64, 2)
+    assert not duplicates.is_duplicate(make_msg(dtm=dtm))
+    assert not duplicates.is_duplicate(make_msg(dtm=dtm + datetime.timedelta(seconds=3)))
+
+
+def test_duplicate_filter_single_slot_overwritten():
+    dtm = datetime.datetime(2021, 6, 1, 12)
+    duplicates = e.DuplicateFilter(1, 2)
+    assert not duplicates.is_duplicate(make_msg(dtm=dtm))
+    assert not duplicates.is_duplicate(make_msg(dtm=dtm, src="04:222222"))
+    assert not duplicates.is_duplicate(make_msg(dtm=dtm)) # Missed, as its slot was taken by 04:222222
+
+
+def test_duplicate_filter_disabled():
+    duplicates = e.DuplicateFilter(64, 0)
+    msg = make_msg()
+    assert not duplicates.is_duplicate(msg)
+    assert not duplicates.is_duplicate(msg)
+
+
+# -----------------------------------
+# CommandRegistry
+
+@pytest.mark.parametrize("param_type, value, expected", [
+    ("bool", "On", True), ("bool", "false", False), ("bool", 1, True), ("bool", False, False),
+    ("int", "3", 3), ("int", 3.0, 3), ("float", "21.5", 21.5), ("float", 21, 21.0), ("number", "0.5", 0.5),
+    ("number", 2, 2), ("str", 12, "12"), ("idx", 1, 1), ("idx", "01", "01"), ("any", [1], [1]), ("int", None, None),
+    ("datetime", "2021-06-01T12:30:00", datetime.datetime(2021, 6, 1, 12, 30))])
+def test_coerce(param_type, value, expected):
+    assert e.CommandRegistry.coerce(param_type, value) == expected
+
+
+@pytest.mark.parametrize("param_type, value", [("bool", "maybe"), ("bool", 2), ("int", 1.5), ("int", True),
+    ("int", "x"), ("float", True), ("datetime", "tomorrow"), ("idx", [1])])
+def test_coerce_invalid(param_type, value):
+    with pytest.raises((TypeError, ValueError)):
+        e.CommandRegistry.coerce(param_type, value)
+
+
+def test_get_command_coerces_args():
+    method, kwargs = e.COMMAND_REGISTRY.get_command({"command": "set_zone_mode", "ctl_id": "01:145038", "zone_idx": "01",
+        "setpoint": "21.5", "cmd_id": "abc", "priority": 1})
+    assert method.__name__ == "set_zone_mode"
+    assert kwargs == {"ctl_id": "01:145038", "zone_idx": "01", "setpoint": 21.5}
+
+
+@pytest.mark.parametrize("json_data, error", [
+    ({"command": "no_such_command"}, "unknown command"),
+    ({"command": "set_zone_mode", "zone_idx": "01"}, "requires 'ctl_id'"), # No controller to default to
+    ({"command": "set_zone_mode", "ctl_id": "01:145038", "zone_idx": "01", "colour": "red"}, "unknown argument"),
+    ({"command": "set_zone_mode", "ctl_id": "01:145038", "zone_idx": "01", "setpoint": "warm"}, "must be of type float")])
+def test_get_command_invalid(json_data, error):
+    with pytest.raises(ValueError, match=error):
+        e.COMMAND_REGISTRY.get_command(json_data)
+
+
+# -----------------------------------
+# PacketLogArchiver
+
+def write_packet_log(file_name, start, count, devices=("04:111111", "04:222222"), codes=("30C9", "3150")):
+    with open(file_name, "w") as fp:
+        for i in range(count):
+            fp.write(packet_line(start + datetime.timedelta(seconds=i), devices[i % len(devices)],
+                codes[i // 10 % len(codes)])) # i.e. the code changes every 10 packets
+
+
+def test_archive_and_query(tmp_path):
+    archiver = e.PacketLogArchiver(str(tmp_path / "archive"), 10)
+    start = datetime.datetime(2021, 6, 1, 12)
+    log_file = str(tmp_path / "packet.log.1")
+    write_packet_log(log_file, start, 100)
+
+    archiver.archive(log_file)
+    assert not os.path.exists(log_file)
+    assert archiver.get_stats()["archived_lines"] == 100
+
+    with open(tmp_path / "archive" / "packet_20210601T120000.log.gz.idx") as fp:
+        index = json.load(fp)
+    assert len(index["blocks"]) == 10
+    assert index["blocks"][0]["codes"] == ["30C9"] and index["blocks"][1]["codes"] == ["3150"]
+    with gzip.open(tmp_path / "archive" / index["file"], "rt") as fp: # Still a normal .gz file
+        assert len(fp.readlines()) == 100
+
+    assert len(list(archiver.query())) == 100
+    lines = list(archiver.query(devices={"04:222222"}, codes={"3150"}))
+    assert len(lines) == 25 and all("04:222222" in line and " 3150 " in line for line in lines)
+    lines = list(archiver.query(start=(start + datetime.timedelta(seconds=20)).isoformat(timespec="microseconds"),
+        end=(start + datetime.timedelta(seconds=29)).isoformat(timespec="microseconds"))) # As from query_packet_logs()
+    assert len(lines) == 10 and lines[0].startswith("2021-06-01T12:00:20")
+
+
+def test_archive_pruned_to_max_size(tmp_path):
+    archiver = e.PacketLogArchiver(str(tmp_path / "archive"), 10, max_mb=1e-6) # i.e. only ever keep the newest
+    for day in (1, 2, 3):
+        log_file = str(tmp_path / "packet.log.1")
+        write_packet_log(log_file, datetime.datetime(2021, 6, day, 12), 20)
+        archiver.archive(log_file)
+
+    assert sorted(os.listdir(tmp_path / "archive")) == ["packet_20210603T120000.log.gz", "packet_20210603T120000.log.gz.idx"]
+    assert archiver.pruned == 2
+    assert all(line.startswith("2021-06-03") for line in archiver.query())
+
+
+def test_archive_not_pruned_without_max_size(tmp_path):
+    archiver = e.PacketLogArchiver(str(tmp_path / "archive"), 10)
+    for day in (1, 2):
+        log_file = str(tmp_path / "packet.log.1")
+        write_packet_log(log_file, datetime.datetime(2021, 6, day, 12), 20)
+        archiver.archive(log_file)
+    assert len(list(archiver.query())) == 40
+
+
+def test_get_rotated_files_oldest_first(tmp_path):
+    log_file = str(tmp_path / "packet.log")
+    for suffix in ("1", "2", "2021-06-02", "2021-06-01", "bak"):
+        (tmp_path / f"packet.log.{suffix}").write_text("")
+    assert e.get_rotated_files(log_file) == [f"{log_file}.{suffix}" for suffix in ("2", "1", "2021-06-01", "2021-06-02")]
+
+
+# -----------------------------------
+# HistoryStore
+
+def make_temperature_msg(dtm, value, zone_idx="01"):
+    return make_msg(dtm=dtm, msg_payload={"zone_idx": zone_idx, "temperature": value})
+
+
+def run_query(history, request) -> dict:
+    results = queue.Queue()
+    history.query(request, results.put)
+    return results.get(timeout=10)
+
+
+@pytest.fixture
+def history(tmp_path):
+    history = e.HistoryStore(str(tmp_path / "history.db"), ["temperature"], {"raw": 7}, 0.05)
+    yield history
+    history.stop()
+
+
+def test_history_rollups(history):
+    bucket = datetime.datetime.fromtimestamp((time.time() - 3600) // 3600 * 3600)
+    for i, value in enumerate((20.0, 22.0, 21.0)):
+        history.record(make_temperature_msg(bucket + datetime.timedelta(seconds=i * 10), value))
+    history.record(make_msg(code_name="setpoint", msg_payload={"setpoint": 21.0})) # Not one of the codes kept
+    history.record(make_temperature_msg(bucket + datetime.timedelta(minutes=1), 19.0))
+
+    result = run_query(history, {"code": "temperature", "start": bucket.isoformat(), "resolution": "raw", "query_id": "q"})
+    assert result["query_id"] == "q"
+    assert [series["key"] for series in result["series"]] == ["temperature"]
+    assert [point[1] for point in result["series"][0]["points"]] == [20.0, 22.0, 21.0, 19.0]
+
+    result = run_query(history, {"start": bucket.isoformat(), "resolution": "1min"})
+    assert result["fields"] == ["ts", "avg", "min", "max"]
+    assert [point[1:] for point in result["series"][0]["points"]] == [[21.0, 20.0, 22.0], [19.0, 19.0, 19.0]]
+
+    result = run_query(history, {"start": bucket.isoformat(), "resolution": "1h"})
+    assert [point[1:] for point in result["series"][0]["points"]] == [[20.5, 19.0, 22.0]]
+
+
+def test_history_query_error(history):
+    assert "error" in run_query(history, {"resolution": "1s"})
+
+
+def test_history_prune_keeps_tiers_missing_from_retention(history):
+    now = datetime.datetime.now()
+    history.record(make_temperature_msg(now - datetime.timedelta(days=10), 18.0))
+    history.record(make_temperature_msg(now, 20.0))
+    run_query(history, {}) # i.e. once written
+    history.stop()
+
+    assert history.retention_days == {"raw": 7, "1min": 14, "15min": 180, "1h": 1825}
+    conn = sqlite3.connect(history.db_file)
+    history._prune(conn)
+    conn.commit()
+    counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        for table in ("samples", "rollup_60", "rollup_900", "rollup_3600")}
+    conn.close()
+    assert counts == {"samples": 1, "rollup_60": 2, "rollup_900": 2, "rollup_3600": 2}
+
+
+def test_history_retention_zero_keeps_for_ever(tmp_path):
+    history = e.HistoryStore(str(tmp_path / "history.db"), ["temperature"], {"raw": 0, "1min": 1}, 0.05)
+    history.record(make_temperature_msg(datetime.datetime.now() - datetime.timedelta(days=10), 18.0))
+    run_query(history, {})
+    history.stop()
+
+    conn = sqlite3.connect(history.db_file)
+    history._prune(conn)
+    conn.commit()
+    assert conn.execute("SELECT COUNT(*) FROM samples").fetchone()[0] == 1
+    assert conn.execute("SELECT COUNT(*) FROM rollup_60").fetchone()[0] == 0
+    conn.close()
+
+
+def test_history_stop_does_not_hang_when_queue_full(tmp_path):
+    history = e.HistoryStore(str(tmp_path / "history.db"), ["temperature"], {}, 0.05, max_queued=2)
+    stalled, release = threading.Event(), threading.Event()
+
+    def stall(result):
+        stalled.set()
+        release.wait(10)
+
+    history.query({}, stall)
+    assert stalled.wait(10)
+    history.record(make_temperature_msg(datetime.datetime.now(), 20.0))
+    history.record(make_temperature_msg(datetime.datetime.now(), 20.5))
+    history.record(make_temperature_msg(datetime.datetime.now(), 21.0))
+    assert history.dropped == 1
+
+    start = time.monotonic()
+    history.stop(timeout=0.5)
+    assert time.monotonic() - start < 5
+    release.set()
+    history._thread.join(10)
+    assert not history._thread.is_alive()